@@ -2,15 +2,20 @@ package common
 
 import (
 	"bufio"
+	"bytes"
+	"encoding/binary"
 	"fmt"
 	"os"
 	"strconv"
 	"strings"
+	"time"
 )
 
 const BET_SEPARATOR = "+"
 const CSV_SEPARATOR = ","
 const NUMBER_OF_FIELDS = 5
+const BIRTHDATE_LAYOUT = "2006-01-02"
+const MAX_NAME_BYTES = 255
 
 type Bet struct {
 	Agency    string
@@ -43,6 +48,46 @@ func (b *Bet) Encode() string {
 	return strings.Join(params, BET_SEPARATOR)
 }
 
+// EncodeCSV Encodes the bet as a CSV record for bulk uploads
+func (b *Bet) EncodeCSV() string {
+	params := []string{
+		b.Name,
+		b.Surname,
+		strconv.Itoa(b.Document),
+		b.Birthdate,
+		strconv.Itoa(b.Number),
+	}
+
+	return strings.Join(params, CSV_SEPARATOR)
+}
+
+// EncodeBinary Encodes the bet for the binary protocol:
+// | document (u64) | number (u32) | birthdate as YYYYMMDD (u32) |
+// | first name size (u8) | first name | last name size (u8) | last name |
+func (b *Bet) EncodeBinary() ([]byte, error) {
+	birthdate, err := time.Parse(BIRTHDATE_LAYOUT, b.Birthdate)
+	if err != nil {
+		return nil, fmt.Errorf("invalid birthdate field")
+	}
+
+	if len(b.Name) > MAX_NAME_BYTES || len(b.Surname) > MAX_NAME_BYTES {
+		return nil, fmt.Errorf("name too long")
+	}
+
+	packedBirthdate := birthdate.Year()*10000 + int(birthdate.Month())*100 + birthdate.Day()
+
+	encoded := new(bytes.Buffer)
+	binary.Write(encoded, binary.LittleEndian, uint64(b.Document))
+	binary.Write(encoded, binary.LittleEndian, uint32(b.Number))
+	binary.Write(encoded, binary.LittleEndian, uint32(packedBirthdate))
+	encoded.WriteByte(byte(len(b.Name)))
+	encoded.WriteString(b.Name)
+	encoded.WriteByte(byte(len(b.Surname)))
+	encoded.WriteString(b.Surname)
+
+	return encoded.Bytes(), nil
+}
+
 func fromCSVLine(betString string) (Bet, error) {
 	params := strings.Split(betString, CSV_SEPARATOR)
 
@@ -1,7 +1,9 @@
 package common
 
 import (
+	"errors"
 	"fmt"
+	"sort"
 	"time"
 
 	"github.com/7574-sistemas-distribuidos/docker-compose-init/client/communication"
@@ -17,6 +19,12 @@ type AgencyConfig struct {
 	ID            string
 	ServerAddress string
 	BatchAmount   int
+	BatchWindow   int
+	Binary        bool
+	Resume        bool
+	Bulk          bool
+	Compression   bool
+	KeepAlive     bool
 	DataFilePath  string
 }
 
@@ -25,10 +33,20 @@ type Agency struct {
 	bets          chan Bet
 	freeBets      chan struct{}
 	done          chan struct{}
-	nextBet       string
+	nextBet       []byte
+	skipBets      int
 	running       bool
 	sleepTime     time.Duration
 	server_socket *communication.ServerSocket
+	inFlight      map[int]inFlightBatch
+	sessionToken  string
+}
+
+// inFlightBatch A batch sent to the server that was not acknowledged yet, kept
+// to send it again if the server throttles it
+type inFlightBatch struct {
+	bets int
+	msg  []byte
 }
 
 func NewAgency(config AgencyConfig, done chan struct{}) Agency {
@@ -39,6 +57,11 @@ func NewAgency(config AgencyConfig, done chan struct{}) Agency {
 		freeBets <- struct{}{}
 	}
 
+	// A window of one batch is the stop-and-wait protocol
+	if config.BatchWindow < 1 {
+		config.BatchWindow = 1
+	}
+
 	return Agency{
 		config:    config,
 		bets:      make(chan Bet, config.BatchAmount),
@@ -46,6 +69,7 @@ func NewAgency(config AgencyConfig, done chan struct{}) Agency {
 		done:      done,
 		running:   true,
 		sleepTime: 1,
+		inFlight:  make(map[int]inFlightBatch),
 	}
 }
 
@@ -61,11 +85,18 @@ func (a *Agency) Run() {
 	// Close the connection when the function ends
 	defer a.cleanUp()
 
+	log.Infof("action: ronda | result: success | ronda: %v", a.server_socket.Round())
+
 	// Go routine to read the data from the file
 	go ReadBetsFromFile(a.config.DataFilePath, a.bets, a.freeBets, a.done)
 
-	// Build and send batches until the channel is closed (no more bets)
-	err = a.sendBets()
+	// Build and send batches (or stream them in a bulk upload) until the
+	// channel is closed (no more bets)
+	if a.config.Bulk {
+		err = a.uploadBets()
+	} else {
+		err = a.sendBets()
+	}
 	if err != nil || !a.running {
 		return
 	}
@@ -96,44 +127,94 @@ func (a *Agency) Stop() {
 }
 
 func (a *Agency) connectToServer() error {
-	server_socket, err := communication.Connect(a.config.ServerAddress, a.config.ID)
-	if err != nil {
-		return err
+	options := []string{communication.ROUND_OPTION}
+	if a.config.Binary {
+		options = append(options, communication.BINARY_PROTOCOL_OPTION)
+	}
+	if a.config.Resume {
+		options = append(options, communication.RESUME_OPTION)
+	}
+	if a.config.Compression {
+		options = append(options, communication.COMPRESSION_OPTION)
+	}
+	if a.config.KeepAlive {
+		// The session of a previous connection is resumed
+		if a.sessionToken != "" {
+			options = append(options, communication.KEEPALIVE_OPTION+"="+a.sessionToken)
+		} else {
+			options = append(options, communication.KEEPALIVE_OPTION)
+		}
 	}
 
-	a.server_socket = &server_socket
-	return nil
+	for {
+		server_socket, err := communication.Connect(a.config.ServerAddress, a.config.ID, options)
+
+		// The server is at its connections limit, so it is tried again
+		// after the time it asked for
+		var retryAfter *communication.RetryAfterError
+		if errors.As(err, &retryAfter) && a.running {
+			log.Infof("action: connect | result: in_progress | espera_ms: %v", retryAfter.Delay.Milliseconds())
+			time.Sleep(retryAfter.Delay)
+			continue
+		}
+
+		if err != nil {
+			return err
+		}
+
+		a.server_socket = &server_socket
+		a.sessionToken, _ = server_socket.Session()
+		return nil
+	}
 }
 
 func (a *Agency) disconnectFromServer() {
 	if a.server_socket != nil {
+		// Persistent sessions are only closed by the server once shut down
+		if token, _ := a.server_socket.Session(); token != "" {
+			a.sendEncodedMessage(communication.EncodedShutdownMessage())
+		}
+
+		a.logCompressionStats()
 		a.server_socket.Close()
 	}
 
 	a.server_socket = nil
 }
 
-func (a *Agency) waitForServerResponse() (string, string, error) {
-	msg, err := a.server_socket.Read()
-
-	if err != nil {
-		return "", "", err
+func (a *Agency) logCompressionStats() {
+	stats, compressed := a.server_socket.CompressionStats()
+	if !compressed {
+		return
 	}
 
-	return communication.DecodeMessage(msg)
+	log.Infof("action: compresion | result: success | enviados: %v | enviados_comprimidos: %v | ratio_envio: %v | recibidos: %v | recibidos_comprimidos: %v | ratio_recepcion: %v | cpu_ms: %.1f",
+		stats.BytesSent,
+		stats.CompressedBytesSent,
+		compressionRatio(stats.BytesSent, stats.CompressedBytesSent),
+		stats.BytesReceived,
+		stats.CompressedBytesReceived,
+		compressionRatio(stats.BytesReceived, stats.CompressedBytesReceived),
+		float64(stats.CompressionTime.Microseconds())/1000,
+	)
 }
 
-func (a *Agency) waitForSuccessServerResponse() error {
-	header, _, err := a.waitForServerResponse()
-	if err != nil {
-		return err
+func compressionRatio(size int, compressedSize int) string {
+	if compressedSize == 0 {
+		return "-"
 	}
 
-	if header != communication.SUCCESS_MESSAGE {
-		return fmt.Errorf("server response was not success")
+	return fmt.Sprintf("%.2f", float64(size)/float64(compressedSize))
+}
+
+func (a *Agency) waitForServerResponse() (string, string, error) {
+	msg, err := a.server_socket.Read()
+
+	if err != nil {
+		return "", "", err
 	}
 
-	return nil
+	return communication.DecodeMessage(msg)
 }
 
 func (a *Agency) waitForResultServerResponse() (bool, string, error) {
@@ -171,7 +252,17 @@ func (a *Agency) sendRequestResultsMessage() error {
 	return a.sendEncodedMessage(msg)
 }
 
+// sendBets Sends the batches pipelined: up to BatchWindow batches can be
+// waiting for their acknowledgement at the same time
 func (a *Agency) sendBets() error {
+	// Bets already persisted by the server (e.g. before it was restarted)
+	// are skipped, and the sequence numbers continue after them
+	sequenceNumber, skipBets := a.server_socket.ResumePoint()
+	a.skipBets = skipBets
+	if skipBets > 0 {
+		log.Infof("action: reanudar_envio | result: success | secuencia: %v | apuestas: %v", sequenceNumber, skipBets)
+	}
+
 	for a.running {
 		batch := a.buildBatch()
 
@@ -179,32 +270,211 @@ func (a *Agency) sendBets() error {
 			break
 		}
 
-		msg := communication.EncodedBetBatchMessage(batch)
-		err := a.server_socket.Write(msg)
+		sequenceNumber++
+		var msg []byte
+		if a.server_socket.Binary() {
+			msg = communication.EncodedBinaryBetBatchMessage(sequenceNumber, batch)
+		} else {
+			msg = communication.EncodedSequencedBetBatchMessage(sequenceNumber, batch)
+		}
+
+		err := a.server_socket.WriteBytes(msg)
 		if err != nil {
 			log.Criticalf("action: apuesta_enviada | result: fail | cantidad: %v", len(batch))
 			return err
 		}
 
-		err = a.waitForSuccessServerResponse()
+		a.inFlight[sequenceNumber] = inFlightBatch{bets: len(batch), msg: msg}
 
-		if err != nil {
-			log.Criticalf("action: apuesta_enviada | result: fail | cantidad: %v", len(batch))
+		for len(a.inFlight) >= a.config.BatchWindow {
+			if err := a.waitForBatchAcknowledgement(); err != nil {
+				return err
+			}
+		}
+	}
+
+	for len(a.inFlight) > 0 && a.running {
+		if err := a.waitForBatchAcknowledgement(); err != nil {
+			return err
+		}
+	}
+
+	return nil
+}
+
+// waitForBatchAcknowledgement Waits for an ack or nack of the server. Acks are
+// cumulative, so every batch up to the acknowledged one is no longer in flight
+func (a *Agency) waitForBatchAcknowledgement() error {
+	header, payload, err := a.waitForServerResponse()
+	if err != nil {
+		return err
+	}
+
+	if header == communication.RETRY_AFTER_MESSAGE {
+		return a.resendThrottledBatches(payload)
+	}
+
+	if header != communication.ACK_MESSAGE && header != communication.NACK_MESSAGE {
+		return fmt.Errorf("invalid message type in batch acknowledgement")
+	}
+
+	sequenceNumber, err := communication.DecodeSequenceNumber(payload)
+	if err != nil {
+		return err
+	}
+
+	if header == communication.NACK_MESSAGE {
+		log.Criticalf("action: apuesta_enviada | result: fail | cantidad: %v", a.inFlight[sequenceNumber].bets)
+		return fmt.Errorf("server failed to store batch %v", sequenceNumber)
+	}
+
+	for pending := range a.inFlight {
+		if pending <= sequenceNumber {
+			delete(a.inFlight, pending)
+		}
+	}
+
+	return nil
+}
+
+// resendThrottledBatches Waits the time asked by the server and sends again
+// the throttled batch followed by every batch sent after it, which the server
+// dropped without reply
+func (a *Agency) resendThrottledBatches(payload string) error {
+	sequenceNumber, delay, err := communication.DecodeRetryAfter(payload)
+	if err != nil {
+		return err
+	}
+
+	log.Debugf("action: limitar_envio | result: in_progress | secuencia: %v | espera_ms: %v", sequenceNumber, delay.Milliseconds())
+	time.Sleep(delay)
+
+	pending := []int{}
+	for inFlightSequence := range a.inFlight {
+		if inFlightSequence >= sequenceNumber {
+			pending = append(pending, inFlightSequence)
+		}
+	}
+	sort.Ints(pending)
+
+	for _, inFlightSequence := range pending {
+		if err := a.server_socket.WriteBytes(a.inFlight[inFlightSequence].msg); err != nil {
+			return err
+		}
+	}
+
+	return nil
+}
+
+// uploadBets Streams every bet as CSV records in chunks after switching the
+// connection to a bulk upload. Chunks are not acknowledged one by one: the
+// server replies the stored and rejected bets once the upload ends
+func (a *Agency) uploadBets() error {
+	if err := a.startBulkUpload(); err != nil {
+		log.Criticalf("action: carga_masiva | result: fail | error: %v", err)
+		return err
+	}
+
+	// Each chunk is a checkpoint, numbered after the ones already persisted
+	checkpoint, skipBets := a.server_socket.ResumePoint()
+	if skipBets > 0 {
+		log.Infof("action: reanudar_envio | result: success | secuencia: %v | apuestas: %v", checkpoint, skipBets)
+	}
+
+	chunk := make([]byte, 0, communication.MAX_BULK_CHUNK_BYTES)
+	for a.running {
+		bet, ok := <-a.bets
+		if !ok {
+			break
+		}
+
+		a.freeBets <- struct{}{}
+
+		if skipBets > 0 {
+			skipBets--
+			continue
+		}
+
+		record := bet.EncodeCSV()
+		if len(chunk) > 0 && !communication.CanAppendRecordToChunk(len(chunk), len(record)) {
+			checkpoint++
+			if err := a.server_socket.WriteBytes(communication.EncodedBulkChunkMessage(checkpoint, chunk)); err != nil {
+				log.Criticalf("action: carga_masiva | result: fail | error: %v", err)
+				return err
+			}
+			chunk = chunk[:0]
+		}
+
+		if len(chunk) > 0 {
+			chunk = append(chunk, communication.BULK_RECORD_SEPARATOR)
+		}
+		chunk = append(chunk, record...)
+	}
+
+	if !a.running {
+		return nil
+	}
+
+	if len(chunk) > 0 {
+		checkpoint++
+		if err := a.server_socket.WriteBytes(communication.EncodedBulkChunkMessage(checkpoint, chunk)); err != nil {
+			log.Criticalf("action: carga_masiva | result: fail | error: %v", err)
 			return err
 		}
 	}
 
+	return a.endBulkUpload()
+}
+
+func (a *Agency) startBulkUpload() error {
+	if err := a.sendEncodedMessage(communication.EncodedBulkUploadMessage()); err != nil {
+		return err
+	}
+
+	header, _, err := a.waitForServerResponse()
+	if err != nil {
+		return err
+	}
+
+	if header != communication.SUCCESS_MESSAGE {
+		return fmt.Errorf("server rejected the bulk upload")
+	}
+
+	a.server_socket.UseLengthPrefixedFrames()
+	return nil
+}
+
+func (a *Agency) endBulkUpload() error {
+	if err := a.sendEncodedMessage(communication.EncodedBulkEndMessage()); err != nil {
+		return err
+	}
+
+	header, payload, err := a.waitForServerResponse()
+	if err != nil {
+		return err
+	}
+
+	if header != communication.BULK_ACK_MESSAGE {
+		return fmt.Errorf("invalid message type in bulk upload acknowledgement")
+	}
+
+	stored, rejected, err := communication.DecodeBulkAck(payload)
+	if err != nil {
+		return err
+	}
+
+	log.Infof("action: carga_masiva | result: success | apuestas: %v | rechazadas: %v", stored, rejected)
 	return nil
 }
 
-func (a *Agency) buildBatch() []string {
-	batch := []string{}
+func (a *Agency) buildBatch() [][]byte {
+	batch := [][]byte{}
 	accumlatedBytes := 0
 	for len(batch) < a.config.BatchAmount {
-		if a.nextBet != "" {
+		if a.nextBet != nil {
 			batch = append(batch, a.nextBet)
 			accumlatedBytes += len(a.nextBet)
-			a.nextBet = ""
+			a.nextBet = nil
 		}
 
 		if len(batch) > 1 {
@@ -217,9 +487,21 @@ func (a *Agency) buildBatch() []string {
 		}
 
 		a.freeBets <- struct{}{}
-		a.nextBet = bet.Encode()
 
-		if !communication.CanAppendBetToBatch(accumlatedBytes, a.nextBet) {
+		encodedBet, err := a.encodeBet(bet)
+		if err != nil {
+			log.Errorf("Error encoding bet: %v", err)
+			continue
+		}
+
+		if a.skipBets > 0 {
+			a.skipBets--
+			continue
+		}
+
+		a.nextBet = encodedBet
+
+		if !communication.CanAppendBetToBatch(accumlatedBytes, len(a.nextBet)) {
 			break
 		}
 
@@ -228,6 +510,14 @@ func (a *Agency) buildBatch() []string {
 	return batch
 }
 
+func (a *Agency) encodeBet(bet Bet) ([]byte, error) {
+	if a.server_socket.Binary() {
+		return bet.EncodeBinary()
+	}
+
+	return []byte(bet.Encode()), nil
+}
+
 func (a *Agency) fetchServerResults() error {
 	for a.running {
 		if a.sleepTime > MAX_DELAY {
@@ -252,10 +542,18 @@ func (a *Agency) fetchServerResults() error {
 		}
 
 		if !done {
-			a.disconnectFromServer()
-
-			// Exponential backoff
+			// Exponential backoff. A persistent session keeps its connection
+			// open in the meantime
 			a.sleepTime *= DELAY_MULTIPLIER
+
+			if token, _ := a.server_socket.Session(); token != "" {
+				if err := a.waitKeepingAlive(a.sleepTime * time.Second); err != nil {
+					return err
+				}
+				continue
+			}
+
+			a.disconnectFromServer()
 			time.Sleep(a.sleepTime * time.Second)
 			continue
 		}
@@ -267,6 +565,42 @@ func (a *Agency) fetchServerResults() error {
 	return nil
 }
 
+// waitKeepingAlive Waits the given time sending heartbeats often enough for
+// the server not to evict the persistent session for being idle
+func (a *Agency) waitKeepingAlive(delay time.Duration) error {
+	_, idleTimeout := a.server_socket.Session()
+	interval := idleTimeout / 2
+
+	for delay > 0 && a.running {
+		step := delay
+		if interval > 0 && interval < step {
+			step = interval
+		}
+
+		time.Sleep(step)
+		delay -= step
+
+		if delay <= 0 {
+			break
+		}
+
+		if err := a.sendEncodedMessage(communication.EncodedHeartbeatMessage()); err != nil {
+			return err
+		}
+
+		header, _, err := a.waitForServerResponse()
+		if err != nil {
+			return err
+		}
+
+		if header != communication.SUCCESS_MESSAGE {
+			return fmt.Errorf("invalid message type in heartbeat")
+		}
+	}
+
+	return nil
+}
+
 func (a *Agency) processWinnersMessage(message string) {
 	winners := communication.DecodeWinnersMessage(message)
 
@@ -1,30 +1,118 @@
 package communication
 
-import "strings"
+import (
+	"bytes"
+	"encoding/binary"
+	"strconv"
+	"strings"
+)
 
 const BATCH_SEPARATOR = '*'
+const SEQUENCE_SEPARATOR = '#'
+const OPTION_SEPARATOR = ';'
+
+const BINARY_PROTOCOL_OPTION = "binary"
+
+// COMPRESSION_OPTION compresses both directions of the connection with a
+// raw deflate stream once the identification is replied
+const COMPRESSION_OPTION = "zlib"
+
+// RESUME_OPTION is accepted as resume=<last persisted sequence number>,<persisted bets>
+const RESUME_OPTION = "resume"
+const RESUME_SEPARATOR = ','
+
+// ROUND_OPTION is accepted as round=<round id>, the lottery round in which
+// the bets of the agency are stored
+const ROUND_OPTION = "round"
+
+// KEEPALIVE_OPTION keeps the connection open after the results, until the
+// agency shuts it down. Requested as keepalive (or keepalive=<token> to resume
+// a session) and accepted as keepalive=<token>,<idle timeout ms>
+const KEEPALIVE_OPTION = "keepalive"
+const KEEPALIVE_SEPARATOR = ','
 
 const AGENCY_IDENTIFICATION_MESSAGE = "agency"
 const BET_BATCH_MESSAGE = "bet_batch"
+const SEQUENCED_BET_BATCH_MESSAGE = "bet_batch_seq"
+const BINARY_BET_BATCH_MESSAGE = "bet_batch_bin"
+const BULK_UPLOAD_MESSAGE = "bulk_upload"
+const BULK_CHUNK_MESSAGE = "bulk_chunk"
+const BULK_END_MESSAGE = "bulk_end"
 const FINISH_MESSAGE = "finish"
 const REQUEST_RESULTS_MESSAGE = "request_results"
+const HEARTBEAT_MESSAGE = "heartbeat"
+const SHUTDOWN_MESSAGE = "shutdown"
 
 const MAX_BATCH_BYTES = 1024*8 - 1 // 8KB - 1 (communication delimiter)
 
+// Bulk upload chunks hold CSV records separated by BULK_RECORD_SEPARATOR and
+// must fit in the 1MB receive buffer the server uses for bulk uploads
+const BULK_RECORD_SEPARATOR = '\n'
+const MAX_BULK_CHUNK_BYTES = 1024 * 512
+
 func encodedMessage(header string, message string) string {
 	return header + string(HEADER_SEPARATOR) + message
 }
 
-func EncodedIdentificationMessage(agencyId string) string {
-	return encodedMessage(AGENCY_IDENTIFICATION_MESSAGE, agencyId)
+// EncodedIdentificationMessage Encodes the identification of the agency along
+// with the protocol options it requests (e.g. agency:1;binary)
+func EncodedIdentificationMessage(agencyId string, options []string) string {
+	payload := strings.Join(append([]string{agencyId}, options...), string(OPTION_SEPARATOR))
+	return encodedMessage(AGENCY_IDENTIFICATION_MESSAGE, payload)
 }
 
 func EncodedBetBatchMessage(batch []string) string {
 	return encodedMessage(BET_BATCH_MESSAGE, strings.Join(batch, string(BATCH_SEPARATOR)))
 }
 
-func CanAppendBetToBatch(accumlatedBytes int, bet string) bool {
-	return accumlatedBytes+len(bet)+1 <= MAX_BATCH_BYTES
+// EncodedSequencedBetBatchMessage Encodes a batch tagged with its sequence number,
+// so it can be pipelined and acknowledged by the server
+func EncodedSequencedBetBatchMessage(sequenceNumber int, batch [][]byte) []byte {
+	payload := strconv.Itoa(sequenceNumber) + string(SEQUENCE_SEPARATOR) +
+		string(bytes.Join(batch, []byte{BATCH_SEPARATOR}))
+
+	return []byte(encodedMessage(SEQUENCED_BET_BATCH_MESSAGE, payload))
+}
+
+// EncodedBinaryBetBatchMessage Encodes a batch of binary encoded bets:
+// | sequence number (u32) | bets count (u32) | bets |
+func EncodedBinaryBetBatchMessage(sequenceNumber int, batch [][]byte) []byte {
+	message := bytes.NewBufferString(BINARY_BET_BATCH_MESSAGE + string(HEADER_SEPARATOR))
+
+	binary.Write(message, binary.LittleEndian, uint32(sequenceNumber))
+	binary.Write(message, binary.LittleEndian, uint32(len(batch)))
+
+	for _, bet := range batch {
+		message.Write(bet)
+	}
+
+	return message.Bytes()
+}
+
+func CanAppendBetToBatch(accumlatedBytes int, betSize int) bool {
+	return accumlatedBytes+betSize+1 <= MAX_BATCH_BYTES
+}
+
+func EncodedBulkUploadMessage() string {
+	return encodedMessage(BULK_UPLOAD_MESSAGE, "")
+}
+
+// EncodedBulkChunkMessage Encodes a chunk of CSV records of a bulk upload,
+// tagged with its checkpoint: bulk_chunk:<checkpoint>#<records>
+func EncodedBulkChunkMessage(checkpoint int, records []byte) []byte {
+	header := encodedMessage(BULK_CHUNK_MESSAGE, strconv.Itoa(checkpoint)+string(SEQUENCE_SEPARATOR))
+
+	message := make([]byte, 0, len(header)+len(records))
+	message = append(message, header...)
+	return append(message, records...)
+}
+
+func EncodedBulkEndMessage() string {
+	return encodedMessage(BULK_END_MESSAGE, "")
+}
+
+func CanAppendRecordToChunk(accumlatedBytes int, recordSize int) bool {
+	return accumlatedBytes+recordSize+1 <= MAX_BULK_CHUNK_BYTES
 }
 
 func EncodedFinishMessage() string {
@@ -34,3 +122,11 @@ func EncodedFinishMessage() string {
 func EncodedRequestResultsMessage() string {
 	return encodedMessage(REQUEST_RESULTS_MESSAGE, "")
 }
+
+func EncodedHeartbeatMessage() string {
+	return encodedMessage(HEARTBEAT_MESSAGE, "")
+}
+
+func EncodedShutdownMessage() string {
+	return encodedMessage(SHUTDOWN_MESSAGE, "")
+}
@@ -2,7 +2,9 @@ package communication
 
 import (
 	"fmt"
+	"strconv"
 	"strings"
+	"time"
 )
 
 const HEADER_SEPARATOR = ':'
@@ -12,6 +14,12 @@ const WINNERS_MESSAGE = "winners"
 const NOT_READY_MESSAGE = "not_ready"
 const SUCCESS_MESSAGE = "success"
 const FAILURE_MESSAGE = "failure"
+const ACK_MESSAGE = "ack"
+const NACK_MESSAGE = "nack"
+const BULK_ACK_MESSAGE = "bulk_ack"
+const RETRY_AFTER_MESSAGE = "retry_after"
+
+const COUNT_SEPARATOR = ','
 
 func DecodeMessage(message string) (string, string, error) {
 	fields := strings.Split(message, string(HEADER_SEPARATOR))
@@ -20,7 +28,16 @@ func DecodeMessage(message string) (string, string, error) {
 		return "", "", fmt.Errorf("invalid message format")
 	}
 
-	headers := []string{WINNERS_MESSAGE, NOT_READY_MESSAGE, SUCCESS_MESSAGE, FAILURE_MESSAGE}
+	headers := []string{
+		WINNERS_MESSAGE,
+		NOT_READY_MESSAGE,
+		SUCCESS_MESSAGE,
+		FAILURE_MESSAGE,
+		ACK_MESSAGE,
+		NACK_MESSAGE,
+		BULK_ACK_MESSAGE,
+		RETRY_AFTER_MESSAGE,
+	}
 
 	for _, header := range headers {
 		if fields[0] == header {
@@ -31,6 +48,57 @@ func DecodeMessage(message string) (string, string, error) {
 	return "", "", fmt.Errorf("invalid message type")
 }
 
+// DecodeSequenceNumber Decodes the sequence number of an ack or nack message
+func DecodeSequenceNumber(message string) (int, error) {
+	sequenceNumber, err := strconv.Atoi(message)
+	if err != nil {
+		return 0, fmt.Errorf("invalid sequence number")
+	}
+
+	return sequenceNumber, nil
+}
+
+// DecodeBulkAck Decodes the counts of stored and rejected bets of a bulk upload
+func DecodeBulkAck(message string) (int, int, error) {
+	fields := strings.Split(message, string(COUNT_SEPARATOR))
+	if len(fields) != 2 {
+		return 0, 0, fmt.Errorf("invalid bulk ack")
+	}
+
+	stored, err := strconv.Atoi(fields[0])
+	if err != nil {
+		return 0, 0, fmt.Errorf("invalid bulk ack")
+	}
+
+	rejected, err := strconv.Atoi(fields[1])
+	if err != nil {
+		return 0, 0, fmt.Errorf("invalid bulk ack")
+	}
+
+	return stored, rejected, nil
+}
+
+// DecodeRetryAfter Decodes the sequence number of a throttled batch (zero for
+// a rejected connection) and the time to wait before sending it again
+func DecodeRetryAfter(message string) (int, time.Duration, error) {
+	fields := strings.Split(message, string(COUNT_SEPARATOR))
+	if len(fields) != 2 {
+		return 0, 0, fmt.Errorf("invalid retry after")
+	}
+
+	sequenceNumber, err := strconv.Atoi(fields[0])
+	if err != nil {
+		return 0, 0, fmt.Errorf("invalid retry after")
+	}
+
+	milliseconds, err := strconv.Atoi(fields[1])
+	if err != nil {
+		return 0, 0, fmt.Errorf("invalid retry after")
+	}
+
+	return sequenceNumber, time.Duration(milliseconds) * time.Millisecond, nil
+}
+
 func DecodeWinnersMessage(message string) []string {
 	return strings.Split(message, string(WINNERS_SEPARATOR))
 }
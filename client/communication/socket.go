@@ -2,17 +2,68 @@ package communication
 
 import (
 	"bufio"
+	"bytes"
+	"compress/flate"
+	"encoding/binary"
+	"fmt"
+	"io"
 	"net"
+	"strconv"
+	"strings"
+	"time"
 )
 
 const COMMUNICATION_DELIMITER = '\n'
 
 type ServerSocket struct {
-	conn   net.Conn
-	reader *bufio.Reader
+	conn           net.Conn
+	reader         *bufio.Reader
+	lengthPrefixed bool
+	resumeSequence int
+	resumeBets     int
+	roundId        int
+	sessionToken   string
+	idleTimeout    time.Duration
+	compressor     *flate.Writer
+	compressed     *bytes.Buffer
+	received       *countingReader
+	stats          CompressionStats
 }
 
-func Connect(address string, agencyId string) (ServerSocket, error) {
+// CompressionStats Sizes of the messages before and after compression, and
+// the time spent compressing them
+type CompressionStats struct {
+	BytesSent               int
+	CompressedBytesSent     int
+	BytesReceived           int
+	CompressedBytesReceived int
+	CompressionTime         time.Duration
+}
+
+type countingReader struct {
+	reader io.Reader
+	count  int
+}
+
+func (r *countingReader) Read(p []byte) (int, error) {
+	n, err := r.reader.Read(p)
+	r.count += n
+	return n, err
+}
+
+// RetryAfterError The server rejected the connection because it is at its
+// connections limit, and the agency must wait Delay before connecting again
+type RetryAfterError struct {
+	Delay time.Duration
+}
+
+func (e *RetryAfterError) Error() string {
+	return fmt.Sprintf("server busy, retry after %v", e.Delay)
+}
+
+// Connect Connects to the server and identifies the agency. If protocol options
+// are requested, waits for the server to reply with the accepted ones
+func Connect(address string, agencyId string, options []string) (ServerSocket, error) {
 	conn, err := net.Dial("tcp", address)
 	if err != nil {
 		return ServerSocket{}, err
@@ -23,9 +74,13 @@ func Connect(address string, agencyId string) (ServerSocket, error) {
 		reader: bufio.NewReader(conn),
 	}
 
-	startMessage := EncodedIdentificationMessage(agencyId)
+	startMessage := EncodedIdentificationMessage(agencyId, options)
 	err = serverSocket.Write(startMessage)
 
+	if err == nil && len(options) > 0 {
+		err = serverSocket.negotiateOptions()
+	}
+
 	if err != nil {
 		conn.Close()
 		return ServerSocket{}, err
@@ -34,17 +89,155 @@ func Connect(address string, agencyId string) (ServerSocket, error) {
 	return serverSocket, nil
 }
 
+func (s *ServerSocket) negotiateOptions() error {
+	message, err := s.Read()
+	if err != nil {
+		return err
+	}
+
+	header, payload, err := DecodeMessage(message)
+	if err != nil {
+		return err
+	}
+
+	if header == RETRY_AFTER_MESSAGE {
+		_, delay, err := DecodeRetryAfter(payload)
+		if err != nil {
+			return err
+		}
+		return &RetryAfterError{Delay: delay}
+	}
+
+	if header != SUCCESS_MESSAGE {
+		return fmt.Errorf("server rejected the identification")
+	}
+
+	for _, option := range strings.Split(payload, string(OPTION_SEPARATOR)) {
+		if option == BINARY_PROTOCOL_OPTION {
+			s.lengthPrefixed = true
+		}
+
+		if option == COMPRESSION_OPTION {
+			if err := s.useCompression(); err != nil {
+				return err
+			}
+		}
+
+		if strings.HasPrefix(option, ROUND_OPTION+"=") {
+			roundId, err := strconv.Atoi(strings.TrimPrefix(option, ROUND_OPTION+"="))
+			if err != nil {
+				return err
+			}
+			s.roundId = roundId
+		}
+
+		if strings.HasPrefix(option, KEEPALIVE_OPTION+"=") {
+			if err := s.decodeSession(strings.TrimPrefix(option, KEEPALIVE_OPTION+"=")); err != nil {
+				return err
+			}
+		}
+
+		if strings.HasPrefix(option, RESUME_OPTION+"=") {
+			if err := s.decodeResumePoint(strings.TrimPrefix(option, RESUME_OPTION+"=")); err != nil {
+				return err
+			}
+		}
+	}
+
+	return nil
+}
+
+// useCompression Compresses every following message in both directions with
+// a single deflate stream per direction, flushed after every message
+func (s *ServerSocket) useCompression() error {
+	s.compressed = new(bytes.Buffer)
+	compressor, err := flate.NewWriter(s.compressed, flate.DefaultCompression)
+	if err != nil {
+		return err
+	}
+
+	// The buffered reader may already hold bytes after the identification reply
+	s.received = &countingReader{reader: s.reader}
+	s.reader = bufio.NewReader(flate.NewReader(s.received))
+	s.compressor = compressor
+	return nil
+}
+
+func (s *ServerSocket) decodeSession(session string) error {
+	fields := strings.Split(session, string(KEEPALIVE_SEPARATOR))
+	if len(fields) != 2 {
+		return fmt.Errorf("invalid session %v", session)
+	}
+
+	milliseconds, err := strconv.Atoi(fields[1])
+	if err != nil {
+		return err
+	}
+
+	s.sessionToken = fields[0]
+	s.idleTimeout = time.Duration(milliseconds) * time.Millisecond
+	return nil
+}
+
+func (s *ServerSocket) decodeResumePoint(resumePoint string) error {
+	fields := strings.Split(resumePoint, string(RESUME_SEPARATOR))
+	if len(fields) != 2 {
+		return fmt.Errorf("invalid resume point %v", resumePoint)
+	}
+
+	sequence, err := strconv.Atoi(fields[0])
+	if err != nil {
+		return err
+	}
+
+	bets, err := strconv.Atoi(fields[1])
+	if err != nil {
+		return err
+	}
+
+	s.resumeSequence = sequence
+	s.resumeBets = bets
+	return nil
+}
+
 func (s *ServerSocket) Read() (string, error) {
 	message, err := s.reader.ReadString(COMMUNICATION_DELIMITER)
 	if err != nil {
 		return "", err
 	}
 
+	if s.compressor != nil {
+		s.stats.BytesReceived += len(message)
+	}
+
 	return message[:len(message)-1], nil
 }
 
 func (s *ServerSocket) Write(message string) error {
-	message_bytes := []byte(message + string(COMMUNICATION_DELIMITER))
+	return s.WriteBytes([]byte(message))
+}
+
+// WriteBytes Writes a message delimited by COMMUNICATION_DELIMITER or, once the
+// binary protocol was negotiated, prefixed by its size (u32)
+func (s *ServerSocket) WriteBytes(message []byte) error {
+	var message_bytes []byte
+
+	if s.lengthPrefixed {
+		message_bytes = make([]byte, 4, 4+len(message))
+		binary.LittleEndian.PutUint32(message_bytes, uint32(len(message)))
+		message_bytes = append(message_bytes, message...)
+	} else {
+		message_bytes = append(message, COMMUNICATION_DELIMITER)
+	}
+
+	if s.compressor != nil {
+		compressed, err := s.compress(message_bytes)
+		if err != nil {
+			return err
+		}
+		message_bytes = compressed
+	}
+
 	bytes_written := 0
 
 	for bytes_written < len(message_bytes) {
@@ -59,6 +252,64 @@ func (s *ServerSocket) Write(message string) error {
 	return nil
 }
 
+// UseLengthPrefixedFrames Prefixes every following message by its size, as
+// required once a bulk upload is accepted
+func (s *ServerSocket) UseLengthPrefixedFrames() {
+	s.lengthPrefixed = true
+}
+
+func (s *ServerSocket) compress(message []byte) ([]byte, error) {
+	start := time.Now()
+	s.compressed.Reset()
+
+	if _, err := s.compressor.Write(message); err != nil {
+		return nil, err
+	}
+	if err := s.compressor.Flush(); err != nil {
+		return nil, err
+	}
+
+	s.stats.CompressionTime += time.Since(start)
+	s.stats.BytesSent += len(message)
+	s.stats.CompressedBytesSent += s.compressed.Len()
+
+	return s.compressed.Bytes(), nil
+}
+
+// CompressionStats Returns the compression stats of the connection, and
+// whether compression was negotiated
+func (s *ServerSocket) CompressionStats() (CompressionStats, bool) {
+	if s.compressor == nil {
+		return CompressionStats{}, false
+	}
+
+	stats := s.stats
+	stats.CompressedBytesReceived = s.received.count
+	return stats, true
+}
+
+// Binary Returns whether the binary protocol was negotiated
+func (s *ServerSocket) Binary() bool {
+	return s.lengthPrefixed
+}
+
+// ResumePoint Returns the last sequence number and the amount of bets the
+// server already persisted for the agency (zero if resume was not negotiated)
+func (s *ServerSocket) ResumePoint() (int, int) {
+	return s.resumeSequence, s.resumeBets
+}
+
+// Session Returns the token of the persistent session (empty if keepalive was
+// not negotiated) and the time it may stay idle before the server evicts it
+func (s *ServerSocket) Session() (string, time.Duration) {
+	return s.sessionToken, s.idleTimeout
+}
+
+// Round Returns the lottery round in which the bets of the agency are stored
+func (s *ServerSocket) Round() int {
+	return s.roundId
+}
+
 func (s *ServerSocket) Close() error {
 	return s.conn.Close()
 }
@@ -40,6 +40,12 @@ func InitConfig() (*viper.Viper, error) {
 	v.BindEnv("loop", "amount")
 	v.BindEnv("log", "level")
 	v.BindEnv("batch", "maxAmount")
+	v.BindEnv("batch", "window")
+	v.BindEnv("protocol", "binary")
+	v.BindEnv("protocol", "resume")
+	v.BindEnv("protocol", "bulk")
+	v.BindEnv("protocol", "compression")
+	v.BindEnv("protocol", "keepalive")
 
 	// Try to read configuration from config file. If config file
 	// does not exists then ReadInConfig will fail but configuration
@@ -101,6 +107,12 @@ func main() {
 		ServerAddress: v.GetString("server.address"),
 		ID:            v.GetString("id"),
 		BatchAmount:   v.GetInt("batch.maxAmount"),
+		BatchWindow:   v.GetInt("batch.window"),
+		Binary:        v.GetBool("protocol.binary"),
+		Resume:        v.GetBool("protocol.resume"),
+		Bulk:          v.GetBool("protocol.bulk"),
+		Compression:   v.GetBool("protocol.compression"),
+		KeepAlive:     v.GetBool("protocol.keepalive"),
 		DataFilePath:  DATA_FILE_PATH,
 	}
 
@@ -0,0 +1,405 @@
+#!/usr/bin/env python3
+"""
+Load generator for the agency protocol. N agencies connect concurrently,
+send synthetic bets with the original protocol (agency, bet_batch, finish,
+request_results) and the ingest throughput, the batch ack latencies, the
+draw time and the peak RSS of the server are reported.
+
+Run from the server directory:
+
+    python3 -m benchmarks.agencies --agencies 5 --bets 20000
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import datetime
+import resource
+import tempfile
+import threading
+import subprocess
+from typing import Optional
+
+from common.lottery import Lottery
+from common.server import Server
+from common.async_server import AsyncServer
+from common.communication.framer import COMMUNICATION_DELIMITER
+from common.communication.agency_message import (
+    BATCH_SEPARATOR,
+    BET_SEPARATOR,
+    HEARDER_SEPARATOR,
+    AgencyHeader,
+)
+from common.communication.server_message import ServerHeader
+
+SERVER_MODES = {"threads": Server, "asyncio": AsyncServer}
+SERVER_DIRPATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LISTEN_BACKLOG = 128
+""" Results are pushed once every agency finished, so agencies wait long
+enough for the slowest one. """
+RESULTS_TIMEOUT = 120.0
+CONNECT_TIMEOUT = 10.0
+CONNECT_BACKOFF = 0.05
+RECEIVE_SIZE = 64 * 1024
+
+FIRST_NAMES = ("Ana", "Juan", "Lucia", "Martin", "Sofia", "Tomas", "Valentina")
+LAST_NAMES = ("Gomez", "Perez", "Rodriguez", "Fernandez", "Lopez", "Diaz")
+FIRST_BIRTHDATE = datetime.date(1950, 1, 1).toordinal()
+LAST_BIRTHDATE = datetime.date(2005, 12, 31).toordinal()
+MAX_NUMBER = 10000
+
+
+def synthetic_batches(
+    agency_id: int, n_bets: int, batch_size: int, seed: int
+) -> list[str]:
+    """
+    Encoded bet batches of an agency. Documents are unique across
+    agencies and the rest of the fields are drawn from the seeded generator.
+    """
+    rng = random.Random(seed * 1_000_003 + agency_id)
+    bets: list[str] = []
+
+    for i in range(n_bets):
+        birthdate = datetime.date.fromordinal(
+            rng.randint(FIRST_BIRTHDATE, LAST_BIRTHDATE)
+        )
+        bets.append(
+            BET_SEPARATOR.join(
+                (
+                    rng.choice(FIRST_NAMES),
+                    rng.choice(LAST_NAMES),
+                    str(agency_id * 10_000_000 + i),
+                    birthdate.isoformat(),
+                    str(rng.randrange(MAX_NUMBER)),
+                )
+            )
+        )
+
+    return [
+        BATCH_SEPARATOR.join(bets[i : i + batch_size])
+        for i in range(0, len(bets), batch_size)
+    ]
+
+
+def encode(header: AgencyHeader, payload: str = "") -> bytes:
+    return (
+        f"{header.value}{HEARDER_SEPARATOR}{payload}{COMMUNICATION_DELIMITER}"
+    ).encode("utf-8")
+
+
+class SimulatedAgency(threading.Thread):
+    """
+    Agency that sends every batch and waits for its ack before sending
+    the next one, as the original protocol does
+    """
+
+    agency_id: int
+    batches: list[str]
+    latencies: list[float]
+    last_ack: float
+    finish_sent: float
+    results_received: float
+    error: Optional[str]
+    _address: tuple[str, int]
+    _start: threading.Barrier
+    _buffer: bytes
+
+    def __init__(
+        self,
+        agency_id: int,
+        batches: list[str],
+        address: tuple[str, int],
+        start: threading.Barrier,
+    ) -> None:
+        super().__init__(daemon=True)
+        self.agency_id = agency_id
+        self.batches = batches
+        self.latencies = []
+        self.last_ack = 0.0
+        self.finish_sent = 0.0
+        self.results_received = 0.0
+        self.error = None
+        self._address = address
+        self._start = start
+        self._buffer = b""
+
+    def run(self) -> None:
+        try:
+            sock: socket.socket = self.__connect()
+        except OSError as e:
+            self.error = f"connect: {e}"
+            self._start.abort()
+            return
+
+        try:
+            with sock:
+                self.__run(sock)
+        except (OSError, ValueError, threading.BrokenBarrierError) as e:
+            self.error = str(e) or type(e).__name__
+
+    def __run(self, sock: socket.socket) -> None:
+        sock.sendall(encode(AgencyHeader.IDENTIFICATION, str(self.agency_id)))
+        self._start.wait()
+
+        for batch in self.batches:
+            sent: float = time.perf_counter()
+            sock.sendall(encode(AgencyHeader.BET_BATCH, batch))
+            reply: str = self.__receive(sock)
+            self.last_ack = time.perf_counter()
+
+            if not reply.startswith(ServerHeader.SUCCESS.value):
+                raise ValueError(f"batch rejected: {reply}")
+
+            self.latencies.append(self.last_ack - sent)
+
+        self.finish_sent = time.perf_counter()
+        sock.sendall(
+            encode(AgencyHeader.FINISH_BETTING) + encode(AgencyHeader.REQUEST_RESULTS)
+        )
+        reply = self.__receive(sock)
+        self.results_received = time.perf_counter()
+
+        if not reply.startswith(ServerHeader.WINNERS.value):
+            raise ValueError(f"results not received: {reply}")
+
+    def __connect(self) -> socket.socket:
+        # The server may still be starting, so refused connections are retried
+        deadline: float = time.monotonic() + CONNECT_TIMEOUT
+
+        while True:
+            try:
+                sock = socket.create_connection(self._address)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                return sock
+            except ConnectionRefusedError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(CONNECT_BACKOFF)
+
+    def __receive(self, sock: socket.socket) -> str:
+        delimiter: bytes = COMMUNICATION_DELIMITER.encode("utf-8")
+
+        while delimiter not in self._buffer:
+            received: bytes = sock.recv(RECEIVE_SIZE)
+            if not received:
+                raise ConnectionError("connection closed by the server")
+            self._buffer += received
+
+        msg, self._buffer = self._buffer.split(delimiter, 1)
+        return msg.decode("utf-8")
+
+
+class InProcessServer:
+    """
+    Server running on a thread of the benchmark, with its storage in a
+    temporary directory. The peak RSS includes the load generator.
+    """
+
+    _server: object
+    _thread: threading.Thread
+    _storage: tempfile.TemporaryDirectory
+    port: int
+
+    def __init__(self, args: argparse.Namespace) -> None:
+        self.port = free_port()
+        self._storage = tempfile.TemporaryDirectory()
+        lottery = Lottery(
+            args.agencies,
+            storage_dirpath=self._storage.name,
+            results_timeout=RESULTS_TIMEOUT,
+            storage_writers=args.storage_writers,
+        )
+        self._server = SERVER_MODES[args.engine](self.port, LISTEN_BACKLOG, lottery)
+        self._thread = threading.Thread(target=self._server.run, daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> int:
+        self._server.stop(None, None)
+        self._thread.join()
+        self._storage.cleanup()
+
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class SubprocessServer:
+    """
+    Server started with main.py in a temporary working directory, so it
+    runs exactly as deployed and its peak RSS is measured alone.
+    """
+
+    _args: argparse.Namespace
+    _workdir: tempfile.TemporaryDirectory
+    _process: Optional[subprocess.Popen]
+    port: int
+
+    def __init__(self, args: argparse.Namespace) -> None:
+        self.port = free_port()
+        self._args = args
+        self._workdir = tempfile.TemporaryDirectory()
+        self._process = None
+
+    def start(self) -> None:
+        env = dict(
+            os.environ,
+            SERVER_PORT=str(self.port),
+            SERVER_LISTEN_BACKLOG=str(LISTEN_BACKLOG),
+            NUMBER_AGENCIES=str(self._args.agencies),
+            SERVER_MODE=self._args.engine,
+            SERVER_WORKERS=str(self._args.workers),
+            STORAGE_WRITERS=str(self._args.storage_writers),
+            RESULTS_TIMEOUT_MS=str(int(RESULTS_TIMEOUT * 1000)),
+            LOGGING_LEVEL="WARNING",
+        )
+        with open(os.path.join(SERVER_DIRPATH, "config.ini")) as src, open(
+            os.path.join(self._workdir.name, "config.ini"), "w"
+        ) as dst:
+            dst.write(src.read())
+
+        with open(os.path.join(self._workdir.name, "server.log"), "w") as log:
+            self._process = subprocess.Popen(
+                [
+                    sys.executable,
+                    os.path.join(SERVER_DIRPATH, "main.py"),
+                ],
+                cwd=self._workdir.name,
+                env=env,
+                stdout=log,
+                stderr=subprocess.STDOUT,
+            )
+
+    def stop(self) -> int:
+        self._process.terminate()
+        self._process.wait()
+        self._workdir.cleanup()
+
+        return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(sorted_values: list[float], quantile: float) -> float:
+    if not sorted_values:
+        return 0.0
+
+    index: int = min(len(sorted_values) - 1, int(quantile * len(sorted_values)))
+    return sorted_values[index]
+
+
+def run_benchmark(args: argparse.Namespace) -> dict:
+    batches: dict[int, list[str]] = {
+        agency_id: synthetic_batches(agency_id, args.bets, args.batch_size, args.seed)
+        for agency_id in range(1, args.agencies + 1)
+    }
+
+    server = SubprocessServer(args) if args.subprocess else InProcessServer(args)
+    start = threading.Barrier(args.agencies + 1)
+    agencies: list[SimulatedAgency] = [
+        SimulatedAgency(agency_id, agency_batches, ("127.0.0.1", server.port), start)
+        for agency_id, agency_batches in batches.items()
+    ]
+
+    server.start()
+    for agency in agencies:
+        agency.start()
+
+    try:
+        start.wait()
+    except threading.BrokenBarrierError:
+        pass
+    started: float = time.perf_counter()
+
+    for agency in agencies:
+        agency.join()
+
+    peak_rss: int = server.stop()
+
+    errors: list[str] = [
+        f"agency {agency.agency_id}: {agency.error}"
+        for agency in agencies
+        if agency.error is not None
+    ]
+    latencies: list[float] = sorted(
+        latency for agency in agencies for latency in agency.latencies
+    )
+    ingest_seconds: float = max(agency.last_ack for agency in agencies) - started
+    bets: int = args.agencies * args.bets
+
+    return {
+        "agencies": args.agencies,
+        "bets": bets,
+        "batch_size": args.batch_size,
+        "engine": args.engine,
+        "subprocess": args.subprocess,
+        "errors": errors,
+        "ingest_seconds": ingest_seconds,
+        "bets_per_second": bets / ingest_seconds if ingest_seconds > 0 else 0.0,
+        "ack_p50_ms": percentile(latencies, 0.50) * 1000,
+        "ack_p99_ms": percentile(latencies, 0.99) * 1000,
+        # From the last finish sent to the last winners received
+        "draw_ms": (
+            max(agency.results_received for agency in agencies)
+            - max(agency.finish_sent for agency in agencies)
+        )
+        * 1000,
+        "peak_rss_mb": peak_rss / 1024,
+    }
+
+
+def parse_args(argv: Optional[list[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--agencies", type=int, default=5)
+    parser.add_argument("--bets", type=int, default=10000, help="bets per agency")
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=7574)
+    parser.add_argument("--engine", choices=SERVER_MODES, default="threads")
+    parser.add_argument("--storage-writers", type=int, default=2)
+    parser.add_argument(
+        "--subprocess",
+        action="store_true",
+        help="run main.py in a child process instead of a server thread",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=1, help="server workers (subprocess only)"
+    )
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+
+    return parser.parse_args(argv)
+
+
+def main() -> None:
+    args = parse_args()
+    report: dict = run_benchmark(args)
+
+    if args.json:
+        print(json.dumps(report))
+    else:
+        print(
+            f"action: benchmark | result: "
+            f"{'fail' if report['errors'] else 'success'} | "
+            f"agencias: {report['agencies']} | apuestas: {report['bets']} | "
+            f"engine: {report['engine']} | "
+            f"bets_per_second: {report['bets_per_second']:.0f} | "
+            f"ack_p50_ms: {report['ack_p50_ms']:.3f} | "
+            f"ack_p99_ms: {report['ack_p99_ms']:.3f} | "
+            f"draw_ms: {report['draw_ms']:.1f} | "
+            f"peak_rss_mb: {report['peak_rss_mb']:.1f}"
+        )
+        for error in report["errors"]:
+            print(f"action: benchmark | result: fail | error: {error}")
+
+    if report["errors"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+import time
+import threading
+from typing import Optional
+
+from common.metrics import THROTTLED
+
+""" Seconds of traffic at its rate limits an agency may send at once, and
+the time a connection rejected by the connections limit waits before
+connecting again. """
+RATE_LIMIT_BURST = 1.0
+CONNECTION_RETRY_AFTER = 1.0
+
+
+class TokenBucket:
+    """
+    Tokens refilled at rate per second up to RATE_LIMIT_BURST seconds of
+    them. An amount bigger than the whole bucket is taken once the bucket
+    is full, leaving it in debt. Not thread-safe
+    """
+
+    rate: float
+    capacity: float
+    tokens: float
+    _updated: float
+
+    def __init__(self, rate: float, now: float) -> None:
+        self.rate = rate
+        self.capacity = rate * RATE_LIMIT_BURST
+        self.tokens = self.capacity
+        self._updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """
+        Return the seconds until the amount can be taken, zero if it can
+        be taken right away
+        """
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self._updated) * self.rate
+        )
+        self._updated = now
+
+        missing: float = min(amount, self.capacity) - self.tokens
+        return max(missing, 0) / self.rate
+
+    def take(self, amount: float) -> None:
+        self.tokens -= amount
+
+
+class AdmissionController:
+    """
+    Bounds the resources the agencies take from the server: the amount of
+    connections open at the same time and, for every agency, the rate of
+    bets and bytes of the batches it sends (token buckets). A limit of
+    zero is unlimited. Every method is thread-safe.
+    """
+
+    _max_connections: int
+    _bets_rate: float
+    _bytes_rate: float
+    _connections: int
+    _buckets: dict[int, list[Optional[TokenBucket]]]
+    _lock: threading.Lock
+
+    def __init__(
+        self,
+        max_connections: int = 0,
+        bets_rate: float = 0.0,
+        bytes_rate: float = 0.0,
+    ) -> None:
+        self._max_connections = max_connections
+        self._bets_rate = bets_rate
+        self._bytes_rate = bytes_rate
+        self._connections = 0
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def admit_connection(self) -> bool:
+        """
+        Count a new connection, unless the connections limit is reached.
+        Every admitted connection must be released once closed
+        """
+        with self._lock:
+            if 0 < self._max_connections <= self._connections:
+                THROTTLED.inc(1, "connection")
+                return False
+
+            self._connections += 1
+            return True
+
+    def release_connection(self) -> None:
+        with self._lock:
+            self._connections -= 1
+
+    def admit_batch(self, agency_id: int, n_bets: int, n_bytes: int) -> float:
+        """
+        Take the bets and bytes of a batch from the rate limits of the
+        agency. Return zero if the batch is admitted or the seconds the
+        agency must wait before sending it again otherwise
+        """
+        now: float = time.monotonic()
+
+        with self._lock:
+            buckets = self.__buckets(agency_id, now)
+            limits: list[tuple[TokenBucket, int]] = [
+                (bucket, amount)
+                for bucket, amount in zip(buckets, (n_bets, n_bytes))
+                if bucket is not None
+            ]
+
+            retry_after: float = max(
+                (bucket.wait_time(amount, now) for bucket, amount in limits),
+                default=0.0,
+            )
+            if retry_after > 0:
+                THROTTLED.inc(1, "batch")
+                return retry_after
+
+            for bucket, amount in limits:
+                bucket.take(amount)
+
+            return 0.0
+
+    def __buckets(self, agency_id: int, now: float) -> list[Optional[TokenBucket]]:
+        if agency_id not in self._buckets:
+            self._buckets[agency_id] = [
+                TokenBucket(rate, now) if rate > 0 else None
+                for rate in (self._bets_rate, self._bytes_rate)
+            ]
+
+        return self._buckets[agency_id]
@@ -0,0 +1,654 @@
+import time
+import queue
+import secrets
+import logging
+import threading
+from concurrent.futures import Future
+from typing import Optional, Protocol, Union
+
+from common.utils import BetBatch
+from common.lottery import Lottery
+from common.duplicates import batch_key
+from common.admission import AdmissionController
+from common.metrics import (
+    BATCH_DECODE_SECONDS,
+    BATCHES_RECEIVED,
+    BETS_RECEIVED,
+    STORE_SECONDS,
+)
+
+from common.communication.server_message import (
+    ServerHeader,
+    encode_ack_message,
+    encode_bulk_ack_message,
+    encode_message,
+    encode_nack_message,
+    encode_retry_after_message,
+    encode_winners_message,
+)
+from common.communication.agency_message import (
+    BATCH_SEPARATOR,
+    BET_SEPARATOR,
+    BINARY_PROTOCOL_OPTION,
+    BULK_BUFFER_SIZE,
+    BULK_FIELD_SEPARATOR,
+    BULK_RECORD_SEPARATOR,
+    COMPRESSION_OPTION,
+    KEEPALIVE_OPTION,
+    KEEPALIVE_SEPARATOR,
+    OPTION_SEPARATOR,
+    OPTION_VALUE_SEPARATOR,
+    RESUME_OPTION,
+    RESUME_SEPARATOR,
+    ROUND_OPTION,
+    AgencyHeader,
+    binary_bets_payload,
+    decode_bet_batch,
+    decode_binary_batch_header,
+    decode_binary_bet_batch,
+    decode_frame,
+    decode_identification_message,
+    decode_message,
+    decode_sequenced_bet_batch,
+)
+
+""" Identification options supported by the server. """
+SUPPORTED_OPTIONS = [
+    BINARY_PROTOCOL_OPTION,
+    RESUME_OPTION,
+    COMPRESSION_OPTION,
+    ROUND_OPTION,
+    KEEPALIVE_OPTION,
+]
+
+""" Time an agency connection may stay idle before it is evicted, and size
+of the tokens of the persistent sessions. """
+SESSION_IDLE_TIMEOUT = 60.0
+SESSION_TOKEN_BYTES = 16
+
+
+class Transport(Protocol):
+    """
+    Connection of a session, whose framing and compression follow the
+    protocol negotiated by the agency (see ClientSocket and StreamSocket)
+    """
+
+    def use_length_prefixed_frames(self, buffer_size: int = 0) -> None: ...
+
+    def use_compression(self) -> None: ...
+
+
+class SessionRegistry:
+    """
+    Persistent sessions of the server by token. An agency reconnecting with
+    the token of its session (e.g. after its connection dropped) takes the
+    session over: its previous connection is closed right away instead of
+    once it is evicted for being idle. Every method is thread-safe.
+    """
+
+    idle_timeout: float
+    _sessions: dict[str, "AgencySession"]
+    _lock: threading.Lock
+
+    def __init__(self, idle_timeout: float = SESSION_IDLE_TIMEOUT) -> None:
+        self.idle_timeout = idle_timeout
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def register(self, session: "AgencySession", token: str = "") -> str:
+        """
+        Register the session under the token it resumes, if that session is
+        still open for the same agency, or under a new token otherwise
+        """
+        with self._lock:
+            previous = self._sessions.get(token)
+
+            if previous is None or previous.agency_id != session.agency_id:
+                token = secrets.token_hex(SESSION_TOKEN_BYTES)
+            else:
+                previous.replaced = True
+
+            self._sessions[token] = session
+            return token
+
+    def unregister(self, token: str, session: "AgencySession") -> None:
+        with self._lock:
+            if self._sessions.get(token) is session:
+                del self._sessions[token]
+
+
+class AgencySession:
+    """
+    Protocol state of a single agency connection. It does not perform any
+    I/O, so it can be driven both by the threaded and the asyncio servers:
+    every batch of received messages is passed to handle_messages and the
+    returned replies must be sent back to the agency.
+
+    Sequenced bet batches (pipelined by the agency) are acknowledged
+    cumulatively: a single ack with the last processed sequence number is
+    replied for every batch of messages, and failed batches are reported
+    with a nack of their sequence number.
+
+    Agencies may request protocol options in the identification message
+    (e.g. agency:1;binary). In that case the server replies with the
+    accepted options and, if the binary protocol was accepted, every
+    following message is a length-prefixed frame. An agency reconnecting
+    after a failure can request resume, which is accepted with the last
+    sequence number and the amount of bets already persisted, so it only
+    sends the bets after them (unless the lottery is not resumable, see
+    ShardLottery). If compression is accepted, every byte
+    after the identification reply is compressed in both directions.
+
+    Sequenced batches already stored by the agency (e.g. retried after a
+    timeout with the same sequence number) are acknowledged as stored but
+    are neither decoded nor stored again.
+
+    An agency can upload all its bets with bulk_upload. Once accepted,
+    streaming is set and the connection switches to length-prefixed frames
+    with a bigger receive buffer: the agency streams chunks of records
+    without waiting for acks and bulk_end replies the counts of stored
+    and rejected bets once every chunk is persisted (or failure if some
+    chunk could not be persisted). The upload stops at the first rejected
+    chunk: it and every chunk after it are rejected, so the persisted bets
+    of the agency are always the first ones of its upload.
+
+    Batches are admitted by the rate limits of the agency. A throttled
+    batch is replied with retry_after and the agency must wait before
+    sending it again, followed by every batch it sent after it (go-back-N):
+    those are dropped without reply until the throttled one is received.
+    Bulk chunks are admitted by the same limits, but they are not replied
+    one by one: the session waits until a throttled chunk is admitted, so
+    the server stops reading from the agency meanwhile (backpressure).
+
+    Agencies that negotiate keepalive hold a persistent session: the
+    connection stays open after the results are replied, across rounds,
+    until the agency shuts it down. Every connection idle for longer than
+    the idle timeout of the registry is expired and must be closed by the
+    server (see expired), so idle agencies send heartbeats.
+
+    Results requested before the draw are parked instead of answered with
+    not_ready: pending_results holds the future of the winners, which the
+    server must wait for (up to the lottery results timeout) and then
+    reply with results_reply.
+    """
+
+    _lottery: Lottery
+    _admission: AdmissionController
+    _sessions: SessionRegistry
+    _last_activity: float
+    token: Optional[str]
+    replaced: bool
+    _pending_ack: Optional[int]
+    _throttled_sequence: Optional[int]
+    pending_results: Optional[Future]
+    agency_id: Optional[int]
+    options: list[str]
+    finished: bool
+    streaming: bool
+    _bulk_stored: int
+    _bulk_rejected: int
+
+    def __init__(
+        self,
+        lottery: Lottery,
+        admission: Optional[AdmissionController] = None,
+        sessions: Optional[SessionRegistry] = None,
+    ) -> None:
+        self._lottery = lottery
+        self._admission = admission if admission is not None else AdmissionController()
+        self._sessions = sessions if sessions is not None else SessionRegistry()
+        self._last_activity = time.monotonic()
+        self.token = None
+        self.replaced = False
+        self._pending_ack = None
+        self._throttled_sequence = None
+        self.pending_results = None
+        self.agency_id = None
+        self.options = []
+        self.finished = False
+        self.streaming = False
+        self._bulk_stored = 0
+        self._bulk_rejected = 0
+
+    @property
+    def binary(self) -> bool:
+        return BINARY_PROTOCOL_OPTION in self.options
+
+    @property
+    def compressed(self) -> bool:
+        return COMPRESSION_OPTION in self.options
+
+    @property
+    def persistent(self) -> bool:
+        return KEEPALIVE_OPTION in self.options
+
+    @property
+    def expired(self) -> bool:
+        """
+        Whether the session was taken over by a new connection of its agency
+        or its connection was idle for longer than the idle timeout. Parked
+        results requests are not idle
+        """
+        if self.replaced:
+            return True
+
+        return (
+            self.pending_results is None
+            and self._sessions.idle_timeout > 0
+            and time.monotonic() - self._last_activity > self._sessions.idle_timeout
+        )
+
+    @property
+    def results_timeout(self) -> float:
+        return self._lottery.results_timeout
+
+    def close(self) -> None:
+        """
+        Release the session once its connection is closed
+        """
+        if self.expired:
+            logging.info(
+                "action: expulsar_sesion | result: success | "
+                f"agencia: {self.agency_id} | "
+                f"motivo: {'reemplazada' if self.replaced else 'inactividad'}"
+            )
+
+        if self.token is not None:
+            self._sessions.unregister(self.token, self)
+
+    def results_reply(self) -> str:
+        """
+        Reply of the parked results request. If the draw was not done
+        before the timeout the request is dropped and not_ready is replied
+        """
+        future: Future = self.pending_results
+        self.pending_results = None
+        self._last_activity = time.monotonic()
+
+        if future.cancel():
+            return encode_message(ServerHeader.NOT_READY)
+
+        return encode_winners_message(future.result())
+
+    def update_transport(self, transport: "Transport") -> None:
+        """
+        Switch the connection to the protocol negotiated so far. Must be
+        called once the replies of the handled messages were sent: the
+        identification reply is the last uncompressed message and bulk
+        chunks are length-prefixed frames bigger than a batch
+        """
+        if self.binary:
+            transport.use_length_prefixed_frames()
+
+        if self.streaming:
+            transport.use_length_prefixed_frames(BULK_BUFFER_SIZE)
+
+        if self.compressed:
+            transport.use_compression()
+
+    def handle_messages(self, msgs: list[Union[str, bytes]]) -> list[str]:
+        """
+        Handle every message received at once and return their replies,
+        coalesced so they are sent together
+        """
+        replies: list[str] = []
+        self._last_activity = time.monotonic()
+
+        for msg in msgs:
+            reply: Optional[str] = self.handle_message(msg)
+
+            if reply is not None:
+                self.__flush_ack(replies)
+                replies.append(reply)
+
+            if self.finished:
+                break
+
+        self.__flush_ack(replies)
+
+        return replies
+
+    def handle_message(self, msg: Union[str, bytes]) -> Optional[str]:
+        if self.agency_id is None:
+            return self.__handle_identification(msg)
+
+        if isinstance(msg, bytes):
+            header, payload = decode_frame(msg)
+        else:
+            header, payload = decode_message(msg)
+
+        if header == AgencyHeader.BET_BATCH:
+            return self.__handle_bet_batch(payload)
+        elif header == AgencyHeader.SEQUENCED_BET_BATCH:
+            return self.__handle_sequenced_bet_batch(payload)
+        elif header == AgencyHeader.BINARY_BET_BATCH:
+            return self.__handle_binary_bet_batch(payload)
+        elif header == AgencyHeader.BULK_UPLOAD:
+            return self.__handle_bulk_upload()
+        elif header == AgencyHeader.BULK_CHUNK:
+            self.__handle_bulk_chunk(payload)
+        elif header == AgencyHeader.BULK_END:
+            return self.__handle_bulk_end()
+        elif header == AgencyHeader.FINISH_BETTING:
+            self.__handle_finish_betting()
+        elif header == AgencyHeader.REQUEST_RESULTS:
+            self.finished = not self.persistent
+            return self.__handle_request_result()
+        elif header == AgencyHeader.HEARTBEAT:
+            return encode_message(ServerHeader.SUCCESS)
+        elif header == AgencyHeader.SHUTDOWN:
+            self.finished = True
+
+        return None
+
+    def __handle_identification(self, msg: str) -> Optional[str]:
+        self.agency_id, requested_options = decode_identification_message(msg)
+
+        # Agencies that request no options keep the original protocol,
+        # where identification has no reply
+        if not requested_options:
+            return None
+
+        # Options may carry a value (e.g. keepalive=<token>)
+        accepted_options: list[str] = []
+        for requested_option in requested_options:
+            option, _, value = requested_option.partition(OPTION_VALUE_SEPARATOR)
+
+            if option == RESUME_OPTION and not self._lottery.resumable:
+                continue
+
+            if option in SUPPORTED_OPTIONS:
+                self.options.append(option)
+                accepted_options.append(self.__accept_option(option, value))
+
+        return encode_message(
+            ServerHeader.SUCCESS, OPTION_SEPARATOR.join(accepted_options)
+        )
+
+    def __accept_option(self, option: str, value: str) -> str:
+        if option == ROUND_OPTION:
+            return f"{ROUND_OPTION}{OPTION_VALUE_SEPARATOR}{self._lottery.round_id}"
+
+        if option == KEEPALIVE_OPTION:
+            self.token = self._sessions.register(self, value)
+            return (
+                f"{KEEPALIVE_OPTION}{OPTION_VALUE_SEPARATOR}{self.token}"
+                f"{KEEPALIVE_SEPARATOR}{int(self._sessions.idle_timeout * 1000)}"
+            )
+
+        if option != RESUME_OPTION:
+            return option
+
+        progress = self._lottery.resume_point(self.agency_id)
+
+        logging.info(
+            f"action: reanudar_agencia | result: success | agencia: {self.agency_id} | "
+            f"secuencia: {progress.last_sequence} | apuestas: {progress.bets}"
+        )
+
+        return (
+            f"{RESUME_OPTION}{OPTION_VALUE_SEPARATOR}{progress.last_sequence}"
+            f"{RESUME_SEPARATOR}{progress.bets}"
+        )
+
+    def __handle_bet_batch(self, payload: str) -> Optional[str]:
+        throttled, reply = self.__throttle(
+            0, payload.count(BATCH_SEPARATOR) + 1, len(payload)
+        )
+        if throttled:
+            return reply
+
+        if self.__store_bet_batch(payload) is not None:
+            return encode_message(ServerHeader.SUCCESS)
+
+        return encode_message(ServerHeader.FAILURE)
+
+    def __handle_sequenced_bet_batch(self, payload: str) -> Optional[str]:
+        sequence_number, bets_payload = decode_sequenced_bet_batch(payload)
+
+        throttled, reply = self.__throttle(
+            sequence_number, bets_payload.count(BATCH_SEPARATOR) + 1, len(payload)
+        )
+        if throttled:
+            return reply
+
+        if self.__store_bet_batch(bets_payload, sequence_number) is None:
+            return encode_nack_message(sequence_number)
+
+        self._pending_ack = sequence_number
+        return None
+
+    def __handle_binary_bet_batch(self, payload: memoryview) -> Optional[str]:
+        sequence_number, n_bets = decode_binary_batch_header(payload)
+
+        throttled, reply = self.__throttle(sequence_number, n_bets, len(payload))
+        if throttled:
+            return reply
+
+        key: int = batch_key(binary_bets_payload(payload), sequence_number)
+
+        if self._lottery.is_duplicate(self.agency_id, key):
+            self.__log_duplicate(n_bets)
+            self._pending_ack = sequence_number
+            return None
+
+        try:
+            with BATCH_DECODE_SECONDS.time():
+                bets: BetBatch = decode_binary_bet_batch(self.agency_id, payload)
+        except ValueError as _:
+            self.__log_failure(n_bets)
+            return encode_nack_message(sequence_number)
+
+        bets.sequence_number = sequence_number
+        if not self.__store_bets(bets, key):
+            return encode_nack_message(sequence_number)
+
+        self._pending_ack = sequence_number
+        return None
+
+    def __handle_bulk_upload(self) -> str:
+        self.streaming = True
+        self._bulk_stored = 0
+        self._bulk_rejected = 0
+
+        logging.info(
+            f"action: carga_masiva | result: in_progress | agencia: {self.agency_id}"
+        )
+
+        return encode_message(ServerHeader.SUCCESS)
+
+    def __handle_bulk_chunk(self, payload: str) -> None:
+        if not self.streaming:
+            raise ValueError("Bulk chunk received outside of a bulk upload")
+
+        checkpoint, records = decode_sequenced_bet_batch(payload)
+        n_bets: int = records.count(BULK_RECORD_SEPARATOR) + 1
+
+        # The agency resumes by skipping the amount of persisted bets, so
+        # they must be a prefix of its upload: once a chunk is rejected,
+        # every chunk after it is rejected too
+        if self._bulk_rejected:
+            self._bulk_rejected += n_bets
+            return
+
+        self.__wait_admission(checkpoint, n_bets, len(payload))
+
+        stored: Optional[int] = self.__store_bet_batch(
+            records, checkpoint, BULK_RECORD_SEPARATOR, BULK_FIELD_SEPARATOR
+        )
+        if stored is None:
+            self._bulk_rejected += n_bets
+        else:
+            self._bulk_stored += stored
+
+    def __handle_finish_betting(self) -> None:
+        try:
+            self._lottery.finish_betting(self.agency_id)
+        except OSError as e:
+            # The agency is not ready, so its results request fails
+            logging.error(
+                f"action: finalizar_apuestas | result: fail | "
+                f"agencia: {self.agency_id} | error: {e}"
+            )
+
+    def __handle_bulk_end(self) -> str:
+        try:
+            self._lottery.flush_bets(self.agency_id)
+        except OSError as e:
+            logging.error(
+                f"action: carga_masiva | result: fail | agencia: {self.agency_id} | "
+                f"error: {e}"
+            )
+            return encode_message(ServerHeader.FAILURE)
+
+        logging.info(
+            f"action: carga_masiva | result: success | agencia: {self.agency_id} | "
+            f"apuestas: {self._bulk_stored} | rechazadas: {self._bulk_rejected}"
+        )
+
+        return encode_bulk_ack_message(self._bulk_stored, self._bulk_rejected)
+
+    def __store_bet_batch(
+        self,
+        payload: str,
+        sequence_number: int = 0,
+        batch_separator: str = BATCH_SEPARATOR,
+        bet_separator: str = BET_SEPARATOR,
+    ) -> Optional[int]:
+        """
+        Return the amount of stored bets, zero if the batch was already
+        stored, or None if it failed
+        """
+        # Unsequenced batches can not be told apart from a batch with the
+        # same bets, so only sequenced batches are checked for retries
+        key: Optional[int] = (
+            batch_key(payload, sequence_number) if sequence_number else None
+        )
+
+        if key is not None and self._lottery.is_duplicate(self.agency_id, key):
+            self.__log_duplicate(payload.count(batch_separator) + 1)
+            return 0
+
+        try:
+            with BATCH_DECODE_SECONDS.time():
+                bets: BetBatch = decode_bet_batch(
+                    self.agency_id, payload, batch_separator, bet_separator
+                )
+            bets.sequence_number = sequence_number
+        except ValueError as _:
+            self.__log_failure(payload.count(batch_separator) + 1)
+            return None
+
+        return len(bets) if self.__store_bets(bets, key) else None
+
+    def __throttle(
+        self, sequence_number: int, n_bets: int, n_bytes: int
+    ) -> tuple[bool, Optional[str]]:
+        """
+        Apply the rate limits of the agency to a batch. Return whether it
+        must be dropped and, for the first throttled batch, its reply.
+        Unsequenced batches (sequence number zero) are sent one at a time,
+        so they are never dropped for a previous throttled batch
+        """
+        if self._throttled_sequence is not None:
+            if sequence_number != self._throttled_sequence:
+                return True, None
+
+            self._throttled_sequence = None
+
+        retry_after: float = self._admission.admit_batch(
+            self.agency_id, n_bets, n_bytes
+        )
+        if retry_after <= 0:
+            return False, None
+
+        if sequence_number:
+            self._throttled_sequence = sequence_number
+
+        logging.debug(
+            f"action: limitar_agencia | result: success | agencia: {self.agency_id} | "
+            f"secuencia: {sequence_number} | espera_ms: {retry_after * 1000:.0f}"
+        )
+
+        return True, encode_retry_after_message(sequence_number, retry_after)
+
+    def __wait_admission(self, sequence_number: int, n_bets: int, n_bytes: int) -> None:
+        """
+        Block until the rate limits of the agency admit the batch
+        """
+        retry_after: float = self._admission.admit_batch(
+            self.agency_id, n_bets, n_bytes
+        )
+
+        while retry_after > 0:
+            logging.debug(
+                f"action: limitar_agencia | result: success | "
+                f"agencia: {self.agency_id} | secuencia: {sequence_number} | "
+                f"espera_ms: {retry_after * 1000:.0f}"
+            )
+            time.sleep(retry_after)
+            retry_after = self._admission.admit_batch(self.agency_id, n_bets, n_bytes)
+
+    def __log_duplicate(self, n_bets: int) -> None:
+        BATCHES_RECEIVED.inc(1, "duplicate")
+        BETS_RECEIVED.inc(n_bets, "duplicate")
+
+        logging.debug(
+            f"action: apuesta_duplicada | result: success | cantidad: {n_bets}"
+        )
+
+    def __log_failure(self, n_bets: int, error: str = "") -> None:
+        BATCHES_RECEIVED.inc(1, "fail")
+        BETS_RECEIVED.inc(n_bets, "fail")
+
+        logging.error(
+            f"action: apuesta_recibida | result: fail | cantidad: {n_bets}"
+            + (f" | error: {error}" if error else "")
+        )
+
+    def __store_bets(self, bets: BetBatch, key: Optional[int] = None) -> bool:
+        if len(bets) == 0:
+            return False
+
+        try:
+            with STORE_SECONDS.time():
+                self._lottery.store_bets(bets, key)
+        except queue.Full:
+            self.__log_failure(len(bets), "ingestion queue full")
+            return False
+
+        BATCHES_RECEIVED.inc(1, "success")
+        BETS_RECEIVED.inc(len(bets), "success")
+
+        # Logged for every batch, so it is only enabled when debugging;
+        # the throughput is exposed by the metrics
+        logging.debug(
+            f"action: apuesta_recibida | result: success | cantidad: {len(bets)}"
+        )
+
+        return True
+
+    def __flush_ack(self, replies: list[str]) -> None:
+        if self._pending_ack is not None:
+            replies.append(encode_ack_message(self._pending_ack))
+            self._pending_ack = None
+
+    def __handle_request_result(self) -> Optional[str]:
+        if not self._lottery.has_finished(self.agency_id):
+            return encode_message(ServerHeader.FAILURE)
+
+        if self.results_timeout <= 0:
+            winners: Optional[list[str]] = self._lottery.winners(self.agency_id)
+
+            if winners is None:
+                return encode_message(ServerHeader.NOT_READY)
+
+            return encode_winners_message(winners)
+
+        future: Future = self._lottery.wait_winners(self.agency_id)
+
+        if future.done():
+            return encode_winners_message(future.result())
+
+        self.pending_results = future
+        return None
@@ -0,0 +1,257 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Union
+
+from common.lottery import Lottery
+from common.agency_session import (
+    SESSION_IDLE_TIMEOUT,
+    AgencySession,
+    SessionRegistry,
+)
+from common.admission import CONNECTION_RETRY_AFTER, AdmissionController
+from common.metrics import ACTIVE_CONNECTIONS
+
+from common.communication.client_socket import RECEIVE_BUFFER_SIZE
+from common.communication.server_message import encode_retry_after_message
+from common.communication.stream_socket import StreamSocket
+
+""" Time between checks for room in the lottery ingestion queue, and between
+checks for expired sessions. """
+INGESTION_BACKOFF = 0.01
+SESSION_CHECK_INTERVAL = 1.0
+""" Threads that hand the received messages to the lottery. """
+HANDLER_THREADS = 64
+
+
+class AsyncServer:
+    """
+    Server that handles every agency connection on a single asyncio event
+    loop instead of spawning a thread per connection. It speaks the same
+    protocol as Server. The buffer size bounds the memory used by each
+    connection. The received messages are handed to the lottery from a
+    pool of handler threads, since the lottery blocks while bets are
+    persisted (up to SYNC_TIMEOUT while syncing the bets of an agency).
+    The pool is dedicated to the server and sized by handler_threads, so
+    up to that many agencies can be blocked at once without delaying the
+    messages of the others.
+    """
+
+    _port: int
+    _listen_backlog: int
+    _reuse_port: bool
+    _buffer_size: int
+    _lottery: Lottery
+    _admission: AdmissionController
+    _sessions: SessionRegistry
+    _running: bool
+    _loop: Optional[asyncio.AbstractEventLoop]
+    _stop_event: Optional[asyncio.Event]
+    _connected_clients: set[asyncio.Task]
+    _open_sessions: dict[asyncio.Task, AgencySession]
+    _handlers: ThreadPoolExecutor
+
+    def __init__(
+        self,
+        port: int,
+        listen_backlog: int,
+        lottery: Lottery,
+        reuse_port: bool = False,
+        buffer_size: int = RECEIVE_BUFFER_SIZE,
+        max_connections: int = 0,
+        agency_bets_rate: float = 0.0,
+        agency_bytes_rate: float = 0.0,
+        session_idle_timeout: float = SESSION_IDLE_TIMEOUT,
+        handler_threads: int = HANDLER_THREADS,
+    ) -> None:
+        self._port = port
+        self._listen_backlog = listen_backlog
+        self._reuse_port = reuse_port
+        self._buffer_size = buffer_size
+        self._lottery = lottery
+        self._admission = AdmissionController(
+            max_connections, agency_bets_rate, agency_bytes_rate
+        )
+        self._sessions = SessionRegistry(session_idle_timeout)
+        self._running = True
+        self._loop = None
+        self._stop_event = None
+        self._connected_clients = set()
+        self._open_sessions = {}
+        self._handlers = ThreadPoolExecutor(
+            max_workers=handler_threads, thread_name_prefix="agency-handler"
+        )
+
+    def run(self) -> None:
+        asyncio.run(self.__serve())
+
+    async def __serve(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._stop_event = asyncio.Event()
+
+        try:
+            server = await asyncio.start_server(
+                self.__handle_client,
+                host="0.0.0.0",
+                port=self._port,
+                backlog=self._listen_backlog,
+                reuse_port=self._reuse_port,
+                limit=self._buffer_size,
+            )
+        except OSError as e:
+            logging.error(f"action: accept_connections | result: fail | error: {e}")
+            return
+
+        logging.info("action: accept_connections | result: in_progress")
+
+        evictor: asyncio.Task = asyncio.create_task(self.__evict_expired_sessions())
+
+        if self._running:
+            await self._stop_event.wait()
+
+        evictor.cancel()
+        server.close()
+        await self.__cleanup()
+        await server.wait_closed()
+
+    async def __handle_client(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        """
+        Handle the communication with an agency
+
+        This coroutine is scheduled on the event loop for every accepted
+        connection and runs until the agency finishes or the server stops
+        """
+        task: asyncio.Task = asyncio.current_task()
+        self._connected_clients.add(task)
+
+        client_socket = StreamSocket(reader, writer, self._buffer_size)
+
+        if not self._admission.admit_connection():
+            await self.__reject_client(reader, client_socket)
+            self._connected_clients.discard(task)
+            return
+
+        logging.info(
+            "action: accept_connections | result: success | "
+            f"ip: {client_socket.address[0]}"
+        )
+
+        session = AgencySession(self._lottery, self._admission, self._sessions)
+        self._open_sessions[task] = session
+        ACTIVE_CONNECTIONS.inc()
+
+        try:
+            while not session.finished:
+                msgs: list[Union[str, bytes]] = await self.__wait_for_messages(
+                    client_socket, session.agency_id
+                )
+                # Handling the messages may block on the lottery (syncing
+                # the bets of the agency at finish, resume or bulk_end, or
+                # waiting for room in its ingestion queue), so it runs on
+                # the handler threads instead of stalling the loop
+                replies: list[str] = await self._loop.run_in_executor(
+                    self._handlers, session.handle_messages, msgs
+                )
+
+                if replies:
+                    await client_socket.send_messages(replies)
+
+                if session.pending_results is not None:
+                    await self.__wait_for_results(session)
+                    await client_socket.send_message(session.results_reply())
+
+                session.update_transport(client_socket)
+
+        except asyncio.CancelledError:
+            pass
+        except ValueError as e:
+            logging.error(f"action: receive_message | result: fail | error: {e}")
+        except OSError as e:
+            logging.error(f"action: receive_message | result: fail | error: {e}")
+        finally:
+            ACTIVE_CONNECTIONS.dec()
+            client_socket.close()
+            session.close()
+            self._admission.release_connection()
+            self._open_sessions.pop(task, None)
+            self._connected_clients.discard(task)
+
+    async def __evict_expired_sessions(self) -> None:
+        """
+        Cancel the connections whose session expired. Reads are not bounded
+        by a timeout, so expired sessions are looked for periodically
+        instead of on every read
+        """
+        while True:
+            await asyncio.sleep(SESSION_CHECK_INTERVAL)
+
+            for task, session in list(self._open_sessions.items()):
+                if session.expired:
+                    task.cancel()
+
+    async def __reject_client(
+        self, reader: asyncio.StreamReader, client_socket: StreamSocket
+    ) -> None:
+        """
+        Reply retry_after to a connection over the connections limit, so the
+        agency knows when to connect again. The connection is closed once
+        the agency closes it (or the retry time expires), since closing it
+        with the identification unread would reset the connection
+        """
+        logging.debug(
+            f"action: accept_connections | result: fail | "
+            f"ip: {client_socket.address[0]} | error: connections limit"
+        )
+
+        try:
+            await client_socket.send_message(
+                encode_retry_after_message(0, CONNECTION_RETRY_AFTER)
+            )
+            client_socket.shutdown_write()
+            await asyncio.wait_for(reader.read(), CONNECTION_RETRY_AFTER)
+        except (OSError, asyncio.TimeoutError):
+            pass
+        finally:
+            client_socket.close()
+
+    async def __wait_for_messages(
+        self, client_socket: StreamSocket, agency_id: Optional[int]
+    ) -> list[Union[str, bytes]]:
+        # Queuing bets blocks while the ingestion queue of the agency is
+        # full, so the agency is not read until there is room
+        # (backpressure) instead of blocking the event loop
+        while agency_id is not None and not self._lottery.accepting_bets(agency_id):
+            await asyncio.sleep(INGESTION_BACKOFF)
+
+        return await client_socket.receive_messages()
+
+    async def __wait_for_results(self, session: AgencySession) -> None:
+        """
+        Park the connection until the winners are pushed by the draw or the
+        results timeout expires, without blocking the event loop
+        """
+        await asyncio.wait(
+            [asyncio.wrap_future(session.pending_results)],
+            timeout=session.results_timeout,
+        )
+
+    async def __cleanup(self) -> None:
+        for task in self._connected_clients:
+            task.cancel()
+
+        await asyncio.gather(*self._connected_clients, return_exceptions=True)
+
+        # Handlers still blocked on the lottery are waited for before it
+        # is closed
+        await self._loop.run_in_executor(None, self._handlers.shutdown)
+        self._lottery.close()
+
+    def stop(self, _signum: int, _frame: str) -> None:
+        # Called from the signal handler, so the loop must be woken up
+        # to notice the stop request
+        self._running = False
+
+        if self._loop is not None and self._stop_event is not None:
+            self._loop.call_soon_threadsafe(self._stop_event.set)
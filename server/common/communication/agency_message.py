@@ -1,22 +1,92 @@
+import struct
+import datetime
+import operator
+from array import array
 from enum import Enum
-from typing import Tuple
+from typing import Tuple, Union
 
-from common.utils import Bet
+from common.utils import BetBatch
+from common.storage import MAX_FIELD_SIZE, MAX_RECORD_ID
 
 HEARDER_SEPARATOR = ":"
 BATCH_SEPARATOR = "*"
 BET_SEPARATOR = "+"
+SEQUENCE_SEPARATOR = "#"
+OPTION_SEPARATOR = ";"
+OPTION_VALUE_SEPARATOR = "="
+""" Every bet has 5 fields: first name, last name, document, birthdate
+(YYYY-MM-DD) and number. """
+FIELDS_PER_BET = 5
+BET_SEPARATORS_PER_BET = FIELDS_PER_BET - 1
+
+""" Identification option that switches the agency to the binary protocol. """
+BINARY_PROTOCOL_OPTION = "binary"
+""" Identification option that compresses both directions of the connection
+with a raw deflate stream once the identification is replied. """
+COMPRESSION_OPTION = "zlib"
+""" Identification option that asks for the progress of the agency, accepted
+as resume=<last persisted sequence number>,<persisted bets>. """
+RESUME_OPTION = "resume"
+RESUME_SEPARATOR = ","
+""" Identification option that asks for the lottery round in which the bets
+of the agency are stored, accepted as round=<round id>. """
+ROUND_OPTION = "round"
+"""
+Identification option that keeps the connection open after the results
+are replied, until the agency shuts it down or it is idle for too long.
+Requested as keepalive (or keepalive=<token> to resume a session whose
+connection dropped) and accepted as keepalive=<token>,<idle timeout ms>.
+Idle agencies keep their session with heartbeat messages.
+"""
+KEEPALIVE_OPTION = "keepalive"
+KEEPALIVE_SEPARATOR = ","
+
+"""
+Bulk upload: once bulk_upload is accepted the connection switches to
+length-prefixed frames of up to BULK_BUFFER_SIZE and the agency streams
+its records without waiting for acks, as
+bulk_chunk:<checkpoint>#<record>\n<record>...
+where every record is a CSV line: first name,last name,document,
+birthdate,number. Every chunk is persisted as a batch whose sequence
+number is its checkpoint. bulk_end: ends the upload and is answered with
+the counts of stored and rejected bets.
+"""
+BULK_RECORD_SEPARATOR = "\n"
+BULK_FIELD_SEPARATOR = ","
+BULK_BUFFER_SIZE = 1024 * 1024
+
+"""
+Binary bet batch payload:
+| sequence number (u32) | bets count (u32) | bets |
+and every bet:
+| document (u64) | number (u32) | birthdate as YYYYMMDD (u32) |
+| first name size (u8) | first name | last name size (u8) | last name |
+"""
+BINARY_BATCH_HEADER = struct.Struct("<II")
+BINARY_SEQUENCE_NUMBER = struct.Struct("<I")
+BINARY_BET_FIELDS = struct.Struct("<QIIB")
+BINARY_NAME_SIZE = struct.Struct("<B")
 
 
 class AgencyHeader(Enum):
     IDENTIFICATION = "agency"
     BET_BATCH = "bet_batch"
+    SEQUENCED_BET_BATCH = "bet_batch_seq"
+    BINARY_BET_BATCH = "bet_batch_bin"
+    BULK_UPLOAD = "bulk_upload"
+    BULK_CHUNK = "bulk_chunk"
+    BULK_END = "bulk_end"
     FINISH_BETTING = "finish"
     REQUEST_RESULTS = "request_results"
     SHUTDOWN = "shutdown"
+    HEARTBEAT = "heartbeat"
 
 
-def decode_identification_message(msg: str) -> int:
+def decode_identification_message(msg: str) -> Tuple[int, list[str]]:
+    """
+    Decode the agency id and the protocol options requested by the agency
+    (e.g. agency:1;binary)
+    """
     if msg == "":
         raise ValueError("No identification message received")
 
@@ -25,10 +95,12 @@ def decode_identification_message(msg: str) -> int:
     if header != AgencyHeader.IDENTIFICATION:
         raise ValueError("Invalid identification message")
 
-    if not payload.isnumeric():
+    agency_id, *options = payload.split(OPTION_SEPARATOR)
+
+    if not agency_id.isnumeric() or int(agency_id) > MAX_RECORD_ID:
         raise ValueError("Invalid agency id")
 
-    return int(payload)
+    return int(agency_id), options
 
 
 def decode_message(msg: str) -> Tuple[AgencyHeader, str]:
@@ -37,28 +109,153 @@ def decode_message(msg: str) -> Tuple[AgencyHeader, str]:
     return AgencyHeader(header), payload
 
 
-def decode_bet_batch(agency_id: int, msg: str) -> list[Bet]:
+def decode_frame(frame: bytes) -> Tuple[AgencyHeader, Union[str, memoryview]]:
     """
-    Decode a message with multiple bets separated by DOCUMENT_SEPARATOR
-    and return a list of Bet objects.
+    Decode a length-prefixed frame of the binary protocol. The payload of
+    binary bet batches is returned as is, any other payload is text.
     """
-    return [__decode_bet(agency_id, bet) for bet in msg.split(BATCH_SEPARATOR)]
+    separator: int = frame.find(HEARDER_SEPARATOR.encode("utf-8"))
+    if separator == -1:
+        raise ValueError("Invalid frame")
 
+    header = AgencyHeader(frame[:separator].decode("utf-8"))
 
-def __decode_bet(agency_id: int, msg: str) -> Bet:
+    if header == AgencyHeader.BINARY_BET_BATCH:
+        return header, memoryview(frame)[separator + 1 :]
+
+    return header, frame[separator + 1 :].decode("utf-8")
+
+
+def decode_binary_batch_header(payload: memoryview) -> Tuple[int, int]:
     """
-    Decode a message with a single bet and return a Bet object.
+    Decode the sequence number and the amount of bets of a binary bet batch.
     """
+    try:
+        return BINARY_BATCH_HEADER.unpack_from(payload)
+    except struct.error:
+        raise ValueError("Truncated binary bet batch")
+
+
+def binary_bets_payload(payload: memoryview) -> memoryview:
+    """
+    Payload of a binary bet batch without its sequence number.
+    """
+    return payload[BINARY_SEQUENCE_NUMBER.size :]
+
+
+def decode_binary_bet_batch(agency_id: int, payload: memoryview) -> BetBatch:
+    """
+    Decode the bets of a binary bet batch.
+    """
+    try:
+        _, n_bets = BINARY_BATCH_HEADER.unpack_from(payload)
+        offset: int = BINARY_BATCH_HEADER.size
+        batch = BetBatch(agency_id)
+
+        for _ in range(n_bets):
+            document, number, birthdate, first_size = BINARY_BET_FIELDS.unpack_from(
+                payload, offset
+            )
+            offset += BINARY_BET_FIELDS.size
+            first_name: str = str(payload[offset : offset + first_size], "utf-8")
+            offset += first_size
+
+            (last_size,) = BINARY_NAME_SIZE.unpack_from(payload, offset)
+            offset += BINARY_NAME_SIZE.size
+            last_name: str = str(payload[offset : offset + last_size], "utf-8")
+            offset += last_size
+
+            batch.append_fields(
+                first_name,
+                last_name,
+                str(document),
+                __decode_packed_date(birthdate),
+                number,
+            )
+    except struct.error:
+        raise ValueError("Truncated binary bet batch")
+
+    if offset != len(payload):
+        raise ValueError("Invalid binary bet batch size")
 
-    fields: list[str] = msg.split(BET_SEPARATOR)
+    return batch
 
-    if len(fields) != 5:
+
+def __decode_packed_date(packed_date: int) -> int:
+    """
+    Return the ordinal of a date packed as YYYYMMDD.
+    """
+    return datetime.date(
+        packed_date // 10000, packed_date // 100 % 100, packed_date % 100
+    ).toordinal()
+
+
+def decode_bet_batch(
+    agency_id: int,
+    msg: str,
+    batch_separator: str = BATCH_SEPARATOR,
+    bet_separator: str = BET_SEPARATOR,
+) -> BetBatch:
+    """
+    Decode a message with multiple bets separated by batch_separator
+    and return them as a BetBatch. The payload is split once into columns
+    that are validated and parsed as a whole, the batch is rejected if
+    any bet is invalid.
+    """
+    # Iterating with map keeps the per bet work out of the interpreter loop
+    separators = map(
+        operator.methodcaller("count", bet_separator), msg.split(batch_separator)
+    )
+    if any(map(BET_SEPARATORS_PER_BET.__ne__, separators)):
         raise ValueError("Invalid number of fields")
 
-    if not fields[2].isnumeric():
+    fields: list[str] = msg.replace(batch_separator, bet_separator).split(bet_separator)
+    # A character takes up to 4 bytes in utf-8, so fields are only encoded
+    # to check their size if some of them is long
+    if max(map(len, fields)) > MAX_FIELD_SIZE // 4 and any(
+        len(field.encode("utf-8")) > MAX_FIELD_SIZE for field in fields
+    ):
+        raise ValueError("Field too long")
+
+    documents: list[str] = fields[2::FIELDS_PER_BET]
+    birthdates: list[str] = fields[3::FIELDS_PER_BET]
+    numbers: list[str] = fields[4::FIELDS_PER_BET]
+
+    if not all(map(str.isnumeric, documents)):
         raise ValueError("Invalid document")
 
-    if not fields[4].isnumeric():
+    if not all(map(str.isnumeric, numbers)):
         raise ValueError("Invalid number")
 
-    return Bet(agency_id, *fields)
+    batch = BetBatch(agency_id)
+    batch.extend_fields(
+        fields[0::FIELDS_PER_BET],
+        fields[1::FIELDS_PER_BET],
+        documents,
+        map(datetime.date.toordinal, map(datetime.date.fromisoformat, birthdates)),
+        map(int, numbers),
+    )
+
+    return batch
+
+
+def decode_bulk_records(agency_id: int, records: str) -> BetBatch:
+    """
+    Decode the CSV records of a bulk upload chunk.
+    """
+    return decode_bet_batch(
+        agency_id, records, BULK_RECORD_SEPARATOR, BULK_FIELD_SEPARATOR
+    )
+
+
+def decode_sequenced_bet_batch(msg: str) -> Tuple[int, str]:
+    """
+    Split a sequenced bet batch payload in its sequence number and the
+    bets payload.
+    """
+    sequence_number, bets = msg.split(SEQUENCE_SEPARATOR, 1)
+
+    if not sequence_number.isnumeric() or int(sequence_number) > MAX_RECORD_ID:
+        raise ValueError("Invalid sequence number")
+
+    return int(sequence_number), bets
@@ -1,49 +1,137 @@
 import socket
+from typing import Optional, Union
 
-CHUNK_SIZE = 1024
-SOCKET_TIMEOUT = 1.0
+from common.metrics import BYTES_RECEIVED, BYTES_SENT
+from common.communication.framer import DELIMITER_BYTES, MessageFramer
+from common.communication.compression import StreamCompression
 
-COMMUNICATION_DELIMITER = "\n"
+""" Default size of the receive buffer, bounds the size of a message. """
+RECEIVE_BUFFER_SIZE = 1024 * 64
+SOCKET_TIMEOUT = 1.0
+""" Max buffers given to a single sendmsg call (below IOV_MAX). """
+MAX_SEND_BUFFERS = 512
 
 
 class ClientSocket:
 
     _socket: socket.socket
-    _listen_overflow: str
+    _framer: MessageFramer
+    _compression: Optional[StreamCompression]
     address: tuple[str, int]
 
-    def __init__(self, socket: socket.socket, address: tuple[str, int]) -> None:
+    def __init__(
+        self,
+        socket: socket.socket,
+        address: tuple[str, int],
+        buffer_size: int = RECEIVE_BUFFER_SIZE,
+    ) -> None:
         socket.settimeout(SOCKET_TIMEOUT)
 
         self._socket = socket
-        self._listen_overflow = ""
+        self._framer = MessageFramer(buffer_size)
+        self._compression = None
         self.address = address
 
     def send_message(self, msg: str) -> None:
-        msg += COMMUNICATION_DELIMITER
-
-        msg_bytes: bytes = msg.encode("utf-8")
-        bytes_sent: int = 0
-
-        while bytes_sent < len(msg_bytes):
-            bytes_sent += self._socket.send(msg_bytes[bytes_sent:])
+        self.send_messages([msg])
+
+    def send_messages(self, msgs: list[str]) -> None:
+        """
+        Send every message, coalesced in as few sendmsg calls as possible.
+        Each message and its delimiter are gathered by the kernel, so they
+        are never concatenated nor copied on partial sends
+        """
+        buffers: list[memoryview] = []
+        for msg in msgs:
+            buffers.append(memoryview(msg.encode("utf-8")))
+            buffers.append(memoryview(DELIMITER_BYTES))
+
+        if self._compression is not None:
+            buffers = [memoryview(self._compression.compress(buffers))]
+
+        first: int = 0
+        while first < len(buffers):
+            bytes_sent: int = self._socket.sendmsg(
+                buffers[first : first + MAX_SEND_BUFFERS]
+            )
 
             if bytes_sent == 0:
                 raise ConnectionError("Socket connection broken")
 
-    def receive_message(self) -> str:
-        while COMMUNICATION_DELIMITER not in self._listen_overflow:
-            chunk: bytes = self._socket.recv(CHUNK_SIZE)
-            if not chunk:
-                raise BrokenPipeError("Socket connection broken")
-
-            self._listen_overflow += chunk.decode("utf-8")
-
-        message, self._listen_overflow = self._listen_overflow.split(
-            COMMUNICATION_DELIMITER, 1
-        )
-
-        return message
+            BYTES_SENT.inc(bytes_sent)
+
+            while first < len(buffers) and bytes_sent >= len(buffers[first]):
+                bytes_sent -= len(buffers[first])
+                first += 1
+
+            if bytes_sent > 0:
+                buffers[first] = buffers[first][bytes_sent:]
+
+    def use_length_prefixed_frames(self, buffer_size: int = 0) -> None:
+        """
+        Switch to length-prefixed frames, growing the receive buffer to
+        buffer_size if it is bigger
+        """
+        self._framer.length_prefixed = True
+        self._framer.grow(buffer_size)
+
+    def use_compression(self) -> None:
+        """
+        Compress every following message in both directions
+        """
+        if self._compression is None:
+            self._compression = StreamCompression()
+
+    def receive_message(self) -> Union[str, bytes]:
+        while not self._framer.messages:
+            self.__receive()
+
+        return self._framer.messages.popleft()
+
+    def receive_messages(self) -> list[Union[str, bytes]]:
+        """
+        Wait for at least one message and return every complete message
+        already received
+        """
+        while not self._framer.messages:
+            self.__receive()
+
+        return self._framer.pop_messages()
+
+    def __receive(self) -> None:
+        if self._compression is not None:
+            self.__receive_compressed()
+            return
+
+        received: int = self._socket.recv_into(self._framer.receive_buffer())
+        if received == 0:
+            raise BrokenPipeError("Socket connection broken")
+
+        BYTES_RECEIVED.inc(received)
+        self._framer.received(received)
+
+    def __receive_compressed(self) -> None:
+        data: bytes = self._socket.recv(RECEIVE_BUFFER_SIZE)
+        if not data:
+            raise BrokenPipeError("Socket connection broken")
+
+        BYTES_RECEIVED.inc(len(data))
+        self._compression.decompress_into(self._framer, data)
+
+    def shutdown_write(self) -> None:
+        """
+        Stop sending, so the agency reads the end of the connection after
+        the last message
+        """
+        self._socket.shutdown(socket.SHUT_WR)
 
     def close(self):
+        """
+        Close the connection, logging its compression stats if it was
+        compressed
+        """
+        if self._compression is not None:
+            self._compression.log_stats(self.address[0])
+            self._compression = None
+
         self._socket.close()
@@ -0,0 +1,95 @@
+import time
+import zlib
+import logging
+
+from common.communication.framer import MessageFramer
+
+""" Raw deflate streams (no zlib header nor checksum, TCP already checks
+the data), so the peer can start its decompressor before receiving. """
+COMPRESSION_WBITS = -zlib.MAX_WBITS
+COMPRESSION_LEVEL = zlib.Z_DEFAULT_COMPRESSION
+
+
+class StreamCompression:
+    """
+    Compression of both directions of a connection. A single compressor
+    and decompressor live for the whole connection, so the history of the
+    previous messages (repeated names, birthdates, documents) is used to
+    compress the next ones. Every send is sync flushed, so the peer can
+    decompress it right away.
+
+    The sizes before and after compression and the CPU time spent are
+    kept to log the compression ratio of the connection.
+    """
+
+    _compressor: "zlib._Compress"
+    _decompressor: "zlib._Decompress"
+    bytes_sent: int
+    compressed_bytes_sent: int
+    bytes_received: int
+    compressed_bytes_received: int
+    cpu_seconds: float
+
+    def __init__(self) -> None:
+        self._compressor = zlib.compressobj(
+            COMPRESSION_LEVEL, zlib.DEFLATED, COMPRESSION_WBITS
+        )
+        self._decompressor = zlib.decompressobj(COMPRESSION_WBITS)
+        self.bytes_sent = 0
+        self.compressed_bytes_sent = 0
+        self.bytes_received = 0
+        self.compressed_bytes_received = 0
+        self.cpu_seconds = 0.0
+
+    def compress(self, buffers: list[memoryview]) -> bytes:
+        start: float = time.thread_time()
+
+        chunks: list[bytes] = [self._compressor.compress(buffer) for buffer in buffers]
+        chunks.append(self._compressor.flush(zlib.Z_SYNC_FLUSH))
+        compressed: bytes = b"".join(chunks)
+
+        self.cpu_seconds += time.thread_time() - start
+        self.bytes_sent += sum(len(buffer) for buffer in buffers)
+        self.compressed_bytes_sent += len(compressed)
+
+        return compressed
+
+    def decompress_into(self, framer: MessageFramer, data: bytes) -> None:
+        """
+        Decompress received bytes straight into the framer. The output is
+        bounded by the free space of the framer buffer, so a small payload
+        can not expand beyond the size of a message
+        """
+        start: float = time.thread_time()
+        self.compressed_bytes_received += len(data)
+
+        while data:
+            free: memoryview = framer.receive_buffer()
+            decompressed: bytes = self._decompressor.decompress(data, len(free))
+            data = self._decompressor.unconsumed_tail
+
+            free[: len(decompressed)] = decompressed
+            framer.received(len(decompressed))
+            self.bytes_received += len(decompressed)
+
+        self.cpu_seconds += time.thread_time() - start
+
+    def log_stats(self, ip: str) -> None:
+        logging.info(
+            f"action: compresion | result: success | ip: {ip} | "
+            f"enviados: {self.bytes_sent} | "
+            f"enviados_comprimidos: {self.compressed_bytes_sent} | "
+            f"ratio_envio: {_ratio(self.bytes_sent, self.compressed_bytes_sent)} | "
+            f"recibidos: {self.bytes_received} | "
+            f"recibidos_comprimidos: {self.compressed_bytes_received} | "
+            f"ratio_recepcion: "
+            f"{_ratio(self.bytes_received, self.compressed_bytes_received)} | "
+            f"cpu_ms: {self.cpu_seconds * 1000:.1f}"
+        )
+
+
+def _ratio(size: int, compressed_size: int) -> str:
+    if compressed_size == 0:
+        return "-"
+
+    return f"{size / compressed_size:.2f}"
@@ -0,0 +1,131 @@
+import struct
+from collections import deque
+from typing import Union
+
+COMMUNICATION_DELIMITER = "\n"
+DELIMITER_BYTES = COMMUNICATION_DELIMITER.encode("utf-8")
+""" Size prefix of the frames of the binary protocol. """
+FRAME_SIZE = struct.Struct("<I")
+
+
+class MessageFramer:
+    """
+    Splits the received byte stream in delimited messages. Bytes are
+    received straight into a preallocated bytearray and the delimiter is
+    only searched in the bytes that were not scanned yet, so every byte
+    is copied once until it is decoded. The buffer size bounds the size
+    of a message.
+
+    Once the agency negotiates the binary protocol the framer switches to
+    length-prefixed frames, which are returned as bytes.
+    """
+
+    _buffer: bytearray
+    _view: memoryview
+    _start: int
+    _end: int
+    _scanned: int
+    length_prefixed: bool
+    messages: deque[Union[str, bytes]]
+
+    def __init__(self, buffer_size: int) -> None:
+        # Received bytes live in _buffer[_start:_end], and _buffer[_start:_scanned]
+        # is already known to contain no delimiter
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._end = 0
+        self._scanned = 0
+        self.length_prefixed = False
+        self.messages = deque()
+
+    def receive_buffer(self) -> memoryview:
+        """
+        Return the free space of the buffer where the next received bytes
+        must be written (e.g. with recv_into)
+        """
+        if self._end == len(self._buffer):
+            self.__make_room()
+
+        return self._view[self._end :]
+
+    def received(self, size: int) -> None:
+        """
+        Split every complete message among the bytes written in the
+        receive buffer
+        """
+        self._end += size
+
+        if self.length_prefixed:
+            self.__split_length_prefixed()
+        else:
+            self.__split_delimited()
+
+        if self._start == self._end:
+            self._start = self._end = 0
+
+        self._scanned = self._end
+
+    def __split_delimited(self) -> None:
+        delimiter: int = self._buffer.find(DELIMITER_BYTES, self._scanned, self._end)
+        while delimiter != -1:
+            self.messages.append(str(self._view[self._start : delimiter], "utf-8"))
+            self._start = delimiter + len(DELIMITER_BYTES)
+            delimiter = self._buffer.find(DELIMITER_BYTES, self._start, self._end)
+
+    def __split_length_prefixed(self) -> None:
+        while self._end - self._start >= FRAME_SIZE.size:
+            (size,) = FRAME_SIZE.unpack_from(self._buffer, self._start)
+            if FRAME_SIZE.size + size > len(self._buffer):
+                raise ValueError("Message exceeds the receive buffer size")
+
+            frame_start: int = self._start + FRAME_SIZE.size
+            if self._end - frame_start < size:
+                break
+
+            self.messages.append(self._view[frame_start : frame_start + size].tobytes())
+            self._start = frame_start + size
+
+    def feed(self, data: bytes) -> None:
+        """
+        Copy already received bytes in the buffer and split them
+        """
+        offset: int = 0
+
+        while offset < len(data):
+            free: memoryview = self.receive_buffer()
+            size: int = min(len(free), len(data) - offset)
+            free[:size] = data[offset : offset + size]
+            self.received(size)
+            offset += size
+
+    def pop_messages(self) -> list[Union[str, bytes]]:
+        messages: list[Union[str, bytes]] = list(self.messages)
+        self.messages.clear()
+
+        return messages
+
+    def grow(self, buffer_size: int) -> None:
+        """
+        Enlarge the buffer, so bigger messages fit in it. The received
+        bytes that were not split yet are kept
+        """
+        if buffer_size <= len(self._buffer):
+            return
+
+        pending: int = self._end - self._start
+        buffer = bytearray(buffer_size)
+        buffer[:pending] = self._view[self._start : self._end]
+
+        self._buffer = buffer
+        self._view = memoryview(self._buffer)
+        self._start, self._end, self._scanned = 0, pending, pending
+
+    def __make_room(self) -> None:
+        if self._start == 0:
+            raise ValueError("Message exceeds the receive buffer size")
+
+        # Move the partial message to the beginning of the buffer
+        pending: int = self._end - self._start
+        self._buffer[:pending] = self._view[self._start : self._end].tobytes()
+        self._start, self._end, self._scanned = 0, pending, pending
@@ -1,7 +1,9 @@
+import math
 from enum import Enum
 
 HEARDER_SEPARATOR = ":"
 DOCUMENT_SEPARATOR = ","
+COUNT_SEPARATOR = ","
 
 
 class ServerHeader(Enum):
@@ -9,11 +11,41 @@ class ServerHeader(Enum):
     NOT_READY = "not_ready"
     SUCCESS = "success"
     FAILURE = "failure"
+    ACK = "ack"
+    NACK = "nack"
+    BULK_ACK = "bulk_ack"
+    RETRY_AFTER = "retry_after"
 
 
 def encode_winners_message(winners: list[str]) -> str:
     return encode_message(ServerHeader.WINNERS, DOCUMENT_SEPARATOR.join(winners))
 
 
+def encode_ack_message(sequence_number: int) -> str:
+    return encode_message(ServerHeader.ACK, str(sequence_number))
+
+
+def encode_nack_message(sequence_number: int) -> str:
+    return encode_message(ServerHeader.NACK, str(sequence_number))
+
+
+def encode_bulk_ack_message(stored_bets: int, rejected_bets: int) -> str:
+    return encode_message(
+        ServerHeader.BULK_ACK, f"{stored_bets}{COUNT_SEPARATOR}{rejected_bets}"
+    )
+
+
+def encode_retry_after_message(sequence_number: int, retry_after: float) -> str:
+    """
+    Reply of a throttled batch (or of a rejected connection, with sequence
+    number zero): the agency must wait the given time, in milliseconds,
+    before sending it again
+    """
+    return encode_message(
+        ServerHeader.RETRY_AFTER,
+        f"{sequence_number}{COUNT_SEPARATOR}{math.ceil(retry_after * 1000)}",
+    )
+
+
 def encode_message(header: ServerHeader, payload: str = "") -> str:
     return f"{header.value}{HEARDER_SEPARATOR}{payload}"
@@ -2,20 +2,34 @@ import logging
 import socket
 from typing import Tuple
 
-from common.communication.client_socket import ClientSocket
+from common.communication.client_socket import RECEIVE_BUFFER_SIZE, ClientSocket
 
 BLOCKING_TIMEOUT = 1.0
 
 
 class ServerSocket:
     _socket: socket.socket
+    _buffer_size: int
     address: Tuple[str, int]
 
-    def __init__(self, address: Tuple[str, int], listen_backlog: int) -> None:
+    def __init__(
+        self,
+        address: Tuple[str, int],
+        listen_backlog: int,
+        reuse_port: bool = False,
+        buffer_size: int = RECEIVE_BUFFER_SIZE,
+    ) -> None:
         self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # A restarted server must be able to bind again while connections
+        # of the previous one are still in TIME_WAIT
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            # Lets several worker processes accept on the same port
+            self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self._socket.bind(address)
         self._socket.listen(listen_backlog)
         self._socket.settimeout(BLOCKING_TIMEOUT)
+        self._buffer_size = buffer_size
         self.address = address
 
     def accept(self) -> ClientSocket:
@@ -23,7 +37,7 @@ class ServerSocket:
 
         logging.info(f"action: accept_connections | result: success | ip: {addr[0]}")
 
-        return ClientSocket(c, addr)
+        return ClientSocket(c, addr, self._buffer_size)
 
     def close(self) -> None:
         self._socket.close()
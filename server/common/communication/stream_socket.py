@@ -0,0 +1,103 @@
+import asyncio
+from typing import Optional, Union
+
+from common.metrics import BYTES_RECEIVED, BYTES_SENT
+from common.communication.framer import COMMUNICATION_DELIMITER, MessageFramer
+from common.communication.compression import StreamCompression
+
+
+class StreamSocket:
+    """
+    Counterpart of ClientSocket for the connections of the asyncio server:
+    the same framing and compression over an asyncio stream. The buffer
+    size bounds the bytes read at once and the size of a message.
+    """
+
+    _reader: asyncio.StreamReader
+    _writer: asyncio.StreamWriter
+    _buffer_size: int
+    _framer: MessageFramer
+    _compression: Optional[StreamCompression]
+    address: tuple[str, int]
+
+    def __init__(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        buffer_size: int,
+    ) -> None:
+        self._reader = reader
+        self._writer = writer
+        self._buffer_size = buffer_size
+        self._framer = MessageFramer(buffer_size)
+        self._compression = None
+        self.address = writer.get_extra_info("peername")
+
+    async def send_message(self, msg: str) -> None:
+        await self.send_messages([msg])
+
+    async def send_messages(self, msgs: list[str]) -> None:
+        """
+        Send every message in a single write
+        """
+        data: bytes = "".join(msg + COMMUNICATION_DELIMITER for msg in msgs).encode(
+            "utf-8"
+        )
+        if self._compression is not None:
+            data = self._compression.compress([memoryview(data)])
+
+        self._writer.write(data)
+        BYTES_SENT.inc(len(data))
+        await self._writer.drain()
+
+    def use_length_prefixed_frames(self, buffer_size: int = 0) -> None:
+        """
+        Switch to length-prefixed frames, growing the receive buffer to
+        buffer_size if it is bigger
+        """
+        self._framer.length_prefixed = True
+        self._framer.grow(buffer_size)
+
+    def use_compression(self) -> None:
+        """
+        Compress every following message in both directions
+        """
+        if self._compression is None:
+            self._compression = StreamCompression()
+
+    async def receive_messages(self) -> list[Union[str, bytes]]:
+        """
+        Wait for at least one message and return every complete message
+        already received
+        """
+        while not self._framer.messages:
+            data: bytes = await self._reader.read(self._buffer_size)
+            if not data:
+                raise BrokenPipeError("Socket connection broken")
+
+            BYTES_RECEIVED.inc(len(data))
+
+            if self._compression is not None:
+                self._compression.decompress_into(self._framer, data)
+            else:
+                self._framer.feed(data)
+
+        return self._framer.pop_messages()
+
+    def shutdown_write(self) -> None:
+        """
+        Stop sending, so the agency reads the end of the connection after
+        the last message
+        """
+        self._writer.write_eof()
+
+    def close(self) -> None:
+        """
+        Close the connection, logging its compression stats if it was
+        compressed
+        """
+        if self._compression is not None:
+            self._compression.log_stats(self.address[0])
+            self._compression = None
+
+        self._writer.close()
@@ -0,0 +1,77 @@
+import hashlib
+import threading
+from collections import deque
+from typing import Union
+
+""" Amount of batches remembered for each agency. """
+DUPLICATES_WINDOW = 16384
+
+
+def batch_key(payload: Union[str, bytes, memoryview], sequence_number: int) -> int:
+    """
+    64 bits digest of the sequence number and the bets of a sequenced
+    batch. A retried batch is sent again with the same sequence number
+    and bets, so it has the same key, while a batch that only carries the
+    same bets as a previous one of the agency is a different batch
+    """
+    if isinstance(payload, str):
+        payload = payload.encode("utf-8")
+
+    digest = hashlib.blake2b(digest_size=8)
+    digest.update(sequence_number.to_bytes(8, "little"))
+    digest.update(payload)
+
+    return int.from_bytes(digest.digest(), "little")
+
+
+class DuplicatesIndex:
+    """
+    Keys of the last batches stored by each agency, so retried batches
+    are detected in O(1) without decoding nor storing them again. Memory
+    is bounded: only the last `window` keys of each agency are kept and
+    the oldest ones are forgotten first. Thread-safe.
+    """
+
+    _window: int
+    _keys: dict[int, set[int]]
+    _order: dict[int, deque]
+    _lock: threading.Lock
+
+    def __init__(self, window: int = DUPLICATES_WINDOW) -> None:
+        self._window = window
+        self._keys = {}
+        self._order = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, agency_key: tuple[int, int]) -> bool:
+        agency, key = agency_key
+
+        with self._lock:
+            return key in self._keys.get(agency, ())
+
+    def add(self, agency: int, key: int) -> None:
+        if self._window <= 0:
+            return
+
+        with self._lock:
+            keys: set[int] = self._keys.setdefault(agency, set())
+            if key in keys:
+                return
+
+            order: deque = self._order.setdefault(agency, deque())
+            if len(order) >= self._window:
+                keys.discard(order.popleft())
+
+            keys.add(key)
+            order.append(key)
+
+    def discard(self, agency: int, key: int) -> None:
+        """
+        Forget the key of a batch that could not be stored, so its retry
+        is stored instead of being taken as a duplicate
+        """
+        with self._lock:
+            keys: set[int] = self._keys.get(agency, set())
+            if key in keys:
+                keys.discard(key)
+                self._order[agency].remove(key)
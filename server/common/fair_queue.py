@@ -0,0 +1,108 @@
+import queue
+import itertools
+import threading
+from collections import deque
+from typing import Any, Optional
+
+
+class FairQueue:
+    """
+    Bounded queue shared by the agencies that hands out their items in
+    round robin, so an agency that floods it only delays (and blocks) its
+    own items. Items of an agency keep their order and every agency may
+    hold up to maxsize of them.
+
+    Items put without agency (control items) are handed out once every
+    item queued before them was. It implements the subset of the
+    queue.Queue interface used by the lottery writers.
+    """
+
+    _maxsize: int
+    _queues: dict[int, deque]
+    _turns: deque
+    _control: deque
+    _tickets: itertools.count
+    _lock: threading.Lock
+    _not_empty: threading.Condition
+    _not_full: threading.Condition
+
+    def __init__(self, maxsize: int) -> None:
+        self._maxsize = maxsize
+        self._queues = {}
+        self._turns = deque()
+        self._control = deque()
+        self._tickets = itertools.count()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+
+    def full(self, agency: int) -> bool:
+        with self._lock:
+            return self.__full(agency)
+
+    def put(
+        self, item: Any, agency: Optional[int] = None, timeout: Optional[float] = None
+    ) -> None:
+        """
+        Queue an item of the agency, or a control item if no agency is
+        given. Raises queue.Full if the agency has no room after timeout
+        """
+        with self._not_full:
+            if agency is None:
+                self._control.append((next(self._tickets), item))
+            else:
+                if not self._not_full.wait_for(
+                    lambda: not self.__full(agency), timeout
+                ):
+                    raise queue.Full
+
+                if agency not in self._queues:
+                    self._queues[agency] = deque()
+                    self._turns.append(agency)
+                self._queues[agency].append((next(self._tickets), item))
+
+            self._not_empty.notify()
+
+    def get(self, timeout: Optional[float] = None) -> Any:
+        """
+        Wait for the next item. Raises queue.Empty if there is none after
+        timeout
+        """
+        with self._not_empty:
+            if not self._not_empty.wait_for(
+                lambda: self._turns or self._control, timeout
+            ):
+                raise queue.Empty
+
+            return self.__pop()
+
+    def get_nowait(self) -> Any:
+        with self._lock:
+            if not self._turns and not self._control:
+                raise queue.Empty
+
+            return self.__pop()
+
+    def __full(self, agency: int) -> bool:
+        return len(self._queues.get(agency, ())) >= self._maxsize
+
+    def __pop(self) -> Any:
+        if self._control and (
+            not self._turns
+            or self._control[0][0]
+            < min(pending[0][0] for pending in self._queues.values())
+        ):
+            return self._control.popleft()[1]
+
+        agency: int = self._turns.popleft()
+        pending: deque = self._queues[agency]
+        _, item = pending.popleft()
+
+        if pending:
+            self._turns.append(agency)
+        else:
+            del self._queues[agency]
+
+        self._not_full.notify_all()
+
+        return item
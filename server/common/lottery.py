@@ -0,0 +1,975 @@
+import time
+import queue
+import logging
+import threading
+from contextlib import ExitStack
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from typing import Any, Optional
+
+from common.utils import (
+    STORAGE_DIRPATH,
+    LOTTERY_WINNER_NUMBER,
+    BetBatch,
+    winning_documents,
+)
+from common.fair_queue import FairQueue
+from common.duplicates import DUPLICATES_WINDOW, DuplicatesIndex
+from common.metrics import (
+    DRAW_SECONDS,
+    LOCK_WAIT_SECONDS,
+    STORAGE_WRITE_SECONDS,
+    InstrumentedLock,
+)
+from common.storage import (
+    WAL_BATCH,
+    WAL_FINISH,
+    AgencyProgress,
+    BetLog,
+    FsyncPolicy,
+    PartitionedBetLog,
+    archive_filepath,
+    archive_round,
+    archived_round_ids,
+    encode_wal_entry,
+    file_sizes,
+    load_snapshot,
+    partition_filepaths,
+    query_logs_winners,
+    query_winners,
+    recover_storage,
+    round_dirpath,
+    round_ids,
+    wal_filepath,
+    write_snapshot,
+)
+
+""" Bound of the batches of each agency waiting to be persisted by a writer
+and the time an agency waits for room in the queue before its batch is
+rejected. """
+INGESTION_QUEUE_SIZE = 1024
+INGESTION_TIMEOUT = 5.0
+""" Maximum number of queued batches persisted with a single write. """
+INGESTION_GROUP_SIZE = 64
+""" Time an agency waits for its queued batches to be persisted and synced
+before the sync fails. """
+SYNC_TIMEOUT = 30.0
+
+
+class Lottery:
+    """
+    State of a lottery contest shared by every agency connection:
+    bets persistence, agencies that finished betting and the winners
+    of the draw. Every method is thread-safe.
+
+    Bets are not persisted by the connection handlers: store_bets pushes
+    the batch onto a bounded ingestion queue drained by a dedicated writer
+    thread, which groups the queued batches in a single disk write. Bets
+    are partitioned by agency and every agency is assigned to one of the
+    storage writers, so writers of different agencies run in parallel
+    and finishing an agency only syncs its own partition. The
+    lock only guards the in-memory coordination state (readiness, winners
+    index and results waiters), so disk writes never block the agencies
+    that are finishing or requesting results. A full queue blocks the
+    agency (backpressure) and rejects its batch after INGESTION_TIMEOUT.
+    Batches are acknowledged once queued, so a batch that can not be
+    persisted fails the next sync of its agency (finish, resume or
+    flush), which raises OSError.
+    Ingestion queues are fair (see FairQueue): writers take the batches of
+    their agencies in round robin and every agency has its own bound, so
+    an agency flooding the server does not block the others.
+
+    Every write of a partition and every finish is recorded in the
+    write-ahead log of the storage. On startup the storage is recovered
+    from it: torn batches are dropped, the agencies that finished betting
+    are ready again (drawing the winners if all of them were) and agencies
+    can resume sending bets from their last persisted batch. With
+    startup_snapshot, the recovered state is snapshotted on close and
+    loaded on the next start instead (see write_snapshot), as long as the
+    storage did not change in between.
+
+    Stored sequenced batches are remembered by their key (see batch_key)
+    in a bounded duplicates index, so batches retried by the agencies are
+    acknowledged without being stored twice.
+
+    Agencies that request their results before the draw are parked as
+    waiters: wait_winners returns a future that is completed with the
+    winners of the agency as soon as the draw is done.
+
+    The lottery is played in rounds. Every round is stored in its own
+    directory (see round_dirpath) and, as soon as it is drawn, the next
+    round starts with a clean state while the drawn round is archived in
+    the background, so agencies can keep betting without a restart. The
+    results of an agency are the winners of the current round once it
+    finished betting in it, or of the last drawn round otherwise.
+    """
+
+    _number_agencies: int
+    _storage_dirpath: str
+    _fsync_policy: FsyncPolicy
+    _fsync_interval: float
+    _draw_workers: int
+    _duplicates_window: int
+    _startup_snapshot: bool
+    _round_id: int
+    _drawn_round: Optional[int]
+    _bet_log: PartitionedBetLog
+    _wal: BetLog
+    _wal_lock: threading.Lock
+    _winners_load_lock: threading.Lock
+    _progress: dict[int, AgencyProgress]
+    _duplicates: DuplicatesIndex
+    _agencies_ready: set[int]
+    _winners_by_agency: Optional[dict[int, list[str]]]
+    _winners_index: dict[int, list[str]]
+    _results_waiters: list[tuple[int, Future]]
+    _ingestion_queues: list[FairQueue]
+    _writers: list[threading.Thread]
+    _writing_locks: list[threading.Lock]
+    _archivers: list[threading.Thread]
+    _lock: InstrumentedLock
+    results_timeout: float
+    resumable: bool
+
+    def __init__(
+        self,
+        number_agencies: int,
+        storage_dirpath: str = STORAGE_DIRPATH,
+        fsync_policy: FsyncPolicy = FsyncPolicy.BATCH,
+        fsync_interval: float = 0.0,
+        results_timeout: float = 0.0,
+        ingestion_queue_size: int = INGESTION_QUEUE_SIZE,
+        draw_workers: int = 1,
+        storage_writers: int = 1,
+        duplicates_window: int = DUPLICATES_WINDOW,
+        startup_snapshot: bool = False,
+    ) -> None:
+        self._number_agencies = number_agencies
+        self._storage_dirpath = storage_dirpath
+        self._fsync_policy = fsync_policy
+        self._fsync_interval = fsync_interval
+        self._draw_workers = draw_workers
+        self._duplicates_window = duplicates_window
+        self._startup_snapshot = startup_snapshot
+        self._winners_by_agency = None
+        self._winners_index = {}
+        self._results_waiters = []
+        self._archivers = []
+        self._lock = InstrumentedLock(LOCK_WAIT_SECONDS)
+        self._wal_lock = threading.Lock()
+        self._winners_load_lock = threading.Lock()
+        self._duplicates = DuplicatesIndex(duplicates_window)
+        self.results_timeout = results_timeout
+        self.resumable = True
+
+        self.__recover_rounds()
+        if not self.__restore_snapshot():
+            self.__recover_storage()
+            self.__rebuild_winners_index()
+        self.__open_round()
+
+        self._ingestion_queues = [
+            FairQueue(ingestion_queue_size) for _ in range(storage_writers)
+        ]
+        self._writing_locks = [threading.Lock() for _ in self._ingestion_queues]
+        self._writers = [
+            threading.Thread(target=self.__write_bets, args=(q, lock), daemon=True)
+            for q, lock in zip(self._ingestion_queues, self._writing_locks)
+        ]
+        for writer in self._writers:
+            writer.start()
+
+        self._resume_round()
+
+    @property
+    def round_id(self) -> int:
+        """
+        Round in which the bets are currently stored
+        """
+        return self._round_id
+
+    def accepting_bets(self, agency_id: int) -> bool:
+        """
+        Whether a batch of the agency can be queued without blocking
+        """
+        return not self.__ingestion_queue(agency_id).full(agency_id)
+
+    def is_duplicate(self, agency_id: int, batch_key: int) -> bool:
+        """
+        Whether a batch with the same key was already stored by the agency
+        """
+        return (agency_id, batch_key) in self._duplicates
+
+    def store_bets(self, bets: BetBatch, batch_key: Optional[int] = None) -> None:
+        """
+        Queue the batch to be persisted and remember its key, if given.
+        The key is forgotten if the batch can not be persisted. Raises
+        queue.Full if there is no room in the ingestion queue after
+        INGESTION_TIMEOUT
+        """
+        bets.batch_key = batch_key
+
+        # Remembered before the batch is queued, so a writer that fails it
+        # right away always finds its key to forget
+        if batch_key is not None:
+            with self._lock:
+                duplicates: DuplicatesIndex = self._duplicates
+            duplicates.add(bets.agency, batch_key)
+
+        try:
+            self.__ingestion_queue(bets.agency).put(
+                bets, bets.agency, timeout=INGESTION_TIMEOUT
+            )
+        except queue.Full:
+            if batch_key is not None:
+                duplicates.discard(bets.agency, batch_key)
+            raise
+
+    def finish_betting(self, agency_id: int) -> None:
+        """
+        Mark the agency as ready once its bets are synced and draw the
+        winners if it was the last one. Finishing again is a no-op
+        """
+        with self._lock:
+            if agency_id in self._agencies_ready:
+                return
+
+        self._sync_bets(agency_id, finish=True)
+
+        with self.__writes_paused(), self._lock:
+            if agency_id in self._agencies_ready:
+                return
+
+            self._agencies_ready.add(agency_id)
+
+            if len(self._agencies_ready) < self._number_agencies:
+                return
+
+            draw = self.__close_round(self.__draw_winners())
+
+        self.__announce_draw(*draw)
+
+    def has_finished(self, agency_id: int) -> bool:
+        """
+        Whether the agency finished betting in the current round or there
+        is a drawn round to query its results from
+        """
+        with self._lock:
+            return agency_id in self._agencies_ready or self._drawn_round is not None
+
+    def winners(self, agency_id: int) -> Optional[list[str]]:
+        """
+        Return the winners of the agency in the last round it finished or
+        None if that round has not been drawn yet
+        """
+        self.__load_drawn_winners()
+
+        with self._lock:
+            if agency_id in self._agencies_ready:
+                return None
+
+            winners_by_agency = self._winners_by_agency
+
+        if winners_by_agency is None:
+            return None
+
+        return winners_by_agency.get(agency_id, [])
+
+    def resume_point(self, agency_id: int) -> AgencyProgress:
+        """
+        Return the progress of the agency once every batch it already
+        sent is persisted, so it can resume sending its next bets. Only
+        meaningful if the lottery is resumable
+        """
+        self._sync_bets(agency_id)
+
+        with self._lock:
+            return self._progress.setdefault(agency_id, AgencyProgress())
+
+    def flush_bets(self, agency_id: int) -> None:
+        """
+        Wait until every batch the agency already sent is persisted
+        """
+        self._sync_bets(agency_id)
+
+    def wait_winners(self, agency_id: int) -> Future:
+        """
+        Return a future completed with the winners of the agency once the
+        draw is done. Waiters that are no longer interested must cancel
+        the future so they are dropped
+        """
+        future: Future = Future()
+        self.__load_drawn_winners()
+
+        with self._lock:
+            winners_by_agency = None
+            if agency_id not in self._agencies_ready:
+                winners_by_agency = self._winners_by_agency
+
+            if winners_by_agency is not None:
+                future.set_result(winners_by_agency.get(agency_id, []))
+                return future
+
+            self._results_waiters = [
+                waiter for waiter in self._results_waiters if not waiter[1].cancelled()
+            ]
+            self._results_waiters.append((agency_id, future))
+
+        return future
+
+    def close(self) -> None:
+        # Archivers wait for the writers to persist the batches of their
+        # round, so they are joined before stopping the writers
+        for archiver in list(self._archivers):
+            archiver.join()
+
+        for ingestion_queue, writer in zip(self._ingestion_queues, self._writers):
+            if writer.is_alive():
+                ingestion_queue.put(None)
+                writer.join()
+
+        with self._lock:
+            self._bet_log.close()
+            self._wal.close()
+            waiters, self._results_waiters = self._results_waiters, []
+
+            if self._startup_snapshot:
+                self.__take_snapshot()
+
+        for _, future in waiters:
+            future.cancel()
+
+    def _sync_bets(self, agency_id: int, finish: bool = False) -> None:
+        """
+        Wait until every batch of the agency queued so far is persisted
+        and synced. If the agency finished betting, its finish is recorded
+        in the write-ahead log. Raises OSError if any of those batches
+        could not be persisted
+        """
+        synced: Future = Future()
+        self.__ingestion_queue(agency_id).put((agency_id, finish, synced), agency_id)
+
+        try:
+            synced.result(SYNC_TIMEOUT)
+        except FutureTimeoutError:
+            raise TimeoutError(
+                f"Bets of agency {agency_id} were not synced after {SYNC_TIMEOUT}s"
+            )
+
+    def _resume_round(self) -> None:
+        """
+        Draw the winners if every agency had finished betting before the
+        server was restarted
+        """
+        with self.__writes_paused(), self._lock:
+            if len(self._agencies_ready) < self._number_agencies:
+                return
+
+            draw = self.__close_round(self.__draw_winners())
+
+        self.__announce_draw(*draw)
+
+    def _collect_winners(self) -> dict[int, list[str]]:
+        """
+        Return the winning documents of each agency from the winners
+        index, so it only costs O(winners). Must be called with the lock held
+        """
+        winners_by_agency: dict[int, list[str]] = {
+            agency: [] for agency in self._agencies_ready
+        }
+
+        for agency, documents in self._winners_index.items():
+            winners_by_agency[agency] = list(documents)
+
+        return winners_by_agency
+
+    def _publish_winners(self, winners_by_agency: dict[int, list[str]]) -> None:
+        """
+        Store the winners of the draw, push them to every parked waiter and
+        start the next round. The drawn round is archived in the background
+        """
+        with self.__writes_paused(), self._lock:
+            draw = self.__close_round(winners_by_agency)
+
+        self.__announce_draw(*draw)
+
+    def __writes_paused(self) -> ExitStack:
+        """
+        Wait for the groups being written and keep the writers from taking
+        new ones until the returned context exits. Taken before the lock,
+        so no bets are written in a round after its winners are drawn
+        """
+        stack = ExitStack()
+        for writing_lock in self._writing_locks:
+            stack.enter_context(writing_lock)
+
+        return stack
+
+    def __close_round(
+        self, winners_by_agency: dict[int, list[str]]
+    ) -> tuple[dict[int, list[str]], int, list[tuple[int, Future]]]:
+        """
+        Store the winners of the drawn round, start the next round and
+        archive the drawn one in the background. Return the winners, the
+        drawn round and its parked waiters. Must be called with the lock
+        held, in the same hold as the draw
+        """
+        drawn_round: int = self._round_id
+        bet_log: PartitionedBetLog = self._bet_log
+        wal: BetLog = self._wal
+
+        self._drawn_round = drawn_round
+        self._winners_by_agency = winners_by_agency
+        waiters, self._results_waiters = self._results_waiters, []
+        self.__start_next_round()
+
+        archiver = threading.Thread(
+            target=self.__archive_round, args=(drawn_round, bet_log, wal), daemon=True
+        )
+        self._archivers = [
+            archiver for archiver in self._archivers if archiver.is_alive()
+        ]
+        self._archivers.append(archiver)
+        archiver.start()
+
+        return winners_by_agency, drawn_round, waiters
+
+    def __announce_draw(
+        self,
+        winners_by_agency: dict[int, list[str]],
+        drawn_round: int,
+        waiters: list[tuple[int, Future]],
+    ) -> None:
+        # Futures run their callbacks on completion, so they are
+        # completed without holding the lock
+        for agency_id, future in waiters:
+            if future.set_running_or_notify_cancel():
+                future.set_result(winners_by_agency.get(agency_id, []))
+
+        logging.info(
+            f"action: sorteo | result: success | ronda: {drawn_round} | "
+            f"esperando_resultados: {len(waiters)}"
+        )
+        logging.info(
+            f"action: nueva_ronda | result: success | ronda: {drawn_round + 1}"
+        )
+
+    def _load_winners(self, round_id: int) -> dict[int, list[str]]:
+        """
+        Return the winners of an archived round, grouped by agency
+        """
+        return query_winners(
+            archive_filepath(self._storage_dirpath, round_id),
+            LOTTERY_WINNER_NUMBER,
+            self._draw_workers,
+        )
+
+    def __ingestion_queue(self, agency_id: int) -> FairQueue:
+        return self._ingestion_queues[agency_id % len(self._ingestion_queues)]
+
+    def __write_bets(
+        self, ingestion_queue: FairQueue, writing_lock: threading.Lock
+    ) -> None:
+        """
+        Writer thread: persist the queued batches, grouping every batch
+        already waiting in the queue in a single write per partition. Sync
+        requests (agency, finish, future) are answered once the batches of
+        the agency queued before them are synced, barriers (event) once
+        every batch queued before them is written, and None stops the writer
+
+        A batch that can not be persisted fails its agency: the following
+        batches of the agency are dropped until its next sync request is
+        failed, so the persisted progress of the agency never has gaps.
+        The writer keeps persisting the batches of the other agencies
+
+        Every group is written holding the writing lock of the writer and
+        the storage and state of the round are taken once per group, so a
+        group is written, indexed and synced in a single round: the draw
+        waits for the group before closing the round
+
+        With the interval fsync policy, the writer wakes up when the logs it
+        wrote are due to be synced, even if no more batches are queued
+        """
+        running: bool = True
+        failed_agencies: dict[int, str] = {}
+        unsynced_agencies: set[int] = set()
+        sync_deadline: Optional[float] = None
+
+        while running:
+            items: list = []
+            try:
+                items.append(
+                    ingestion_queue.get(
+                        None
+                        if sync_deadline is None
+                        else max(sync_deadline - time.monotonic(), 0.0)
+                    )
+                )
+            except queue.Empty:
+                pass
+
+            while items and len(items) < INGESTION_GROUP_SIZE:
+                try:
+                    items.append(ingestion_queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            batches: list[BetBatch] = []
+            for item in items:
+                if not isinstance(item, BetBatch):
+                    continue
+                if item.agency in failed_agencies:
+                    self.__forget_batch(item)
+                else:
+                    batches.append(item)
+            sync_requests: list[tuple[int, bool, Future]] = [
+                item for item in items if isinstance(item, tuple)
+            ]
+            barriers: list[threading.Event] = [
+                item for item in items if isinstance(item, threading.Event)
+            ]
+            running = None not in items
+
+            with writing_lock:
+                self.__write_group(batches, sync_requests, failed_agencies)
+
+                unsynced_agencies.update(bets.agency for bets in batches)
+                sync_deadline = self.__sync_due_logs(unsynced_agencies)
+
+            for barrier in barriers:
+                barrier.set()
+
+    def __write_group(
+        self,
+        batches: list[BetBatch],
+        sync_requests: list[tuple[int, bool, Future]],
+        failed_agencies: dict[int, str],
+    ) -> None:
+        with self._lock:
+            round_storage = RoundStorage(
+                self._bet_log, self._wal, self._progress, self._winners_index
+            )
+
+        if batches:
+            with STORAGE_WRITE_SECONDS.time():
+                stored: list[BetBatch] = self.__persist_batches(
+                    round_storage, batches, failed_agencies
+                )
+
+            with self._lock:
+                for bets in stored:
+                    self.__index_winners(round_storage, bets)
+
+        for agency_id, finish, synced in sync_requests:
+            self.__answer_sync(
+                round_storage, agency_id, finish, synced, failed_agencies
+            )
+
+    def __sync_due_logs(self, agencies: set[int]) -> Optional[float]:
+        """
+        Sync the partitions of the agencies and the write-ahead log of the
+        round if their fsync interval is over. Agencies whose partition has
+        nothing left to sync are removed. Return when the next sync is due
+        """
+        with self._lock:
+            bet_log: PartitionedBetLog = self._bet_log
+            wal: BetLog = self._wal
+
+        now: float = time.monotonic()
+        deadlines: list[float] = []
+
+        try:
+            for agency_id in list(agencies):
+                deadline: Optional[float] = bet_log.sync_if_due(agency_id, now)
+                if deadline is None:
+                    agencies.discard(agency_id)
+                else:
+                    deadlines.append(deadline)
+
+            with self._wal_lock:
+                deadline = wal.sync_if_due(now)
+                if deadline is not None:
+                    deadlines.append(deadline)
+        except OSError as e:
+            # Left to the next sync of the agencies, which reports the failure
+            logging.error(f"action: sincronizar_apuestas | result: fail | error: {e}")
+            agencies.clear()
+            return None
+
+        return min(deadlines, default=None)
+
+    def __persist_batches(
+        self,
+        round_storage: "RoundStorage",
+        batches: list[BetBatch],
+        failed_agencies: dict[int, str],
+    ) -> list[BetBatch]:
+        """
+        Write the batches to the partition of their agencies and record
+        every write in the write-ahead log. The partition is flushed first,
+        so the log never records bets that were not written. Agencies whose
+        batches could not be written are added to failed_agencies and the
+        stored batches are returned
+        """
+        batches_by_agency: dict[int, list[BetBatch]] = {}
+        for bets in batches:
+            batches_by_agency.setdefault(bets.agency, []).append(bets)
+
+        stored: list[BetBatch] = []
+        for agency_id, agency_batches in batches_by_agency.items():
+            try:
+                self.__persist_agency_batches(round_storage, agency_id, agency_batches)
+            except Exception as e:
+                failed_agencies[agency_id] = str(e)
+                for bets in agency_batches:
+                    self.__forget_batch(bets)
+                logging.error(
+                    f"action: guardar_apuestas | result: fail | agencia: {agency_id} | "
+                    f"error: {e}"
+                )
+                continue
+
+            stored.extend(agency_batches)
+
+        return stored
+
+    def __forget_batch(self, bets: BetBatch) -> None:
+        if bets.batch_key is None:
+            return
+
+        with self._lock:
+            duplicates: DuplicatesIndex = self._duplicates
+        duplicates.discard(bets.agency, bets.batch_key)
+
+    def __persist_agency_batches(
+        self,
+        round_storage: "RoundStorage",
+        agency_id: int,
+        agency_batches: list[BetBatch],
+    ) -> None:
+        partition: BetLog = round_storage.bet_log.partition(agency_id)
+        partition.extend(agency_batches)
+        partition.flush()
+
+        sequence_number: int = agency_batches[-1].sequence_number
+        n_bets: int = sum(len(bets) for bets in agency_batches)
+
+        with self._wal_lock:
+            round_storage.wal.write(
+                encode_wal_entry(
+                    WAL_BATCH, agency_id, sequence_number, n_bets, partition.size
+                )
+            )
+            # Handed to the OS right away, so the progress survives a
+            # crash of the process whatever the fsync policy
+            round_storage.wal.flush()
+
+        with self._lock:
+            progress = round_storage.progress.setdefault(agency_id, AgencyProgress())
+            progress.last_sequence = sequence_number
+            progress.bets += n_bets
+            progress.size = partition.size
+
+    def __answer_sync(
+        self,
+        round_storage: "RoundStorage",
+        agency_id: int,
+        finish: bool,
+        synced: Future,
+        failed_agencies: dict[int, str],
+    ) -> None:
+        """
+        Sync the partition of the agency and complete its sync request, or
+        fail it if some batch of the agency was not persisted since its
+        previous sync request
+        """
+        error: Optional[str] = failed_agencies.pop(agency_id, None)
+
+        if error is None:
+            try:
+                self.__sync_partition(round_storage, agency_id, finish)
+            except Exception as e:
+                error = str(e)
+                logging.error(
+                    f"action: sincronizar_apuestas | result: fail | "
+                    f"agencia: {agency_id} | error: {e}"
+                )
+
+        if error is None:
+            synced.set_result(None)
+        else:
+            synced.set_exception(
+                OSError(f"Bets of agency {agency_id} were not stored: {error}")
+            )
+
+    def __sync_partition(
+        self, round_storage: "RoundStorage", agency_id: int, finish: bool
+    ) -> None:
+        round_storage.bet_log.sync(agency_id)
+
+        with self._wal_lock:
+            if finish:
+                round_storage.wal.write(encode_wal_entry(WAL_FINISH, agency_id))
+            round_storage.wal.sync()
+
+    def __index_winners(self, round_storage: "RoundStorage", bets: BetBatch) -> None:
+        documents: list[str] = winning_documents(bets)
+
+        if documents:
+            round_storage.winners_index.setdefault(bets.agency, []).extend(documents)
+
+    def __recover_rounds(self) -> None:
+        """
+        Find the current round of a previous execution of the server: the
+        last round that was not archived, or the one after the last archived
+        round. Older rounds were drawn before the server stopped, so they are
+        archived right away
+        """
+        pending_rounds: list[int] = round_ids(self._storage_dirpath)
+        archived_rounds: list[int] = archived_round_ids(self._storage_dirpath)
+
+        for round_id in pending_rounds[:-1]:
+            archive_round(self._storage_dirpath, round_id)
+
+        drawn_rounds: list[int] = archived_rounds + pending_rounds[:-1]
+        self._drawn_round = max(drawn_rounds) if drawn_rounds else None
+        self._round_id = (
+            pending_rounds[-1] if pending_rounds else (self._drawn_round or 0) + 1
+        )
+
+    def __round_dirpath(self) -> str:
+        return round_dirpath(self._storage_dirpath, self._round_id)
+
+    def __open_round(self) -> None:
+        self._bet_log = PartitionedBetLog(
+            self.__round_dirpath(), self._fsync_policy, self._fsync_interval
+        )
+        self._wal = BetLog(
+            wal_filepath(self.__round_dirpath()),
+            self._fsync_policy,
+            self._fsync_interval,
+        )
+
+    def __start_next_round(self) -> None:
+        """
+        Replace the state of the drawn round with a clean one, storing the
+        next bets in a new round directory. The storage of the drawn round
+        is closed by its archiver. Must be called with the lock held
+        """
+        with self._wal_lock:
+            self._round_id += 1
+            self._progress = {}
+            self._agencies_ready = set()
+            self._winners_index = {}
+            self._duplicates = DuplicatesIndex(self._duplicates_window)
+            self.__open_round()
+
+    def __archive_round(
+        self, round_id: int, bet_log: PartitionedBetLog, wal: BetLog
+    ) -> None:
+        """
+        Archiver thread: wait until the batches queued before the draw are
+        written, then close the storage of the drawn round and merge it
+        into the archive
+        """
+        for ingestion_queue in self._ingestion_queues:
+            barrier = threading.Event()
+            ingestion_queue.put(barrier)
+            barrier.wait()
+
+        try:
+            bet_log.close()
+            wal.close()
+            archived_bets: int = archive_round(self._storage_dirpath, round_id)
+        except OSError as e:
+            logging.error(
+                f"action: archivar_ronda | result: fail | ronda: {round_id} | "
+                f"error: {e}"
+            )
+            return
+
+        logging.info(
+            f"action: archivar_ronda | result: success | ronda: {round_id} | "
+            f"apuestas: {archived_bets}"
+        )
+
+    def __load_drawn_winners(self) -> None:
+        """
+        After a restart, load the winners of the last drawn round from the
+        archive the first time they are requested. The archive is scanned
+        without holding the lock, so the agencies that are betting are not
+        blocked meanwhile
+        """
+        with self._winners_load_lock:
+            with self._lock:
+                if self._winners_by_agency is not None or self._drawn_round is None:
+                    return
+                drawn_round: int = self._drawn_round
+
+            winners_by_agency = self._load_winners(drawn_round)
+
+            with self._lock:
+                # A newer draw while loading already published its winners
+                if self._winners_by_agency is None:
+                    self._winners_by_agency = winners_by_agency
+
+    def __take_snapshot(self) -> None:
+        """
+        Snapshot the state recovered on startup, once the storage of the
+        current round is closed. Must be called with the lock held
+        """
+        snapshot: dict[str, Any] = {
+            "round": self._round_id,
+            "files": file_sizes(self.__round_dirpath()),
+            "progress": {
+                agency: [p.last_sequence, p.bets, p.size]
+                for agency, p in self._progress.items()
+            },
+            "agencies_ready": sorted(self._agencies_ready),
+            "winners_index": self._winners_index,
+            "drawn_round": self._drawn_round,
+            "drawn_winners": self._winners_by_agency,
+        }
+
+        try:
+            write_snapshot(self._storage_dirpath, snapshot)
+        except OSError as e:
+            logging.error(f"action: guardar_snapshot | result: fail | error: {e}")
+            return
+
+        logging.info(
+            f"action: guardar_snapshot | result: success | ronda: {self._round_id}"
+        )
+
+    def __restore_snapshot(self) -> bool:
+        """
+        Restore the state of the current round from the snapshot taken by
+        a previous execution of the server. Return False if there is no
+        snapshot or the storage changed since it was taken, so the state
+        must be recovered from the storage
+        """
+        # The snapshot is consumed even if it is not used, so it is never
+        # loaded after the storage changes
+        snapshot: Optional[dict[str, Any]] = load_snapshot(self._storage_dirpath)
+        if snapshot is None or not self._startup_snapshot:
+            return False
+
+        try:
+            files: dict[str, int] = file_sizes(self.__round_dirpath())
+            if snapshot["round"] != self._round_id or snapshot["files"] != files:
+                raise ValueError("storage changed after the snapshot")
+
+            agencies_ready: set[int] = set(snapshot["agencies_ready"])
+            progress: dict[int, AgencyProgress] = {}
+            for agency, values in snapshot["progress"].items():
+                agency_progress = progress.setdefault(int(agency), AgencyProgress())
+                (
+                    agency_progress.last_sequence,
+                    agency_progress.bets,
+                    agency_progress.size,
+                ) = values
+                agency_progress.finished = int(agency) in agencies_ready
+
+            winners_index: dict[int, list[str]] = {
+                int(agency): documents
+                for agency, documents in snapshot["winners_index"].items()
+            }
+            drawn_winners: Optional[dict[int, list[str]]] = None
+            if (
+                snapshot["drawn_round"] == self._drawn_round
+                and snapshot["drawn_winners"] is not None
+            ):
+                drawn_winners = {
+                    int(agency): documents
+                    for agency, documents in snapshot["drawn_winners"].items()
+                }
+        except (KeyError, TypeError, ValueError) as e:
+            logging.warning(f"action: cargar_snapshot | result: fail | error: {e}")
+            return False
+
+        self._progress = progress
+        self._agencies_ready = agencies_ready
+        self._winners_index = winners_index
+        self._winners_by_agency = drawn_winners
+
+        logging.info(
+            "action: cargar_snapshot | result: success | "
+            f"ronda: {self._round_id} | "
+            f"agencias: {len(self._progress)} | "
+            f"agencias_listas: {len(self._agencies_ready)}"
+        )
+
+        return True
+
+    def __recover_storage(self) -> None:
+        """
+        Recover the storage of the current round and the agencies that
+        finished betting in it from the write-ahead log of a previous
+        execution of the server
+        """
+        self._progress = recover_storage(self.__round_dirpath())
+        self._agencies_ready = {
+            agency for agency, progress in self._progress.items() if progress.finished
+        }
+
+        if self._progress:
+            logging.info(
+                "action: recuperar_estado | result: success | "
+                f"ronda: {self._round_id} | "
+                f"agencias: {len(self._progress)} | "
+                f"agencias_listas: {len(self._agencies_ready)} | "
+                f"apuestas: {sum(p.bets for p in self._progress.values())}"
+            )
+
+    def __rebuild_winners_index(self) -> None:
+        """
+        Recover the winners index from the bets persisted by a previous
+        execution of the server. It is the only draw that scans every
+        stored bet, so the partitions are split among the draw workers
+        """
+        partitions: dict[int, str] = partition_filepaths(self.__round_dirpath())
+        if not partitions:
+            return
+
+        self._winners_index.update(
+            query_logs_winners(
+                list(partitions.values()), LOTTERY_WINNER_NUMBER, self._draw_workers
+            )
+        )
+
+        logging.info(
+            "action: recuperar_ganadores | result: success | "
+            f"agencias: {len(self._winners_index)}"
+        )
+
+    def __draw_winners(self) -> dict[int, list[str]]:
+        """
+        Draw the winning number for the lottery. Then return the winning bets for each agency.
+        Must be called with the lock held
+        """
+
+        with DRAW_SECONDS.time():
+            return self._collect_winners()
+
+
+class RoundStorage:
+    """
+    Storage and state of the round a writer writes a group to, taken
+    together so the group is written, logged and indexed in that round
+    """
+
+    bet_log: PartitionedBetLog
+    wal: BetLog
+    progress: dict[int, AgencyProgress]
+    winners_index: dict[int, list[str]]
+
+    def __init__(
+        self,
+        bet_log: PartitionedBetLog,
+        wal: BetLog,
+        progress: dict[int, AgencyProgress],
+        winners_index: dict[int, list[str]],
+    ) -> None:
+        self.bet_log = bet_log
+        self.wal = wal
+        self.progress = progress
+        self.winners_index = winners_index
@@ -0,0 +1,312 @@
+import time
+import bisect
+import logging
+import threading
+from typing import Optional
+
+""" Upper bounds (in seconds) of the buckets of the latency histograms. """
+LATENCY_BUCKETS = (
+    0.00001,
+    0.00005,
+    0.0001,
+    0.0005,
+    0.001,
+    0.005,
+    0.01,
+    0.05,
+    0.1,
+    0.5,
+    1.0,
+    5.0,
+)
+METRICS_PATH = "/metrics"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Metric:
+    """
+    Metric family of the registry. Samples are kept by the values of its
+    labels, given in the same order as label_names
+    """
+
+    kind: str = "untyped"
+    name: str
+    description: str
+    label_names: tuple[str, ...]
+    _lock: threading.Lock
+
+    def __init__(
+        self, name: str, description: str, label_names: tuple[str, ...] = ()
+    ) -> None:
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self._lock = threading.Lock()
+
+    def render(self) -> list[str]:
+        return [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+
+    def _labels(self, values: tuple[str, ...], extra: str = "") -> str:
+        pairs: list[str] = [
+            f'{name}="{value}"' for name, value in zip(self.label_names, values)
+        ]
+        if extra:
+            pairs.append(extra)
+
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter(Metric):
+    kind = "counter"
+    _values: dict[tuple[str, ...], float]
+
+    def __init__(
+        self, name: str, description: str, label_names: tuple[str, ...] = ()
+    ) -> None:
+        super().__init__(name, description, label_names)
+        self._values = {}
+
+    def inc(self, amount: float = 1, *label_values: str) -> None:
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values: str) -> float:
+        with self._lock:
+            return self._values.get(label_values, 0)
+
+    def render(self) -> list[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+
+        return super().render() + [
+            f"{self.name}{self._labels(labels)} {value}" for labels, value in values
+        ]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount: float = 1, *label_values: str) -> None:
+        self.inc(-amount, *label_values)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+    buckets: tuple[float, ...]
+    _counts: list[int]
+    _sum: float
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+    ) -> None:
+        super().__init__(name, description)
+        self.buckets = buckets
+        self._counts = [0] * (len(buckets) + 1)
+        self._sum = 0.0
+
+    def observe(self, value: float) -> None:
+        bucket: int = bisect.bisect_left(self.buckets, value)
+
+        with self._lock:
+            self._counts[bucket] += 1
+            self._sum += value
+
+    def time(self) -> "Timer":
+        return Timer(self)
+
+    @property
+    def count(self) -> int:
+        with self._lock:
+            return sum(self._counts)
+
+    def render(self) -> list[str]:
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+
+        lines: list[str] = super().render()
+        cumulative: int = 0
+
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            le: str = "+Inf" if bound == float("inf") else repr(bound)
+            lines.append(f'{self.name}_bucket{{le="{le}"}} {cumulative}')
+
+        lines.append(f"{self.name}_sum {total}")
+        lines.append(f"{self.name}_count {cumulative}")
+
+        return lines
+
+
+class Timer:
+    """
+    Context manager that observes its elapsed time in a histogram
+    """
+
+    _histogram: Histogram
+    _start: float
+
+    def __init__(self, histogram: Histogram) -> None:
+        self._histogram = histogram
+
+    def __enter__(self) -> "Timer":
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *_exc) -> None:
+        self._histogram.observe(time.perf_counter() - self._start)
+
+
+class InstrumentedLock:
+    """
+    Lock that observes the time spent waiting to acquire it
+    """
+
+    _lock: threading.Lock
+    _wait: Histogram
+
+    def __init__(self, wait: Histogram) -> None:
+        self._lock = threading.Lock()
+        self._wait = wait
+
+    def __enter__(self) -> None:
+        start: float = time.perf_counter()
+        self._lock.acquire()
+        self._wait.observe(time.perf_counter() - start)
+
+    def __exit__(self, *_exc) -> None:
+        self._lock.release()
+
+
+class Registry:
+    _metrics: dict[str, Metric]
+    _lock: threading.Lock
+
+    def __init__(self) -> None:
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+
+        lines: list[str] = []
+        for metric in metrics:
+            lines.extend(metric.render())
+
+        return "\n".join(lines) + "\n"
+
+
+""" Metrics of the server process. """
+REGISTRY = Registry()
+
+
+def counter(name: str, description: str, label_names: tuple[str, ...] = ()) -> Counter:
+    return REGISTRY.register(Counter(name, description, label_names))
+
+
+def gauge(name: str, description: str) -> Gauge:
+    return REGISTRY.register(Gauge(name, description))
+
+
+def histogram(
+    name: str, description: str, buckets: tuple[float, ...] = LATENCY_BUCKETS
+) -> Histogram:
+    return REGISTRY.register(Histogram(name, description, buckets))
+
+
+""" Metrics of the hot paths of the server. Rates (e.g. bets per second) are
+computed from the counters by the scraper. """
+BETS_RECEIVED = counter(
+    "lottery_bets_received_total", "Bets received by result", ("result",)
+)
+BATCHES_RECEIVED = counter(
+    "lottery_batches_received_total", "Bet batches received by result", ("result",)
+)
+BATCH_DECODE_SECONDS = histogram(
+    "lottery_batch_decode_seconds", "Time spent decoding a bet batch"
+)
+STORE_SECONDS = histogram(
+    "lottery_store_seconds", "Time spent queuing a bet batch to be stored"
+)
+STORAGE_WRITE_SECONDS = histogram(
+    "lottery_storage_write_seconds", "Time spent writing a group of batches to disk"
+)
+LOCK_WAIT_SECONDS = histogram(
+    "lottery_lock_wait_seconds", "Time spent waiting for the lottery state lock"
+)
+DRAW_SECONDS = histogram("lottery_draw_seconds", "Duration of the draw")
+ACTIVE_CONNECTIONS = gauge(
+    "lottery_active_connections", "Agency connections currently open"
+)
+BYTES_RECEIVED = counter(
+    "lottery_received_bytes_total", "Bytes received from the agencies"
+)
+BYTES_SENT = counter("lottery_sent_bytes_total", "Bytes sent to the agencies")
+THROTTLED = counter(
+    "lottery_throttled_total",
+    "Connections and batches rejected by admission control",
+    ("kind",),
+)
+
+
+class MetricsServer:
+    """
+    Serves the metrics of the registry in the Prometheus text format on
+    a background thread. http.server is only imported when the metrics
+    are exposed, since it is the most expensive import of the server
+    """
+
+    _server: "ThreadingHTTPServer"
+    _thread: Optional[threading.Thread]
+
+    def __init__(self, port: int, registry: Registry = REGISTRY) -> None:
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                if self.path != METRICS_PATH:
+                    self.send_error(404)
+                    return
+
+                body: bytes = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *_args) -> None:
+                # Scrapes are not logged
+                pass
+
+        self._server = ThreadingHTTPServer(("", port), MetricsHandler)
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def port(self) -> int:
+        return self._server.server_address[1]
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+        logging.info(f"action: exponer_metricas | result: success | port: {self.port}")
+
+    def stop(self) -> None:
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread.join()
+
+        self._server.server_close()
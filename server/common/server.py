@@ -1,23 +1,25 @@
+import time
 import socket
 import logging
 import threading
-
-from common.utils import Bet, store_bets, load_bets, has_won
+from concurrent import futures
+from typing import Union
+
+from common.lottery import Lottery
+from common.agency_session import (
+    SESSION_IDLE_TIMEOUT,
+    AgencySession,
+    SessionRegistry,
+)
+from common.admission import CONNECTION_RETRY_AFTER, AdmissionController
+from common.metrics import ACTIVE_CONNECTIONS
 
 from common.communication.server_socket import ServerSocket
-from common.communication.client_socket import ClientSocket
-
-from common.communication.server_message import (
-    ServerHeader,
-    encode_message,
-    encode_winners_message,
-)
-from common.communication.agency_message import (
-    BATCH_SEPARATOR,
-    AgencyHeader,
-    decode_bet_batch,
-    decode_identification_message,
-    decode_message,
+from common.communication.server_message import encode_retry_after_message
+from common.communication.client_socket import (
+    RECEIVE_BUFFER_SIZE,
+    SOCKET_TIMEOUT,
+    ClientSocket,
 )
 
 
@@ -25,22 +27,37 @@ class Server:
     _server_socket: ServerSocket
     _running: bool
     _first_accept_try: bool
-    _number_agencies: int
     _connected_clients: set[tuple[threading.Thread, ClientSocket]]
-    _agencies_ready: set[int]
-    _winners_by_agency: dict[int, list[str]]
-    _lock: threading.Lock
-
-    def __init__(self, port: int, listen_backlog: int, number_agencies: int) -> None:
+    _rejected_clients: list[tuple[float, ClientSocket]]
+    _lottery: Lottery
+    _admission: AdmissionController
+    _sessions: SessionRegistry
+
+    def __init__(
+        self,
+        port: int,
+        listen_backlog: int,
+        lottery: Lottery,
+        reuse_port: bool = False,
+        buffer_size: int = RECEIVE_BUFFER_SIZE,
+        max_connections: int = 0,
+        agency_bets_rate: float = 0.0,
+        agency_bytes_rate: float = 0.0,
+        session_idle_timeout: float = SESSION_IDLE_TIMEOUT,
+    ) -> None:
         # Initialize server socket
-        self._server_socket = ServerSocket(("", port), listen_backlog)
+        self._server_socket = ServerSocket(
+            ("", port), listen_backlog, reuse_port, buffer_size
+        )
         self._running = True
         self._first_accept_try = True
-        self._number_agencies = number_agencies
         self._connected_clients = set()
-        self._agencies_ready = set()
-        self._winners_by_agency = {}
-        self._lock = threading.Lock()
+        self._rejected_clients = []
+        self._lottery = lottery
+        self._admission = AdmissionController(
+            max_connections, agency_bets_rate, agency_bytes_rate
+        )
+        self._sessions = SessionRegistry(session_idle_timeout)
 
     def run(self):
         """
@@ -57,6 +74,10 @@ class Server:
 
                 client_socket: ClientSocket = self._server_socket.accept()
 
+                if not self._admission.admit_connection():
+                    self.__reject_client(client_socket)
+                    continue
+
                 t = threading.Thread(target=self.__handle_client, args=(client_socket,))
                 t.start()
 
@@ -76,6 +97,31 @@ class Server:
 
         self.__cleanup()
 
+    def __reject_client(self, client_socket: ClientSocket) -> None:
+        """
+        Reply retry_after to a connection over the connections limit, so the
+        agency knows when to connect again. The socket is closed once the
+        agency had time to read the reply, since closing it with the
+        identification unread would reset the connection
+        """
+        logging.debug(
+            f"action: accept_connections | result: fail | "
+            f"ip: {client_socket.address[0]} | error: connections limit"
+        )
+
+        try:
+            client_socket.send_message(
+                encode_retry_after_message(0, CONNECTION_RETRY_AFTER)
+            )
+            client_socket.shutdown_write()
+        except OSError:
+            client_socket.close()
+            return
+
+        self._rejected_clients.append(
+            (time.monotonic() + CONNECTION_RETRY_AFTER, client_socket)
+        )
+
     def __handle_client(self, client_socket: ClientSocket) -> None:
         """
         Handle the communication with an agency
@@ -83,104 +129,67 @@ class Server:
         This function is called in a new thread to handle the communication
         with an agency. The agency is identified by the agency_socket
         """
+        session = AgencySession(self._lottery, self._admission, self._sessions)
+        ACTIVE_CONNECTIONS.inc()
+
         try:
-            msg: str = self.__wait_for_message(client_socket)
-            agency_id: int = decode_identification_message(msg)
-
-            while self._running:
-                msg: str = self.__wait_for_message(client_socket)
-                header, payload = decode_message(msg)
-
-                if header == AgencyHeader.BET_BATCH:
-                    self.__handle_bet_batch(client_socket, payload, agency_id)
-                elif header == AgencyHeader.FINISH_BETTING:
-                    self.__handle_finish_betting(agency_id)
-                elif header == AgencyHeader.REQUEST_RESULTS:
-                    self.__handle_request_result(client_socket, agency_id)
-                    return
-                elif header == AgencyHeader.SHUTDOWN:
-                    return
+            while self._running and not session.finished:
+                msgs: list[Union[str, bytes]] = self.__wait_for_messages(
+                    client_socket, session
+                )
+                # The server is stopping or the session expired
+                if not msgs:
+                    break
+
+                replies: list[str] = session.handle_messages(msgs)
+
+                if replies:
+                    client_socket.send_messages(replies)
+
+                if session.pending_results is not None:
+                    self.__wait_for_results(session)
+                    client_socket.send_message(session.results_reply())
+
+                session.update_transport(client_socket)
 
         except ValueError as e:
             logging.error(f"action: receive_message | result: fail | error: {e}")
         except OSError as e:
             logging.error(f"action: receive_message | result: fail | error: {e}")
         finally:
+            ACTIVE_CONNECTIONS.dec()
             client_socket.close()
+            session.close()
+            self._admission.release_connection()
 
-    def __handle_bet_batch(
-        self, client_socket: ClientSocket, payload: str, agency_id: int
-    ):
-        try:
-            bets: list[Bet] = decode_bet_batch(agency_id, payload)
-
-            if len(bets) == 0:
-                client_socket.send_message(encode_message(ServerHeader.FAILURE))
-                return
-
-            with self._lock:
-                store_bets(bets)
-
-            logging.info(
-                f"action: apuesta_recibida | result: success | cantidad: {len(bets)}"
-            )
-
-            client_socket.send_message(encode_message(ServerHeader.SUCCESS))
-        except ValueError as _:
-            n_bets: int = len(payload.split(BATCH_SEPARATOR))
-            logging.error(
-                f"action: apuesta_recibida | result: fail | cantidad: {n_bets}"
-            )
-
-            client_socket.send_message(encode_message(ServerHeader.FAILURE))
-
-    def __handle_finish_betting(self, agency_id: int) -> None:
-        with self._lock:
-            self._agencies_ready.add(agency_id)
-
-            if len(self._agencies_ready) == self._number_agencies:
-                self.__draw_winners()
-
-    def __handle_request_result(
-        self, client_socket: ClientSocket, agency_id: int
-    ) -> None:
-        with self._lock:
-            if agency_id not in self._agencies_ready:
-                client_socket.send_message(encode_message(ServerHeader.FAILURE))
-                return
-
-            if (
-                len(self._agencies_ready) < self._number_agencies
-                or not self._winners_by_agency
-            ):
-                client_socket.send_message(encode_message(ServerHeader.NOT_READY))
-                return
-
-            client_socket.send_message(
-                encode_winners_message(self._winners_by_agency[agency_id])
-            )
-
-    def __wait_for_message(self, client_socket: ClientSocket) -> str:
-        while self._running:
+    def __wait_for_messages(
+        self, client_socket: ClientSocket, session: AgencySession
+    ) -> list[Union[str, bytes]]:
+        while self._running and not session.expired:
             try:
-                return client_socket.receive_message()
+                return client_socket.receive_messages()
             except socket.timeout:
                 continue
 
-        return ""
+        return []
 
-    def __draw_winners(self):
+    def __wait_for_results(self, session: AgencySession) -> None:
         """
-        Draw the winning number for the lottery. Then store the winning bets for each agency
+        Hold the connection until the winners are pushed by the draw, the
+        results timeout expires or the server stops
         """
+        deadline: float = time.monotonic() + session.results_timeout
 
-        self._winners_by_agency = {agency: [] for agency in self._agencies_ready}
-
-        for bet in load_bets():
-            if has_won(bet):
-                self._winners_by_agency[bet.agency].append(bet.document)
+        while self._running:
+            remaining: float = deadline - time.monotonic()
+            if remaining <= 0:
+                return
 
-        logging.info("action: sorteo | result: success")
+            done, _ = futures.wait(
+                [session.pending_results], timeout=min(remaining, SOCKET_TIMEOUT)
+            )
+            if done:
+                return
 
     def __close_finished_connections(self) -> None:
         connected_clients: set[tuple[threading.Thread, ClientSocket]] = set()
@@ -194,13 +203,25 @@ class Server:
 
         self._connected_clients = connected_clients
 
+        now: float = time.monotonic()
+        for deadline, s in self._rejected_clients:
+            if deadline <= now:
+                s.close()
+        self._rejected_clients = [
+            (deadline, s) for deadline, s in self._rejected_clients if deadline > now
+        ]
+
     def __cleanup(self) -> None:
         try:
             for t, s in self._connected_clients:
                 s.close()
                 t.join()
 
+            for _, s in self._rejected_clients:
+                s.close()
+
             self._server_socket.close()
+            self._lottery.close()
         except Exception as e:
             logging.error(f"action: exit | result: fail | error: {e}")
 
@@ -0,0 +1,964 @@
+import os
+import re
+import csv
+import json
+import mmap
+import time
+import shutil
+import zlib
+import struct
+import logging
+import datetime
+from array import array
+from enum import Enum
+from itertools import repeat
+from typing import Any, BinaryIO, Iterator, Optional, Union
+
+from common.utils import Bet, BetBatch
+
+""" Size of the user space buffer of the bets log writer and reader. """
+STORAGE_BUFFER_SIZE = 1024 * 1024
+
+"""
+Every bet is persisted as a length-prefixed record:
+| payload size (u32) | crc32 of payload (u32) | payload |
+The payload starts with the fixed width fields followed by the utf-8
+encoded first name, last name and document.
+"""
+RECORD_HEADER = struct.Struct("<II")
+BET_FIELDS = struct.Struct("<IIIHHH")
+""" Bounds of the fixed width fields: agency ids, numbers and sequence
+numbers are u32, names and documents are prefixed by their u16 size. """
+MAX_RECORD_ID = 2**32 - 1
+MAX_FIELD_SIZE = 2**16 - 1
+MAX_RECORD_SIZE = BET_FIELDS.size + 3 * MAX_FIELD_SIZE
+
+"""
+Write-ahead log of a partitioned storage directory. Every write of
+batches to a partition and every finish of an agency is recorded as:
+| kind (u8) | agency (u32) | sequence number (u32) | bets (u32) | partition size (u64) |
+framed as a bets log record, so torn entries are detected the same way.
+"""
+WAL_FILENAME = "wal.log"
+WAL_ENTRY = struct.Struct("<BIIIQ")
+WAL_BATCH = 1
+WAL_FINISH = 2
+
+""" Bets log of each agency in a partitioned storage directory. """
+PARTITION_FILENAME = "agency-{agency}.log"
+PARTITION_PATTERN = re.compile(r"agency-(\d+)\.log")
+
+
+class FsyncPolicy(Enum):
+    BATCH = "batch"
+    INTERVAL = "interval"
+    FINISH = "finish"
+
+
+def _frame_record(payload: bytes) -> bytes:
+    return RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def _encode_record(
+    agency: int,
+    number: int,
+    birthdate: int,
+    first_name: str,
+    last_name: str,
+    document: str,
+) -> bytes:
+    first_name_bytes: bytes = first_name.encode("utf-8")
+    last_name_bytes: bytes = last_name.encode("utf-8")
+    document_bytes: bytes = str(document).encode("utf-8")
+
+    payload: bytes = b"".join(
+        (
+            BET_FIELDS.pack(
+                agency,
+                number,
+                birthdate,
+                len(first_name_bytes),
+                len(last_name_bytes),
+                len(document_bytes),
+            ),
+            first_name_bytes,
+            last_name_bytes,
+            document_bytes,
+        )
+    )
+
+    return _frame_record(payload)
+
+
+def encode_bet(bet: Bet) -> bytes:
+    return _encode_record(
+        bet.agency,
+        bet.number,
+        bet.birthdate.toordinal(),
+        bet.first_name,
+        bet.last_name,
+        bet.document,
+    )
+
+
+def encode_bets(bets: Union[list[Bet], BetBatch]) -> bytes:
+    """
+    Encode the records of every bet. A BetBatch is encoded straight
+    from its arrays, without building Bet objects
+    """
+    if not isinstance(bets, BetBatch):
+        return b"".join(encode_bet(bet) for bet in bets)
+
+    return b"".join(
+        _encode_record(bets.agency, *fields)
+        for fields in zip(
+            bets.numbers,
+            bets.birthdates,
+            bets.first_names,
+            bets.last_names,
+            bets.documents,
+        )
+    )
+
+
+def decode_bet(buffer: memoryview, offset: int = 0) -> Bet:
+    """
+    Decode the bet whose record payload starts at offset of the buffer
+    """
+    agency, number, birthdate, first_size, last_size, document_size = (
+        BET_FIELDS.unpack_from(buffer, offset)
+    )
+
+    start: int = offset + BET_FIELDS.size
+    first_name: str = str(buffer[start : start + first_size], "utf-8")
+    start += first_size
+    last_name: str = str(buffer[start : start + last_size], "utf-8")
+    start += last_size
+    document: str = str(buffer[start : start + document_size], "utf-8")
+
+    return Bet(
+        agency,
+        first_name,
+        last_name,
+        document,
+        datetime.date.fromordinal(birthdate),
+        number,
+    )
+
+
+class BetLog:
+    """
+    Long-lived, buffered writer of the append-only bets log. Records are
+    group committed: the buffer is flushed and fsync'ed after every batch,
+    every fsync_interval seconds or only when sync is explicitly called
+    (at finish), depending on the fsync policy.
+
+    With the interval policy the log is synced by the first write once the
+    oldest unsynced record is fsync_interval old. A log that goes quiet is
+    synced by whoever writes it calling sync_if_due (see Lottery), so a
+    crash of the machine loses at most the records of the last
+    fsync_interval seconds (plus the time spent writing a group).
+    Not thread-safe/process-safe.
+    """
+
+    _file: BinaryIO
+    _fsync_policy: FsyncPolicy
+    _fsync_interval: float
+    _unsynced_since: Optional[float]
+    filepath: str
+
+    def __init__(
+        self,
+        filepath: str,
+        fsync_policy: FsyncPolicy = FsyncPolicy.BATCH,
+        fsync_interval: float = 0.0,
+    ) -> None:
+        self._file = open(filepath, "ab", buffering=STORAGE_BUFFER_SIZE)
+        self._fsync_policy = fsync_policy
+        self._fsync_interval = fsync_interval
+        self._unsynced_since = None
+        self.filepath = filepath
+
+    def append(self, bets: Union[list[Bet], BetBatch]) -> None:
+        self.extend([bets])
+
+    def extend(self, batches: list[Union[list[Bet], BetBatch]]) -> None:
+        """
+        Append several batches with a single write, so they are group
+        committed by the fsync policy as if they were a single batch
+        """
+        self.write(b"".join(encode_bets(bets) for bets in batches))
+
+    def write(self, records: bytes) -> None:
+        self._file.write(records)
+
+        if self._unsynced_since is None:
+            self._unsynced_since = time.monotonic()
+
+        if self._fsync_policy == FsyncPolicy.BATCH:
+            self.sync()
+        else:
+            self.sync_if_due(time.monotonic())
+
+    def sync_if_due(self, now: float) -> Optional[float]:
+        """
+        With the interval policy, sync the log if its oldest unsynced record
+        is fsync_interval old. Return when the next sync is due, or None
+        if there is nothing to sync by interval
+        """
+        if self._fsync_policy != FsyncPolicy.INTERVAL or self._unsynced_since is None:
+            return None
+
+        deadline: float = self._unsynced_since + self._fsync_interval
+        if now < deadline:
+            return deadline
+
+        self.sync()
+        return None
+
+    @property
+    def size(self) -> int:
+        return self._file.tell()
+
+    def flush(self) -> None:
+        self._file.flush()
+
+    def sync(self) -> None:
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced_since = None
+
+    def close(self) -> None:
+        if self._file.closed:
+            return
+
+        self.sync()
+        self._file.close()
+
+
+class PartitionedBetLog:
+    """
+    Bets storage partitioned by agency: every agency appends to its own
+    bets log inside the storage directory, so writers of different
+    agencies never contend and queries of an agency only read its own
+    partition. A partition must only be written by a single thread.
+    """
+
+    _dirpath: str
+    _fsync_policy: FsyncPolicy
+    _fsync_interval: float
+    _partitions: dict[int, BetLog]
+
+    def __init__(
+        self,
+        dirpath: str,
+        fsync_policy: FsyncPolicy = FsyncPolicy.BATCH,
+        fsync_interval: float = 0.0,
+    ) -> None:
+        os.makedirs(dirpath, exist_ok=True)
+        self._dirpath = dirpath
+        self._fsync_policy = fsync_policy
+        self._fsync_interval = fsync_interval
+        self._partitions = {}
+
+    def partition(self, agency: int) -> BetLog:
+        if agency not in self._partitions:
+            self._partitions[agency] = BetLog(
+                partition_filepath(self._dirpath, agency),
+                self._fsync_policy,
+                self._fsync_interval,
+            )
+
+        return self._partitions[agency]
+
+    def extend(self, batches: list[BetBatch]) -> None:
+        """
+        Append the batches to the partition of their agencies, with a
+        single write for each partition
+        """
+        batches_by_agency: dict[int, list[BetBatch]] = {}
+        for bets in batches:
+            batches_by_agency.setdefault(bets.agency, []).append(bets)
+
+        for agency, agency_batches in batches_by_agency.items():
+            self.partition(agency).extend(agency_batches)
+
+    def sync(self, agency: int) -> None:
+        if agency in self._partitions:
+            self._partitions[agency].sync()
+
+    def sync_if_due(self, agency: int, now: float) -> Optional[float]:
+        """
+        Sync the partition of the agency if its interval is over (see
+        BetLog.sync_if_due)
+        """
+        if agency not in self._partitions:
+            return None
+
+        return self._partitions[agency].sync_if_due(now)
+
+    def close(self) -> None:
+        for bet_log in list(self._partitions.values()):
+            bet_log.close()
+
+
+def _map_log(filepath: str) -> Optional[mmap.mmap]:
+    with open(filepath, "rb") as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return None
+
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _scan_records(
+    buffer: memoryview, filepath: str, start: int = 0, end: Optional[int] = None
+) -> Iterator[int]:
+    """
+    Yield the offset of the payload of every record of the mapped log
+    that starts between the start (a record boundary) and end offsets.
+    A torn or corrupted record (e.g. the server died in the middle of a
+    write) ends the log.
+    """
+    end = len(buffer) if end is None else end
+    offset: int = start
+
+    while offset < end:
+        payload: int = offset + RECORD_HEADER.size
+        if payload > len(buffer):
+            break
+
+        size, checksum = RECORD_HEADER.unpack_from(buffer, offset)
+        if payload + size > len(buffer) or (
+            zlib.crc32(buffer[payload : payload + size]) != checksum
+        ):
+            break
+
+        yield payload
+        offset = payload + size
+
+    if offset < end:
+        logging.warning(
+            f"action: leer_apuestas | result: fail | error: torn record in {filepath}"
+        )
+
+
+def _find_record(buffer: memoryview, offset: int) -> int:
+    """
+    Return the offset of the first record found at or after the given
+    offset, i.e. the first header whose checksum matches the payload it
+    spans, or the end of the log if there is none
+    """
+    while offset + RECORD_HEADER.size <= len(buffer):
+        size, checksum = RECORD_HEADER.unpack_from(buffer, offset)
+        payload: int = offset + RECORD_HEADER.size
+
+        if (
+            BET_FIELDS.size <= size <= MAX_RECORD_SIZE
+            and payload + size <= len(buffer)
+            and zlib.crc32(buffer[payload : payload + size]) == checksum
+        ):
+            return offset
+
+        offset += 1
+
+    return len(buffer)
+
+
+def read_bets(filepath: str) -> Iterator[Bet]:
+    """
+    Read every bet of the log through a read-only memory map, so records
+    are decoded straight from the page cache.
+    """
+    mapped_log: Optional[mmap.mmap] = _map_log(filepath)
+    if mapped_log is None:
+        return
+
+    try:
+        with memoryview(mapped_log) as buffer:
+            for offset in _scan_records(buffer, filepath):
+                yield decode_bet(buffer, offset)
+    finally:
+        mapped_log.close()
+
+
+class BetColumns:
+    """
+    Columnar view of the bets log. The fixed width fields of every bet
+    are kept in parallel arrays, while names are not decoded and
+    documents are only decoded from the memory map when requested.
+
+    A segment of the log can be loaded with the start and end offsets:
+    the view holds the records that start in the segment, beginning at
+    the first record found from start. first_offset and last_offset are
+    the boundaries of the records actually read.
+    """
+
+    _mapped_log: Optional[mmap.mmap]
+    agency: array
+    number: array
+    birthdate: array
+    document_offset: array
+    document_size: array
+    first_offset: int
+    last_offset: int
+    complete: bool
+
+    def __init__(
+        self, filepath: str, start: int = 0, end: Optional[int] = None
+    ) -> None:
+        self._mapped_log = _map_log(filepath)
+        self.agency = array("I")
+        self.number = array("I")
+        self.birthdate = array("I")
+        self.document_offset = array("Q")
+        self.document_size = array("H")
+        self.first_offset = self.last_offset = 0
+        self.complete = True
+
+        if self._mapped_log is None:
+            return
+
+        end = len(self._mapped_log) if end is None else end
+
+        with memoryview(self._mapped_log) as buffer:
+            if start > 0:
+                start = _find_record(buffer, start)
+            self.first_offset = self.last_offset = start
+
+            for offset in _scan_records(buffer, filepath, start, end):
+                agency, number, birthdate, first_size, last_size, document_size = (
+                    BET_FIELDS.unpack_from(buffer, offset)
+                )
+                self.agency.append(agency)
+                self.number.append(number)
+                self.birthdate.append(birthdate)
+                self.document_offset.append(
+                    offset + BET_FIELDS.size + first_size + last_size
+                )
+                self.document_size.append(document_size)
+                self.last_offset = (
+                    offset
+                    + RECORD_HEADER.unpack_from(buffer, offset - RECORD_HEADER.size)[0]
+                )
+
+        # Whether the scan reached the end or stopped at a torn record
+        self.complete = self.last_offset >= end
+
+    def __len__(self) -> int:
+        return len(self.agency)
+
+    def __enter__(self) -> "BetColumns":
+        return self
+
+    def __exit__(self, *_exc) -> None:
+        self.close()
+
+    def document(self, index: int) -> str:
+        start: int = self.document_offset[index]
+        return self._mapped_log[start : start + self.document_size[index]].decode(
+            "utf-8"
+        )
+
+    def close(self) -> None:
+        if self._mapped_log is not None:
+            self._mapped_log.close()
+
+
+def _indices_of(column: array, value: int) -> Iterator[int]:
+    """
+    Yield the indices of the column equal to value. The search runs over
+    the raw bytes of the column, so matching is done in C
+    """
+    data: bytes = column.tobytes()
+    needle: bytes = array(column.typecode, [value]).tobytes()
+
+    position: int = data.find(needle)
+    while position != -1:
+        if position % column.itemsize == 0:
+            yield position // column.itemsize
+            position = data.find(needle, position + column.itemsize)
+        else:
+            position = data.find(needle, position + 1)
+
+
+def _query_segment(
+    filepath: str, number: int, start: int, end: Optional[int]
+) -> tuple[dict[int, list[str]], int, int, bool]:
+    """
+    Return the winners of the segment of the log grouped by agency, the
+    boundaries of the records read and whether the segment was read up
+    to its end
+    """
+    winners_by_agency: dict[int, list[str]] = {}
+
+    with BetColumns(filepath, start, end) as columns:
+        for index in _indices_of(columns.number, number):
+            winners_by_agency.setdefault(columns.agency[index], []).append(
+                columns.document(index)
+            )
+
+        return (
+            winners_by_agency,
+            columns.first_offset,
+            columns.last_offset,
+            columns.complete,
+        )
+
+
+def query_winners(filepath: str, number: int, workers: int = 1) -> dict[int, list[str]]:
+    """
+    Return the documents of the bets with the given number grouped by
+    agency, without materializing Bet objects.
+
+    With more than one worker the log is split in byte ranges scanned by
+    a process pool. Partial results are merged in log order (and dropped
+    after a torn record), so they match the sequential scan exactly. If
+    the records read by consecutive segments do not line up, the log is
+    scanned sequentially instead
+    """
+    if workers <= 1:
+        return _query_segment(filepath, number, 0, None)[0]
+
+    segment_size: int = os.path.getsize(filepath) // workers + 1
+    starts: list[int] = [segment * segment_size for segment in range(workers)]
+    winners_by_agency: dict[int, list[str]] = {}
+    expected_offset: int = 0
+
+    with _query_pool(workers) as executor:
+        partial_results = executor.map(
+            _query_segment,
+            repeat(filepath),
+            repeat(number),
+            starts,
+            starts[1:] + [None],
+        )
+
+        for partial_winners, first_offset, last_offset, complete in partial_results:
+            if first_offset != expected_offset:
+                return query_winners(filepath, number)
+
+            for agency, documents in partial_winners.items():
+                winners_by_agency.setdefault(agency, []).extend(documents)
+
+            if not complete:
+                break
+
+            expected_offset = last_offset
+
+    return winners_by_agency
+
+
+def _query_pool(workers: int) -> Any:
+    """
+    Process pool of the parallel scans. Scans run while the writer,
+    archiver and server threads are running, and forking a multithreaded
+    process may copy a lock held by another thread (e.g. a logging lock)
+    into the workers, so they are started from a forkserver instead
+    """
+    # The process pool is only imported by parallel scans, so it does not
+    # slow down the startup of the server
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    return ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context("forkserver")
+    )
+
+
+def query_logs_winners(
+    filepaths: list[str], number: int, workers: int = 1
+) -> dict[int, list[str]]:
+    """
+    Return the documents of the bets with the given number in every log,
+    grouped by agency in the order of the logs. With more than one worker
+    the logs are scanned whole by a single process pool shared by all of
+    them, instead of splitting each log among its own pool
+    """
+    if len(filepaths) == 1:
+        return query_winners(filepaths[0], number, workers)
+
+    if workers <= 1:
+        partial_results = [
+            _query_segment(filepath, number, 0, None) for filepath in filepaths
+        ]
+    else:
+        with _query_pool(workers) as executor:
+            partial_results = list(
+                executor.map(
+                    _query_segment,
+                    filepaths,
+                    repeat(number),
+                    repeat(0),
+                    repeat(None),
+                )
+            )
+
+    winners_by_agency: dict[int, list[str]] = {}
+    for partial_winners, *_ in partial_results:
+        for agency, documents in partial_winners.items():
+            winners_by_agency.setdefault(agency, []).extend(documents)
+
+    return winners_by_agency
+
+
+def export_csv(filepath: str, csv_filepath: str) -> None:
+    """
+    Export the bets log to a csv file with the fields of each bet
+    """
+    with open(csv_filepath, "w", newline="") as file:
+        writer = csv.writer(file, quoting=csv.QUOTE_MINIMAL)
+        for bet in read_bets(filepath):
+            writer.writerow(
+                [
+                    bet.agency,
+                    bet.first_name,
+                    bet.last_name,
+                    bet.document,
+                    bet.birthdate,
+                    bet.number,
+                ]
+            )
+
+
+class AgencyProgress:
+    """
+    Durable progress of an agency in a partitioned storage: sequence
+    number of its last persisted batch, amount of persisted bets, size of
+    its partition and whether it finished betting
+    """
+
+    last_sequence: int
+    bets: int
+    size: int
+    finished: bool
+
+    def __init__(self) -> None:
+        self.last_sequence = 0
+        self.bets = 0
+        self.size = 0
+        self.finished = False
+
+
+def encode_wal_entry(
+    kind: int, agency: int, sequence_number: int = 0, bets: int = 0, size: int = 0
+) -> bytes:
+    return _frame_record(WAL_ENTRY.pack(kind, agency, sequence_number, bets, size))
+
+
+def wal_filepath(dirpath: str) -> str:
+    return os.path.join(dirpath, WAL_FILENAME)
+
+
+def _read_wal(dirpath: str) -> dict[int, AgencyProgress]:
+    """
+    Replay the write-ahead log. Batches recorded beyond the current size
+    of their partition were not written before the crash, so they are
+    not part of the progress
+    """
+    progress: dict[int, AgencyProgress] = {}
+    partition_sizes: dict[int, int] = {
+        agency: os.path.getsize(partition)
+        for agency, partition in partition_filepaths(dirpath).items()
+    }
+
+    mapped_log: Optional[mmap.mmap] = _map_log(wal_filepath(dirpath))
+    if mapped_log is None:
+        return progress
+
+    try:
+        with memoryview(mapped_log) as buffer:
+            for offset in _scan_records(buffer, wal_filepath(dirpath)):
+                kind, agency, sequence_number, bets, size = WAL_ENTRY.unpack_from(
+                    buffer, offset
+                )
+                agency_progress = progress.setdefault(agency, AgencyProgress())
+
+                if kind == WAL_FINISH:
+                    agency_progress.finished = True
+                elif agency_progress.size < size <= partition_sizes.get(agency, 0):
+                    agency_progress.last_sequence = sequence_number
+                    agency_progress.bets += bets
+                    agency_progress.size = size
+    finally:
+        mapped_log.close()
+
+    return progress
+
+
+def _read_partitions(dirpath: str) -> dict[int, AgencyProgress]:
+    """
+    Progress of a storage without write-ahead log: every valid record of
+    the partitions is kept
+    """
+    progress: dict[int, AgencyProgress] = {}
+
+    for agency, partition in partition_filepaths(dirpath).items():
+        agency_progress = progress.setdefault(agency, AgencyProgress())
+
+        with BetColumns(partition) as columns:
+            agency_progress.bets = len(columns)
+            agency_progress.size = columns.last_offset
+
+    return progress
+
+
+def recover_storage(dirpath: str) -> dict[int, AgencyProgress]:
+    """
+    Bring a partitioned storage back to a consistent state after a crash
+    and return the progress of every agency. Partitions are truncated to
+    the last batch recorded by the write-ahead log (dropping torn
+    records), and the log is compacted to a single entry per agency
+    """
+    if not os.path.isdir(dirpath):
+        return {}
+
+    if os.path.exists(wal_filepath(dirpath)):
+        progress = _read_wal(dirpath)
+    else:
+        progress = _read_partitions(dirpath)
+
+    for agency, partition in partition_filepaths(dirpath).items():
+        size: int = progress[agency].size if agency in progress else 0
+
+        if os.path.getsize(partition) > size:
+            logging.warning(
+                f"action: recuperar_apuestas | result: success | agencia: {agency} | "
+                f"bytes_descartados: {os.path.getsize(partition) - size}"
+            )
+            os.truncate(partition, size)
+
+    compacted_filepath: str = wal_filepath(dirpath) + ".tmp"
+    with open(compacted_filepath, "wb") as file:
+        for agency, agency_progress in sorted(progress.items()):
+            file.write(
+                encode_wal_entry(
+                    WAL_BATCH,
+                    agency,
+                    agency_progress.last_sequence,
+                    agency_progress.bets,
+                    agency_progress.size,
+                )
+            )
+            if agency_progress.finished:
+                file.write(encode_wal_entry(WAL_FINISH, agency))
+
+        file.flush()
+        os.fsync(file.fileno())
+
+    os.replace(compacted_filepath, wal_filepath(dirpath))
+
+    return progress
+
+
+def partition_filepath(dirpath: str, agency: int) -> str:
+    return os.path.join(dirpath, PARTITION_FILENAME.format(agency=agency))
+
+
+def partition_filepaths(dirpath: str) -> dict[int, str]:
+    """
+    Return the bets log of every agency stored in the directory, sorted
+    by agency
+    """
+    if not os.path.isdir(dirpath):
+        return {}
+
+    partitions: dict[int, str] = {}
+    for filename in os.listdir(dirpath):
+        match = PARTITION_PATTERN.fullmatch(filename)
+        if match:
+            partitions[int(match.group(1))] = os.path.join(dirpath, filename)
+
+    return dict(sorted(partitions.items()))
+
+
+def merge_partitions(dirpath: str, filepath: str) -> int:
+    """
+    Compact the partitions of the directory into a single bets log with
+    the global view of the bets, agency by agency. Records are copied
+    without being decoded, up to the torn record of each partition (if
+    any). Return the number of merged bets
+    """
+    merged_bets: int = 0
+    merged_filepath: str = filepath + ".tmp"
+
+    with open(merged_filepath, "wb", buffering=STORAGE_BUFFER_SIZE) as file:
+        for partition in partition_filepaths(dirpath).values():
+            mapped_log: Optional[mmap.mmap] = _map_log(partition)
+            if mapped_log is None:
+                continue
+
+            try:
+                with memoryview(mapped_log) as buffer:
+                    end: int = 0
+                    for offset in _scan_records(buffer, partition):
+                        end = (
+                            offset
+                            + RECORD_HEADER.unpack_from(
+                                buffer, offset - RECORD_HEADER.size
+                            )[0]
+                        )
+                        merged_bets += 1
+
+                    file.write(buffer[:end])
+            finally:
+                mapped_log.close()
+
+        file.flush()
+        os.fsync(file.fileno())
+
+    # The global view is replaced atomically, so readers never see a
+    # partially merged log
+    os.replace(merged_filepath, filepath)
+
+    return merged_bets
+
+
+"""
+Every round of the lottery is stored in its own partitioned directory
+inside the storage directory. Once a round is drawn its partitions are
+merged into a single bets log of the archive and its directory removed.
+"""
+ROUND_DIRNAME = "round-{round_id}"
+ROUND_PATTERN = re.compile(r"round-(\d+)")
+ARCHIVE_DIRNAME = "archive"
+ARCHIVE_FILENAME = "round-{round_id}.log"
+ARCHIVE_PATTERN = re.compile(r"round-(\d+)\.log")
+
+
+def round_dirpath(dirpath: str, round_id: int) -> str:
+    return os.path.join(dirpath, ROUND_DIRNAME.format(round_id=round_id))
+
+
+def archive_filepath(dirpath: str, round_id: int) -> str:
+    return os.path.join(
+        dirpath, ARCHIVE_DIRNAME, ARCHIVE_FILENAME.format(round_id=round_id)
+    )
+
+
+def _matching_ids(dirpath: str, pattern: re.Pattern) -> list[int]:
+    if not os.path.isdir(dirpath):
+        return []
+
+    ids: list[int] = []
+    for filename in os.listdir(dirpath):
+        match = pattern.fullmatch(filename)
+        if match:
+            ids.append(int(match.group(1)))
+
+    return sorted(ids)
+
+
+def round_ids(dirpath: str) -> list[int]:
+    """
+    Return the rounds of the storage directory that were not archived yet,
+    sorted by id
+    """
+    return _matching_ids(dirpath, ROUND_PATTERN)
+
+
+def archived_round_ids(dirpath: str) -> list[int]:
+    return _matching_ids(os.path.join(dirpath, ARCHIVE_DIRNAME), ARCHIVE_PATTERN)
+
+
+def archive_round(dirpath: str, round_id: int) -> int:
+    """
+    Merge the partitions of a drawn round into its archived bets log and
+    remove the round directory. The archived log is replaced atomically,
+    so a round whose directory was left behind by a crash can be archived
+    again. Return the number of archived bets
+    """
+    os.makedirs(os.path.join(dirpath, ARCHIVE_DIRNAME), exist_ok=True)
+
+    archived_bets: int = merge_partitions(
+        round_dirpath(dirpath, round_id), archive_filepath(dirpath, round_id)
+    )
+    shutil.rmtree(round_dirpath(dirpath, round_id))
+
+    return archived_bets
+
+
+"""
+On a clean shutdown the state derived from the storage (progress of the
+agencies, winners index and winners of the last drawn round) is written
+to a snapshot, so the next start loads it instead of replaying the
+write-ahead log and scanning the partitions. A snapshot records the size
+of every file of its round and is removed once read, so it is never
+loaded for a storage that changed after it was taken.
+"""
+SNAPSHOT_FILENAME = "snapshot.json"
+
+
+def snapshot_filepath(dirpath: str) -> str:
+    return os.path.join(dirpath, SNAPSHOT_FILENAME)
+
+
+def file_sizes(dirpath: str) -> dict[str, int]:
+    """
+    Return the size of every file of the directory, by filename
+    """
+    if not os.path.isdir(dirpath):
+        return {}
+
+    return {
+        filename: os.path.getsize(os.path.join(dirpath, filename))
+        for filename in sorted(os.listdir(dirpath))
+    }
+
+
+def write_snapshot(dirpath: str, snapshot: dict[str, Any]) -> None:
+    """
+    Write the snapshot of the storage directory. It is replaced
+    atomically, so a crash while writing it never leaves a partial one
+    """
+    filepath: str = snapshot_filepath(dirpath)
+
+    with open(filepath + ".tmp", "w", encoding="utf-8") as file:
+        json.dump(snapshot, file)
+        file.flush()
+        os.fsync(file.fileno())
+
+    os.replace(filepath + ".tmp", filepath)
+
+
+def load_snapshot(dirpath: str) -> Optional[dict[str, Any]]:
+    """
+    Read and remove the snapshot of the storage directory. Return None if
+    there is no snapshot or it can not be read
+    """
+    filepath: str = snapshot_filepath(dirpath)
+
+    try:
+        with open(filepath, encoding="utf-8") as file:
+            snapshot: Optional[dict[str, Any]] = json.load(file)
+    except FileNotFoundError:
+        return None
+    except ValueError as e:
+        logging.warning(f"action: cargar_snapshot | result: fail | error: {e}")
+        snapshot = None
+
+    os.remove(filepath)
+
+    return snapshot
+
+
+""" Bets logs opened by store_bets, by filepath. """
+_bet_logs: dict[str, BetLog] = {}
+
+
+def open_bet_log(filepath: str) -> BetLog:
+    if filepath not in _bet_logs:
+        _bet_logs[filepath] = BetLog(filepath)
+
+    return _bet_logs[filepath]
+
+
+def flush_bet_log(filepath: str) -> None:
+    if filepath in _bet_logs:
+        _bet_logs[filepath].flush()
+
+
+def close_bet_logs() -> None:
+    for bet_log in _bet_logs.values():
+        bet_log.close()
+
+    _bet_logs.clear()
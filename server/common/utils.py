@@ -1,9 +1,11 @@
-import csv
 import datetime
-
+from array import array
+from typing import Iterable, Iterator, Optional, Union
 
 """ Bets storage location. """
-STORAGE_FILEPATH = "./bets.csv"
+STORAGE_FILEPATH = "./bets.log"
+""" Directory of the bets storage partitioned by agency. """
+STORAGE_DIRPATH = "./bets"
 """ Simulated winner number in the lottery contest. """
 LOTTERY_WINNER_NUMBER = 7574
 
@@ -12,65 +14,196 @@ LOTTERY_WINNER_NUMBER = 7574
 
 
 class Bet:
+    __slots__ = (
+        "agency",
+        "first_name",
+        "last_name",
+        "document",
+        "_birthdate",
+        "number",
+    )
+
     def __init__(
         self,
         agency: str,
         first_name: str,
         last_name: str,
         document: str,
-        birthdate: str,
+        birthdate: Union[str, datetime.date],
         number: str,
     ):
         """
         agency must be passed with integer format.
-        birthdate must be passed with format: 'YYYY-MM-DD'.
+        birthdate must be passed with format: 'YYYY-MM-DD' (or as a date),
+        it is only parsed the first time it is accessed.
         number must be passed with integer format.
         """
         self.agency = int(agency)
         self.first_name = first_name
         self.last_name = last_name
         self.document = document
-        self.birthdate = datetime.date.fromisoformat(birthdate)
+        self._birthdate = birthdate
         self.number = int(number)
 
+    @property
+    def birthdate(self) -> datetime.date:
+        if isinstance(self._birthdate, str):
+            self._birthdate = datetime.date.fromisoformat(self._birthdate)
+
+        return self._birthdate
+
+
+"""
+The bets of a single agency batch kept as parallel arrays, so no Bet
+object is built while the batch is decoded, persisted and checked for
+winners. Birthdates are kept as proleptic Gregorian ordinals.
+"""
+
+
+class BetBatch:
+    __slots__ = (
+        "agency",
+        "first_names",
+        "last_names",
+        "documents",
+        "birthdates",
+        "numbers",
+        "sequence_number",
+        "batch_key",
+    )
+
+    def __init__(self, agency: int, sequence_number: int = 0):
+        self.agency = agency
+        self.sequence_number = sequence_number
+        self.batch_key: Optional[int] = None
+        self.first_names: list[str] = []
+        self.last_names: list[str] = []
+        self.documents: list[str] = []
+        self.birthdates = array("I")
+        self.numbers = array("I")
+
+    def append(
+        self,
+        first_name: str,
+        last_name: str,
+        document: str,
+        birthdate: str,
+        number: str,
+    ) -> None:
+        """
+        birthdate must be passed with format: 'YYYY-MM-DD'.
+        number must be passed with integer format.
+        """
+        self.append_fields(
+            first_name,
+            last_name,
+            document,
+            datetime.date.fromisoformat(birthdate).toordinal(),
+            int(number),
+        )
+
+    def append_fields(
+        self,
+        first_name: str,
+        last_name: str,
+        document: str,
+        birthdate: int,
+        number: int,
+    ) -> None:
+        """
+        Append an already parsed bet, birthdate must be passed as an ordinal.
+        """
+        try:
+            self.numbers.append(number)
+        except OverflowError:
+            raise ValueError("Invalid number")
+
+        self.birthdates.append(birthdate)
+        self.first_names.append(first_name)
+        self.last_names.append(last_name)
+        self.documents.append(document)
 
-""" Checks whether a bet won the prize or not. """
+    def extend_fields(
+        self,
+        first_names: Iterable[str],
+        last_names: Iterable[str],
+        documents: Iterable[str],
+        birthdates: Iterable[int],
+        numbers: Iterable[int],
+    ) -> None:
+        """
+        Append already parsed columns of bets, birthdates must be passed
+        as ordinals.
+        """
+        try:
+            parsed_numbers = array("I", numbers)
+        except OverflowError:
+            raise ValueError("Invalid number")
+        parsed_birthdates = array("I", birthdates)
+
+        self.numbers.extend(parsed_numbers)
+        self.birthdates.extend(parsed_birthdates)
+        self.first_names.extend(first_names)
+        self.last_names.extend(last_names)
+        self.documents.extend(documents)
+
+    def __len__(self) -> int:
+        return len(self.numbers)
+
+    def __iter__(self) -> Iterator[Bet]:
+        for i in range(len(self)):
+            yield Bet(
+                self.agency,
+                self.first_names[i],
+                self.last_names[i],
+                self.documents[i],
+                datetime.date.fromordinal(self.birthdates[i]),
+                self.numbers[i],
+            )
 
 
-def has_won(bet: Bet) -> bool:
+""" Checks whether a bet won the prize or not. A batch is checked straight
+from its numbers array, returning whether each of its bets won. """
+
+
+def has_won(bet: Union[Bet, BetBatch]) -> Union[bool, list[bool]]:
+    if isinstance(bet, BetBatch):
+        return [number == LOTTERY_WINNER_NUMBER for number in bet.numbers]
+
     return bet.number == LOTTERY_WINNER_NUMBER
 
 
+""" Documents of the bets of the batch that won the prize. """
+
+
+def winning_documents(batch: BetBatch) -> list[str]:
+    return [document for document, won in zip(batch.documents, has_won(batch)) if won]
+
+
 """
-Persist the information of each bet in the STORAGE_FILEPATH file.
+Persist the information of each bet in the STORAGE_FILEPATH file
+(or the given filepath) through a long-lived buffered bets log.
 Not thread-safe/process-safe.
 """
 
 
-def store_bets(bets: list[Bet]) -> None:
-    with open(STORAGE_FILEPATH, "a+") as file:
-        writer = csv.writer(file, quoting=csv.QUOTE_MINIMAL)
-        for bet in bets:
-            writer.writerow(
-                [
-                    bet.agency,
-                    bet.first_name,
-                    bet.last_name,
-                    bet.document,
-                    bet.birthdate,
-                    bet.number,
-                ]
-            )
+def store_bets(
+    bets: Union[list[Bet], BetBatch], filepath: str = STORAGE_FILEPATH
+) -> None:
+    from common.storage import open_bet_log
+
+    open_bet_log(filepath).append(bets)
 
 
 """
-Loads the information all the bets in the STORAGE_FILEPATH file.
+Loads the information all the bets in the STORAGE_FILEPATH file
+(or the given filepath).
 Not thread-safe/process-safe.
 """
 
 
-def load_bets() -> list[Bet]:
-    with open(STORAGE_FILEPATH, "r") as file:
-        reader = csv.reader(file, quoting=csv.QUOTE_MINIMAL)
-        for row in reader:
-            yield Bet(row[0], row[1], row[2], row[3], row[4], row[5])
+def load_bets(filepath: str = STORAGE_FILEPATH) -> list[Bet]:
+    from common.storage import flush_bet_log, read_bets
+
+    flush_bet_log(filepath)
+    yield from read_bets(filepath)
@@ -0,0 +1,277 @@
+import os
+import queue
+import signal
+import logging
+import threading
+import multiprocessing
+from typing import Any, Callable
+
+from common.lottery import Lottery
+from common.metrics import MetricsServer
+from common.utils import LOTTERY_WINNER_NUMBER
+from common.storage import archive_filepath, query_logs_winners
+
+""" Bets storage directory of each worker shard. """
+SHARD_STORAGE_DIRPATH = "./bets-{shard}"
+COORDINATION_TIMEOUT = 1.0
+
+""" Coordination messages exchanged between the pool and its workers. """
+FINISH = "finish"
+READY = "ready"
+DRAW = "draw"
+WINNERS = "winners"
+RESULTS = "results"
+STOP = "stop"
+
+
+class ShardLottery(Lottery):
+    """
+    Lottery of a single worker process. Bets are persisted in the shard
+    storage of the worker, while agencies readiness and the draw are
+    coordinated by the WorkerPool through the inbox/outbox queues.
+
+    A shard is not resumable: the connections of an agency are accepted
+    by any worker, so the progress of a single shard is not the progress
+    of the agency and resuming from it would store bets twice.
+    """
+
+    _shard: int
+    _shards: int
+    _inbox: multiprocessing.Queue
+    _outbox: multiprocessing.Queue
+
+    def __init__(
+        self,
+        number_agencies: int,
+        shard: int,
+        shards: int,
+        inbox: multiprocessing.Queue,
+        outbox: multiprocessing.Queue,
+        **lottery_options: Any,
+    ) -> None:
+        self._shard = shard
+        self._shards = shards
+        self._inbox = inbox
+        self._outbox = outbox
+        super().__init__(
+            number_agencies,
+            SHARD_STORAGE_DIRPATH.format(shard=shard),
+            **lottery_options,
+        )
+        self.resumable = False
+
+    def finish_betting(self, agency_id: int) -> None:
+        with self._lock:
+            if agency_id in self._agencies_ready:
+                return
+
+        self._sync_bets(agency_id, finish=True)
+
+        with self._lock:
+            if agency_id in self._agencies_ready:
+                return
+            self._agencies_ready.add(agency_id)
+
+        self._outbox.put((FINISH, agency_id))
+
+    def _resume_round(self) -> None:
+        # The draw is coordinated by the pool, so it is only notified of
+        # the agencies that had finished betting in this shard
+        with self._lock:
+            agencies_ready: list[int] = sorted(self._agencies_ready)
+
+        for agency_id in agencies_ready:
+            self._outbox.put((FINISH, agency_id))
+
+    def _load_winners(self, round_id: int) -> dict[int, list[str]]:
+        # Agencies may connect to any worker, so the winners of an archived
+        # round are merged from the archives of every shard
+        filepaths: list[str] = [
+            archive_filepath(SHARD_STORAGE_DIRPATH.format(shard=shard), round_id)
+            for shard in range(self._shards)
+        ]
+
+        return query_logs_winners(
+            [filepath for filepath in filepaths if os.path.exists(filepath)],
+            LOTTERY_WINNER_NUMBER,
+            self._draw_workers,
+        )
+
+    def listen(self) -> None:
+        """
+        Process the coordination messages sent by the pool until it asks
+        the worker to stop
+        """
+        while True:
+            kind, payload = self._inbox.get()
+
+            if kind == READY:
+                with self._lock:
+                    self._agencies_ready.add(payload)
+            elif kind == DRAW:
+                with self._lock:
+                    winners = self._collect_winners()
+                self._outbox.put((WINNERS, (self._shard, winners)))
+            elif kind == RESULTS:
+                self._publish_winners(payload)
+            elif kind == STOP:
+                return
+
+
+def _run_worker(
+    shard: int,
+    shards: int,
+    port: int,
+    listen_backlog: int,
+    number_agencies: int,
+    server_class: Callable[..., Any],
+    inbox: multiprocessing.Queue,
+    outbox: multiprocessing.Queue,
+    lottery_options: dict[str, Any],
+    server_options: dict[str, Any],
+    metrics_port: int,
+) -> None:
+    if metrics_port:
+        # Every worker exposes the metrics of its own process
+        MetricsServer(metrics_port + shard).start()
+
+    lottery = ShardLottery(
+        number_agencies, shard, shards, inbox, outbox, **lottery_options
+    )
+    server = server_class(
+        port, listen_backlog, lottery, reuse_port=True, **server_options
+    )
+
+    signal.signal(signal.SIGTERM, server.stop)
+    signal.signal(signal.SIGINT, server.stop)
+
+    threading.Thread(target=lottery.listen, daemon=True).start()
+
+    server.run()
+
+
+class WorkerPool:
+    """
+    Runs a server in each of the worker processes, all of them accepting
+    on the same port (SO_REUSEPORT) so each one parses and persists its
+    own shard of agencies. The pool tracks which agencies finished
+    betting and, once all of them did, merges the winners of every shard
+    and sends them back to the workers, which start the next round.
+    """
+
+    _port: int
+    _listen_backlog: int
+    _number_agencies: int
+    _server_class: Callable[..., Any]
+    _lottery_options: dict[str, Any]
+    _server_options: dict[str, Any]
+    _metrics_port: int
+    _running: bool
+    _events: multiprocessing.Queue
+    _inboxes: list[multiprocessing.Queue]
+    _workers: list[multiprocessing.Process]
+    _agencies_ready: set[int]
+    _shard_winners: dict[int, dict[int, list[str]]]
+
+    def __init__(
+        self,
+        port: int,
+        listen_backlog: int,
+        number_agencies: int,
+        server_class: Callable[..., Any],
+        workers: int,
+        lottery_options: dict[str, Any],
+        server_options: dict[str, Any],
+        metrics_port: int = 0,
+    ) -> None:
+        self._port = port
+        self._listen_backlog = listen_backlog
+        self._number_agencies = number_agencies
+        self._server_class = server_class
+        self._lottery_options = lottery_options
+        self._server_options = server_options
+        self._metrics_port = metrics_port
+        self._running = True
+        self._events = multiprocessing.Queue()
+        self._inboxes = [multiprocessing.Queue() for _ in range(workers)]
+        self._workers = []
+        self._agencies_ready = set()
+        self._shard_winners = {}
+
+    def run(self) -> None:
+        for shard, inbox in enumerate(self._inboxes):
+            worker = multiprocessing.Process(
+                target=_run_worker,
+                args=(
+                    shard,
+                    len(self._inboxes),
+                    self._port,
+                    self._listen_backlog,
+                    self._number_agencies,
+                    self._server_class,
+                    inbox,
+                    self._events,
+                    self._lottery_options,
+                    self._server_options,
+                    self._metrics_port,
+                ),
+            )
+            worker.start()
+            self._workers.append(worker)
+
+        logging.info(
+            f"action: start_workers | result: success | workers: {len(self._workers)}"
+        )
+
+        while self._running:
+            try:
+                kind, payload = self._events.get(timeout=COORDINATION_TIMEOUT)
+            except queue.Empty:
+                continue
+
+            if kind == FINISH:
+                self.__handle_finish_betting(payload)
+            elif kind == WINNERS:
+                self.__handle_shard_winners(*payload)
+
+        self.__cleanup()
+
+    def __handle_finish_betting(self, agency_id: int) -> None:
+        self.__broadcast(READY, agency_id)
+        self._agencies_ready.add(agency_id)
+
+        if len(self._agencies_ready) == self._number_agencies:
+            self.__broadcast(DRAW, None)
+
+    def __handle_shard_winners(self, shard: int, winners: dict[int, list[str]]) -> None:
+        self._shard_winners[shard] = winners
+
+        if len(self._shard_winners) < len(self._workers):
+            return
+
+        winners_by_agency: dict[int, list[str]] = {
+            agency: [] for agency in self._agencies_ready
+        }
+        for shard in sorted(self._shard_winners):
+            for agency, documents in self._shard_winners[shard].items():
+                winners_by_agency.setdefault(agency, []).extend(documents)
+
+        self.__broadcast(RESULTS, winners_by_agency)
+        self._agencies_ready = set()
+        self._shard_winners = {}
+
+    def __broadcast(self, kind: str, payload: Any) -> None:
+        for inbox in self._inboxes:
+            inbox.put((kind, payload))
+
+    def __cleanup(self) -> None:
+        self.__broadcast(STOP, None)
+
+        for worker in self._workers:
+            worker.join()
+
+    def stop(self, _signum: int, _frame: str) -> None:
+        self._running = False
+
+        for worker in self._workers:
+            worker.terminate()
@@ -1,11 +1,31 @@
 #!/usr/bin/env python3
 
+import time
+
+# Taken before the rest of the imports, so the startup report includes them
+STARTUP_TIME = time.perf_counter()
+
 from configparser import ConfigParser
-from common.server import Server
+from common.lottery import Lottery
+from common.storage import FsyncPolicy
+from common.metrics import MetricsServer
 import logging
 import os
 import signal
 
+SERVER_MODES = ("threads", "asyncio")
+
+
+def config_value(config, key):
+    """
+    Value of a config param from the environment variables, or from the
+    config file if it is not set
+    """
+    if key in os.environ:
+        return os.environ[key]
+
+    return config["DEFAULT"][key]
+
 
 def initialize_config():
     """Parse env variables or config file to find program config params
@@ -18,27 +38,64 @@ def initialize_config():
     with config parameters
     """
 
-    config = ConfigParser(os.environ)
+    # Environment variables are looked up by config_value, so they are not
+    # copied into the parser defaults
+    config = ConfigParser()
     # If config.ini does not exists original config object is not modified
     config.read("config.ini")
 
     config_params = {}
     try:
-        config_params["port"] = int(
-            os.getenv("SERVER_PORT", config["DEFAULT"]["SERVER_PORT"])
-        )
+        config_params["port"] = int(config_value(config, "SERVER_PORT"))
         config_params["listen_backlog"] = int(
-            os.getenv(
-                "SERVER_LISTEN_BACKLOG", config["DEFAULT"]["SERVER_LISTEN_BACKLOG"]
-            )
-        )
-        config_params["logging_level"] = os.getenv(
-            "LOGGING_LEVEL", config["DEFAULT"]["LOGGING_LEVEL"]
+            config_value(config, "SERVER_LISTEN_BACKLOG")
         )
+        config_params["logging_level"] = config_value(config, "LOGGING_LEVEL")
+
+        config_params["number_agencies"] = int(config_value(config, "NUMBER_AGENCIES"))
 
-        config_params["number_agencies"] = int(
-            os.getenv("NUMBER_AGENCIES", config["DEFAULT"]["NUMBER_AGENCIES"])
+        config_params["server_mode"] = config_value(config, "SERVER_MODE")
+        if config_params["server_mode"] not in SERVER_MODES:
+            raise ValueError(f"invalid server mode {config_params['server_mode']}")
+
+        config_params["workers"] = int(config_value(config, "SERVER_WORKERS"))
+
+        config_params["buffer_size"] = int(config_value(config, "SOCKET_BUFFER_SIZE"))
+
+        config_params["fsync_policy"] = FsyncPolicy(
+            config_value(config, "STORAGE_FSYNC")
+        )
+        config_params["fsync_interval"] = (
+            int(config_value(config, "STORAGE_FSYNC_INTERVAL_MS")) / 1000
+        )
+        config_params["results_timeout"] = (
+            int(config_value(config, "RESULTS_TIMEOUT_MS")) / 1000
+        )
+        config_params["ingestion_queue_size"] = int(
+            config_value(config, "INGESTION_QUEUE_SIZE")
+        )
+        config_params["draw_workers"] = int(config_value(config, "DRAW_WORKERS"))
+        config_params["storage_writers"] = int(config_value(config, "STORAGE_WRITERS"))
+        config_params["duplicates_window"] = int(
+            config_value(config, "DUPLICATES_WINDOW")
+        )
+        config_params["metrics_port"] = int(config_value(config, "METRICS_PORT"))
+        config_params["max_connections"] = int(config_value(config, "MAX_CONNECTIONS"))
+        config_params["agency_bets_rate"] = float(
+            config_value(config, "AGENCY_BETS_PER_SECOND")
+        )
+        config_params["agency_bytes_rate"] = float(
+            config_value(config, "AGENCY_BYTES_PER_SECOND")
+        )
+        config_params["session_idle_timeout"] = (
+            int(config_value(config, "SESSION_IDLE_TIMEOUT_MS")) / 1000
         )
+        config_params["handler_threads"] = int(
+            config_value(config, "ASYNC_HANDLER_THREADS")
+        )
+        config_params["startup_snapshot"] = config_value(
+            config, "STARTUP_SNAPSHOT"
+        ).lower() in ("1", "true", "yes")
     except KeyError as e:
         raise KeyError("Key was not found. Error: {} .Aborting server".format(e))
     except ValueError as e:
@@ -49,12 +106,52 @@ def initialize_config():
     return config_params
 
 
+def load_server_class(server_mode):
+    """
+    Import only the server of the configured mode, since asyncio is
+    expensive to import and most deployments run the threaded server
+    """
+    if server_mode == "asyncio":
+        from common.async_server import AsyncServer
+
+        return AsyncServer
+
+    from common.server import Server
+
+    return Server
+
+
 def main():
+    phases = {"importar": time.perf_counter() - STARTUP_TIME}
+    phase_start = time.perf_counter()
+
     config_params = initialize_config()
     logging_level = config_params["logging_level"]
     port = config_params["port"]
     listen_backlog = config_params["listen_backlog"]
     number_agencies = config_params["number_agencies"]
+    server_mode = config_params["server_mode"]
+    workers = config_params["workers"]
+    metrics_port = config_params["metrics_port"]
+    server_options = {
+        "buffer_size": config_params["buffer_size"],
+        "max_connections": config_params["max_connections"],
+        "agency_bets_rate": config_params["agency_bets_rate"],
+        "agency_bytes_rate": config_params["agency_bytes_rate"],
+        "session_idle_timeout": config_params["session_idle_timeout"],
+    }
+    if server_mode == "asyncio":
+        server_options["handler_threads"] = config_params["handler_threads"]
+    lottery_options = {
+        "fsync_policy": config_params["fsync_policy"],
+        "fsync_interval": config_params["fsync_interval"],
+        "results_timeout": config_params["results_timeout"],
+        "ingestion_queue_size": config_params["ingestion_queue_size"],
+        "draw_workers": config_params["draw_workers"],
+        "storage_writers": config_params["storage_writers"],
+        "duplicates_window": config_params["duplicates_window"],
+        "startup_snapshot": config_params["startup_snapshot"],
+    }
 
     initialize_log(logging_level)
 
@@ -62,18 +159,69 @@ def main():
     # of the component
     logging.debug(
         f"action: config | result: success | port: {port} | "
-        f"listen_backlog: {listen_backlog} | logging_level: {logging_level}"
+        f"listen_backlog: {listen_backlog} | logging_level: {logging_level} | "
+        f"server_mode: {server_mode} | workers: {workers} | "
+        f"fsync_policy: {config_params['fsync_policy'].value}"
     )
+    phase_start = record_phase(phases, "configurar", phase_start)
 
     # Initialize server and start server loop
-    server = Server(port, listen_backlog, number_agencies)
+    if workers > 1:
+        # Every worker recovers its own shard, so the recovery of the
+        # storage is reported by the workers
+        from common.worker_pool import WorkerPool
+
+        server = WorkerPool(
+            port,
+            listen_backlog,
+            number_agencies,
+            load_server_class(server_mode),
+            workers,
+            lottery_options,
+            server_options,
+            metrics_port,
+        )
+    else:
+        if metrics_port:
+            MetricsServer(metrics_port).start()
+
+        lottery = Lottery(number_agencies, **lottery_options)
+        phase_start = record_phase(phases, "recuperar", phase_start)
+        server_class = load_server_class(server_mode)
+        server = server_class(port, listen_backlog, lottery, **server_options)
+    record_phase(phases, "servidor", phase_start)
 
     signal.signal(signal.SIGTERM, server.stop)
     signal.signal(signal.SIGINT, server.stop)
 
+    log_startup(phases)
     server.run()
 
 
+def record_phase(phases, name, phase_start):
+    """
+    Record the duration of a startup phase and return the start of the next
+    one
+    """
+    now = time.perf_counter()
+    phases[name] = now - phase_start
+    return now
+
+
+def log_startup(phases):
+    """
+    Log how long each startup phase took, from the start of the process
+    until the server is ready to accept connections
+    """
+    report = " | ".join(
+        f"{name}_ms: {seconds * 1000:.1f}" for name, seconds in phases.items()
+    )
+    logging.info(
+        f"action: inicio | result: success | {report} | "
+        f"total_ms: {(time.perf_counter() - STARTUP_TIME) * 1000:.1f}"
+    )
+
+
 def initialize_log(logging_level):
     """
     Python custom logging initialization
@@ -1,10 +1,45 @@
 from common.utils import *
+from common.lottery import Lottery
+from common.worker_pool import FINISH, SHARD_STORAGE_DIRPATH, ShardLottery, WorkerPool
+from common.server import Server
+from common.async_server import AsyncServer
+from common.agency_session import AgencySession, SessionRegistry
+from common.admission import AdmissionController
+from common.fair_queue import FairQueue
+from common.communication.client_socket import ClientSocket
+from benchmarks.agencies import parse_args, run_benchmark
+from common.metrics import Counter, Histogram, MetricsServer, Registry
+from common.storage import (
+    BetLog,
+    FsyncPolicy,
+    PartitionedBetLog,
+    archive_filepath,
+    close_bet_logs,
+    encode_bet,
+    merge_partitions,
+    partition_filepath,
+    partition_filepaths,
+    query_logs_winners,
+    query_winners,
+    read_bets,
+    round_dirpath,
+    snapshot_filepath,
+    wal_filepath,
+)
 import os
+import queue
+import shutil
+import socket
+import struct
+import threading
+import time
 import unittest
+import zlib
 
 class TestUtils(unittest.TestCase):
 
     def tearDown(self):
+        close_bet_logs()
         if os.path.exists(STORAGE_FILEPATH):
             os.remove(STORAGE_FILEPATH)
 
@@ -25,6 +60,13 @@ class TestUtils(unittest.TestCase):
         b = Bet('1', 'first', 'last', 10000000,'2000-12-20', LOTTERY_WINNER_NUMBER + 1)
         self.assertFalse(has_won(b))
 
+    def test_has_won_checks_every_bet_of_a_batch(self):
+        batch = BetBatch(1)
+        batch.append('first', 'last', '10000000', '2000-12-20', LOTTERY_WINNER_NUMBER)
+        batch.append('first', 'last', '10000001', '2000-12-20', LOTTERY_WINNER_NUMBER + 1)
+        self.assertEqual([True, False], has_won(batch))
+        self.assertEqual(['10000000'], winning_documents(batch))
+
     def test_store_bets_and_load_bets_keeps_fields_data(self):
         to_store = [Bet('1', 'first', 'last', '10000000','2000-12-20', 7500)]
         store_bets(to_store)
@@ -46,6 +88,15 @@ class TestUtils(unittest.TestCase):
         self._assert_equal_bets(to_store[0], from_load[0])
         self._assert_equal_bets(to_store[1], from_load[1])
 
+    def test_store_bets_and_load_bets_keeps_batch_fields_data(self):
+        batch = BetBatch(1)
+        batch.append('first', 'last', '10000000','2000-12-20', 7500)
+        store_bets(batch)
+        from_load = list(load_bets())
+
+        self.assertEqual(1, len(from_load))
+        self._assert_equal_bets(next(iter(batch)), from_load[0])
+
     def _assert_equal_bets(self, b1, b2):
         self.assertEqual(b1.agency, b2.agency)
         self.assertEqual(b1.first_name, b2.first_name)
@@ -54,6 +105,814 @@ class TestUtils(unittest.TestCase):
         self.assertEqual(b1.birthdate, b2.birthdate)
         self.assertEqual(b1.number, b2.number)
 
+
+class TestClientSocket(unittest.TestCase):
+
+    def setUp(self):
+        self.peer, server_side = socket.socketpair()
+        self.client_socket = ClientSocket(server_side, ('', 0), buffer_size=16)
+
+    def tearDown(self):
+        self.peer.close()
+        self.client_socket.close()
+
+    def test_receive_messages_returns_every_complete_frame(self):
+        self.peer.sendall(b'first\nsecond\nthi')
+        self.assertEqual(['first', 'second'], self.client_socket.receive_messages())
+
+        self.peer.sendall(b'rd\n')
+        self.assertEqual('third', self.client_socket.receive_message())
+
+    def test_receive_message_frames_split_across_reads(self):
+        self.peer.sendall(b'first\n0123456789')
+        self.assertEqual('first', self.client_socket.receive_message())
+
+        self.peer.sendall(b'abcd\n')
+        self.assertEqual('0123456789abcd', self.client_socket.receive_message())
+
+    def test_send_messages_coalesces_every_message(self):
+        self.client_socket.send_messages(['success:', 'success:', 'winners:1,2'])
+        self.assertEqual(b'success:\nsuccess:\nwinners:1,2\n', self.peer.recv(1024))
+
+    def test_receive_message_larger_than_buffer_fails(self):
+        self.peer.sendall(b'0123456789abcdefg\n')
+        with self.assertRaises(ValueError):
+            self.client_socket.receive_message()
+
+    def test_compressed_messages_are_decompressed_in_both_directions(self):
+        self.client_socket.use_compression()
+        compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+        decompressor = zlib.decompressobj(wbits=-zlib.MAX_WBITS)
+
+        for data in [b'first\nsec', b'ond\n']:
+            compressed = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            self.peer.sendall(compressed)
+        self.assertEqual('first', self.client_socket.receive_message())
+        self.assertEqual('second', self.client_socket.receive_message())
+
+        self.client_socket.send_messages(['winners:1,2', 'winners:1,2'])
+        self.assertEqual(
+            b'winners:1,2\nwinners:1,2\n', decompressor.decompress(self.peer.recv(1024))
+        )
+
+    def test_length_prefixed_frames_larger_than_buffer_fit_once_grown(self):
+        frame = b'bulk_chunk:1#' + b'x' * 64
+        self.peer.sendall(b'bulk_upload:\n' + struct.pack('<I', len(frame)))
+        self.assertEqual('bulk_upload:', self.client_socket.receive_message())
+
+        self.client_socket.use_length_prefixed_frames(buffer_size=128)
+        self.peer.sendall(frame)
+        self.assertEqual(frame, self.client_socket.receive_message())
+
+
+class TestStorage(unittest.TestCase):
+
+    def tearDown(self):
+        if os.path.exists(STORAGE_FILEPATH):
+            os.remove(STORAGE_FILEPATH)
+
+    def test_read_bets_stops_at_torn_record(self):
+        bets = [
+            Bet('1', 'first_0', 'last_0', '00000000','2000-12-20', 7500),
+            Bet('1', 'first_1', 'last_1', '00000001','2000-12-21', 7501),
+        ]
+        bet_log = BetLog(STORAGE_FILEPATH)
+        bet_log.append(bets)
+        bet_log.close()
+
+        with open(STORAGE_FILEPATH, 'ab') as file:
+            file.write(encode_bet(bets[0])[:-3])
+
+        from_load = list(read_bets(STORAGE_FILEPATH))
+        self.assertEqual(['00000000', '00000001'], [b.document for b in from_load])
+
+    def test_interval_policy_syncs_once_the_oldest_record_is_due(self):
+        bet_log = BetLog(STORAGE_FILEPATH, FsyncPolicy.INTERVAL, 10.0)
+        self.addCleanup(bet_log.close)
+        self.assertIsNone(bet_log.sync_if_due(time.monotonic()))
+
+        bet_log.append([Bet('1', 'first', 'last', '00000000', '2000-12-20', 7500)])
+        deadline = bet_log.sync_if_due(time.monotonic())
+        self.assertIsNotNone(deadline)
+        self.assertEqual(deadline, bet_log.sync_if_due(time.monotonic()))
+        self.assertIsNone(bet_log.sync_if_due(deadline))
+        self.assertIsNone(bet_log.sync_if_due(deadline + 10.0))
+
+    def test_query_winners_groups_documents_by_agency(self):
+        bet_log = BetLog(STORAGE_FILEPATH)
+        bet_log.append([
+            Bet('1', 'first', 'last', '00000000','2000-12-20', 7500),
+            Bet('2', 'first', 'last', '00000001','2000-12-20', 7574),
+            Bet('1', 'first', 'last', '00000002','2000-12-20', 7574),
+            Bet('2', 'first', 'last', '00000003','2000-12-20', 7574),
+        ])
+        bet_log.close()
+
+        winners = query_winners(STORAGE_FILEPATH, 7574)
+        self.assertEqual({1: ['00000002'], 2: ['00000001', '00000003']}, winners)
+
+    def test_parallel_query_winners_matches_sequential_query(self):
+        bet_log = BetLog(STORAGE_FILEPATH)
+        bet_log.append([
+            Bet(str(i % 5 + 1), 'first', 'last', str(10000000 + i), '2000-12-20', 7574 - i % 3)
+            for i in range(1000)
+        ])
+        bet_log.close()
+
+        with open(STORAGE_FILEPATH, 'r+b') as file:
+            file.seek(os.path.getsize(STORAGE_FILEPATH) // 2)
+            file.write(b'torn')
+
+        sequential = query_winners(STORAGE_FILEPATH, 7574)
+        parallel = query_winners(STORAGE_FILEPATH, 7574, workers=4)
+        self.assertEqual(list(sequential.items()), list(parallel.items()))
+        self.assertLess(sum(map(len, parallel.values())), 334)
+
+    def test_partitions_share_a_single_parallel_query(self):
+        bet_log = PartitionedBetLog(STORAGE_DIRPATH)
+        for agency in range(1, 4):
+            batch = BetBatch(agency)
+            for i in range(10):
+                batch.append('first', 'last', f'{agency}000000{i}', '2000-12-20', 7574 - i % 2)
+            bet_log.extend([batch])
+        bet_log.close()
+
+        partitions = list(partition_filepaths(STORAGE_DIRPATH).values())
+        sequential = query_logs_winners(partitions, 7574)
+        parallel = query_logs_winners(partitions, 7574, workers=2)
+        self.assertEqual(list(sequential.items()), list(parallel.items()))
+        self.assertEqual(['30000000', '30000002', '30000004', '30000006', '30000008'], parallel[3])
+        shutil.rmtree(STORAGE_DIRPATH)
+
+    def test_merge_partitions_builds_the_global_view_by_agency(self):
+        batches = [BetBatch(2), BetBatch(1), BetBatch(2)]
+        batches[0].append('first', 'last', '00000001','2000-12-20', 7574)
+        batches[1].append('first', 'last', '00000002','2000-12-20', 7500)
+        batches[2].append('first', 'last', '00000003','2000-12-20', 7574)
+        bet_log = PartitionedBetLog(STORAGE_DIRPATH)
+        bet_log.extend(batches)
+        bet_log.close()
+
+        self.assertEqual(3, merge_partitions(STORAGE_DIRPATH, STORAGE_FILEPATH))
+        documents = [bet.document for bet in load_bets()]
+        self.assertEqual(['00000002', '00000001', '00000003'], documents)
+        shutil.rmtree(STORAGE_DIRPATH)
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_metrics_are_rendered_in_prometheus_text_format(self):
+        registry = Registry()
+        batches = registry.register(Counter('batches_total', 'Batches', ('result',)))
+        latency = registry.register(Histogram('latency_seconds', 'Latency', (0.1, 1.0)))
+        batches.inc(2, 'success')
+        latency.observe(0.05)
+        latency.observe(0.5)
+
+        server = MetricsServer(0, registry)
+        server.start()
+        try:
+            with socket.create_connection(('127.0.0.1', server.port)) as conn:
+                conn.sendall(b'GET /metrics HTTP/1.0\r\n\r\n')
+                response = b''.join(iter(lambda: conn.recv(4096), b'')).decode()
+        finally:
+            server.stop()
+
+        self.assertIn('batches_total{result="success"} 2', response)
+        self.assertIn('latency_seconds_bucket{le="0.1"} 1', response)
+        self.assertIn('latency_seconds_bucket{le="+Inf"} 2', response)
+        self.assertIn('latency_seconds_count 2', response)
+
+
+class LotteryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.lotteries = []
+
+    def tearDown(self):
+        for lottery in self.lotteries:
+            lottery.close()
+        shutil.rmtree(STORAGE_DIRPATH, ignore_errors=True)
+
+    def open_lottery(self, *args, **kwargs):
+        lottery = Lottery(*args, **kwargs)
+        self.lotteries.append(lottery)
+        return lottery
+
+
+class TestLottery(LotteryTestCase):
+
+    def test_winners_are_indexed_when_bets_are_stored(self):
+        first_batch = BetBatch(1)
+        first_batch.append('first', 'last', '10000000','2000-12-20', LOTTERY_WINNER_NUMBER)
+        first_batch.append('first', 'last', '10000001','2000-12-20', LOTTERY_WINNER_NUMBER + 1)
+        second_batch = BetBatch(2)
+        second_batch.append('first', 'last', '10000002','2000-12-20', LOTTERY_WINNER_NUMBER)
+
+        lottery = self.open_lottery(2)
+        lottery.store_bets(first_batch)
+        lottery.store_bets(second_batch)
+        lottery.finish_betting(1)
+        self.assertIsNone(lottery.winners(1))
+
+        lottery.finish_betting(2)
+        self.assertEqual(['10000000'], lottery.winners(1))
+        self.assertEqual(['10000002'], lottery.winners(2))
+
+    def test_queued_bets_are_persisted_when_agency_finishes(self):
+        lottery = self.open_lottery(1, ingestion_queue_size=2)
+        for document in range(10000000, 10000010):
+            batch = BetBatch(1)
+            batch.append('first', 'last', str(document), '2000-12-20', LOTTERY_WINNER_NUMBER)
+            lottery.store_bets(batch)
+
+        lottery.finish_betting(1)
+        self.assertEqual(10, len(lottery.winners(1)))
+        lottery.close()
+        bets = read_bets(archive_filepath(STORAGE_DIRPATH, 1))
+        documents = [bet.document for bet in bets]
+        self.assertEqual([str(d) for d in range(10000000, 10000010)], documents)
+
+    def test_readiness_and_progress_are_recovered_after_a_crash(self):
+        lottery = self.open_lottery(2)
+        for agency, sequence_number in [(1, 1), (2, 1), (2, 2)]:
+            batch = BetBatch(agency, sequence_number)
+            batch.append('first', 'last', f'1000000{sequence_number}', '2000-12-20', LOTTERY_WINNER_NUMBER)
+            lottery.store_bets(batch)
+        lottery.finish_betting(1)
+        lottery.close()
+
+        partition = partition_filepath(round_dirpath(STORAGE_DIRPATH, 1), 2)
+        with open(partition, 'ab') as file:
+            file.write(b'torn record')
+
+        lottery = self.open_lottery(2)
+        self.assertTrue(lottery.has_finished(1))
+        self.assertFalse(lottery.has_finished(2))
+        progress = lottery.resume_point(2)
+        self.assertEqual((2, 2), (progress.last_sequence, progress.bets))
+        self.assertEqual(progress.size, os.path.getsize(partition))
+
+        lottery.finish_betting(2)
+        lottery.close()
+        self.assertEqual(['10000001', '10000002'], self.open_lottery(2).winners(2))
+
+    def test_batches_that_can_not_be_persisted_fail_the_next_sync(self):
+        lottery = self.open_lottery(1)
+        stored = BetBatch(1, 1)
+        stored.append('first', 'last', '10000000', '2000-12-20', LOTTERY_WINNER_NUMBER)
+        lottery.store_bets(stored)
+        lottery.flush_bets(1)
+
+        # Names are stored with a u16 size, so the writer fails to encode it
+        too_long = BetBatch(1, 2)
+        too_long.append('é' * 40000, 'last', '10000001', '2000-12-20', LOTTERY_WINNER_NUMBER)
+        dropped = BetBatch(1, 3)
+        dropped.append('first', 'last', '10000002', '2000-12-20', LOTTERY_WINNER_NUMBER)
+        with self.assertLogs(level='ERROR'), self.assertRaises(OSError):
+            lottery.store_bets(too_long)
+            lottery.store_bets(dropped)
+            lottery.finish_betting(1)
+        self.assertFalse(lottery.has_finished(1))
+        self.assertEqual(1, lottery.resume_point(1).last_sequence)
+
+        lottery.finish_betting(1)
+        self.assertEqual(['10000000'], lottery.winners(1))
+
+    def test_key_of_a_batch_that_can_not_be_persisted_is_forgotten(self):
+        lottery = self.open_lottery(1)
+        too_long = BetBatch(1, 1)
+        too_long.append('é' * 40000, 'last', '10000000', '2000-12-20', LOTTERY_WINNER_NUMBER)
+        dropped = BetBatch(1, 2)
+        dropped.append('first', 'last', '10000001', '2000-12-20', LOTTERY_WINNER_NUMBER)
+        with self.assertLogs(level='ERROR'), self.assertRaises(OSError):
+            lottery.store_bets(too_long, batch_key=1)
+            lottery.store_bets(dropped, batch_key=2)
+            lottery.flush_bets(1)
+        self.assertFalse(lottery.is_duplicate(1, 1))
+        self.assertFalse(lottery.is_duplicate(1, 2))
+
+        retried = BetBatch(1, 2)
+        retried.append('first', 'last', '10000001', '2000-12-20', LOTTERY_WINNER_NUMBER)
+        lottery.store_bets(retried, batch_key=2)
+        lottery.flush_bets(1)
+        self.assertTrue(lottery.is_duplicate(1, 2))
+        lottery.finish_betting(1)
+        self.assertEqual(['10000001'], lottery.winners(1))
+
+    def test_quiet_logs_are_synced_by_their_writer_after_the_interval(self):
+        lottery = self.open_lottery(
+            1, fsync_policy=FsyncPolicy.INTERVAL, fsync_interval=0.05
+        )
+        batch = BetBatch(1, 1)
+        batch.append('first', 'last', '10000000', '2000-12-20', LOTTERY_WINNER_NUMBER)
+        lottery.store_bets(batch)
+
+        # Written right away, but only synced once the interval is over
+        lottery.resume_point(1)
+        partition = lottery._bet_log.partition(1)
+        deadline = time.monotonic() + 5
+        while partition.sync_if_due(0.0) is not None and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertIsNone(partition.sync_if_due(0.0))
+
+    def test_winners_index_is_recovered_from_storage(self):
+        batch = BetBatch(1)
+        batch.append('first', 'last', '10000000','2000-12-20', LOTTERY_WINNER_NUMBER)
+        bet_log = PartitionedBetLog(round_dirpath(STORAGE_DIRPATH, 1))
+        bet_log.extend([batch])
+        bet_log.close()
+
+        lottery = self.open_lottery(1)
+        lottery.finish_betting(1)
+        self.assertEqual(['10000000'], lottery.winners(1))
+
+    def test_next_round_starts_after_the_draw(self):
+        lottery = self.open_lottery(1)
+        for round_id, document in [(1, '10000000'), (2, '10000001')]:
+            self.assertEqual(round_id, lottery.round_id)
+            batch = BetBatch(1)
+            batch.append('first', 'last', document, '2000-12-20', LOTTERY_WINNER_NUMBER)
+            lottery.store_bets(batch)
+            lottery.finish_betting(1)
+            self.assertEqual([document], lottery.winners(1))
+
+        lottery.close()
+        self.assertFalse(os.path.exists(round_dirpath(STORAGE_DIRPATH, 1)))
+        archived = read_bets(archive_filepath(STORAGE_DIRPATH, 1))
+        self.assertEqual(['10000000'], [bet.document for bet in archived])
+        self.assertEqual(3, self.open_lottery(1).round_id)
+
+    def test_finishing_again_does_not_draw_twice(self):
+        lottery = self.open_lottery(2)
+        lottery.finish_betting(1)
+        lottery.finish_betting(1)
+        self.assertEqual(1, lottery.round_id)
+        self.assertIsNone(lottery.winners(1))
+
+        lottery.finish_betting(2)
+        self.assertEqual(2, lottery.round_id)
+        self.assertEqual([], lottery.winners(2))
+
+    def test_finished_archivers_are_dropped_when_a_round_is_drawn(self):
+        lottery = self.open_lottery(1)
+        for _ in range(3):
+            lottery.finish_betting(1)
+            for archiver in lottery._archivers:
+                archiver.join()
+
+        self.assertEqual(4, lottery.round_id)
+        self.assertEqual(1, len(lottery._archivers))
+
+    def test_state_is_loaded_from_the_snapshot_taken_on_close(self):
+        lottery = self.open_lottery(2, startup_snapshot=True)
+        batch = BetBatch(1, 1)
+        batch.append('first', 'last', '10000001', '2000-12-20', LOTTERY_WINNER_NUMBER)
+        lottery.store_bets(batch)
+        lottery.finish_betting(1)
+        lottery.close()
+        self.assertTrue(os.path.exists(snapshot_filepath(STORAGE_DIRPATH)))
+
+        lottery = self.open_lottery(2, startup_snapshot=True)
+        self.assertFalse(os.path.exists(snapshot_filepath(STORAGE_DIRPATH)))
+        self.assertTrue(lottery.has_finished(1))
+        self.assertEqual(1, lottery.resume_point(1).last_sequence)
+        lottery.finish_betting(2)
+        self.assertEqual(['10000001'], lottery.winners(1))
+        lottery.close()
+
+        # The storage changed after the snapshot, so it is recovered instead
+        with open(wal_filepath(round_dirpath(STORAGE_DIRPATH, 2)), 'ab') as file:
+            file.write(b'torn record')
+        with self.assertLogs(level='WARNING') as logs:
+            lottery = self.open_lottery(2, startup_snapshot=True)
+        self.assertIn('cargar_snapshot | result: fail', logs.output[0])
+        self.assertEqual(2, lottery.round_id)
+        self.assertEqual(['10000001'], lottery.winners(1))
+
+    def test_shard_notifies_the_agencies_that_finished_again_after_a_restart(self):
+        self.addCleanup(shutil.rmtree, SHARD_STORAGE_DIRPATH.format(shard=0), True)
+        outbox = queue.Queue()
+        shard = ShardLottery(2, 0, 1, queue.Queue(), outbox)
+        self.lotteries.append(shard)
+        batch = BetBatch(1, 1)
+        batch.append('first', 'last', '10000000', '2000-12-20', LOTTERY_WINNER_NUMBER)
+        shard.store_bets(batch)
+        shard.finish_betting(1)
+        self.assertEqual((FINISH, 1), outbox.get_nowait())
+        shard.close()
+
+        outbox = queue.Queue()
+        self.lotteries.append(ShardLottery(2, 0, 1, queue.Queue(), outbox))
+        self.assertEqual((FINISH, 1), outbox.get_nowait())
+        self.assertTrue(outbox.empty())
+
+    def test_fair_queue_serves_agencies_in_round_robin(self):
+        fair_queue = FairQueue(2)
+        for item, agency in [('1a', 1), ('1b', 1), ('stop', None), ('2a', 2)]:
+            fair_queue.put(item, agency)
+
+        self.assertTrue(fair_queue.full(1))
+        self.assertFalse(fair_queue.full(2))
+        self.assertEqual(['1a', '2a', '1b', 'stop'], [fair_queue.get() for _ in range(4)])
+
+class TestAgencySession(LotteryTestCase):
+
+    def test_sequenced_bet_batches_are_acknowledged_cumulatively(self):
+        session = AgencySession(self.open_lottery(1))
+        replies = session.handle_messages([
+            'agency:1',
+            'bet_batch_seq:1#first+last+10000000+2000-12-20+7500',
+            'bet_batch_seq:2#first+last+10000001+2000-12-20+7501',
+        ])
+        self.assertEqual(['ack:2'], replies)
+
+    def test_failed_sequenced_bet_batch_is_reported_by_sequence_number(self):
+        session = AgencySession(self.open_lottery(1))
+        replies = session.handle_messages([
+            'agency:1',
+            'bet_batch_seq:1#first+last+10000000+2000-12-20+7500',
+            'bet_batch_seq:2#first+last+10000001+2000-13-20+7501',
+            'bet_batch_seq:3#first+last+10000002+2000-12-20+7502',
+        ])
+        self.assertEqual(['ack:1', 'nack:2', 'ack:3'], replies)
+
+    def test_bet_batch_with_any_invalid_bet_fails_as_a_whole(self):
+        lottery = self.open_lottery(1)
+        session = AgencySession(lottery)
+        valid = 'first+last+10000000+2000-12-20+7574'
+        invalid_bets = [
+            'first+last+10000001+2000-12-20',
+            'first+last+1000000a+2000-12-20+7574',
+            'first+last+10000001+2000-12-20+-1',
+            'first+last+10000001+2000-12-20+4294967296',
+            'first+last+10000001+2000-02-30+7574',
+            '',
+        ]
+        session.handle_messages(['agency:1'])
+
+        for invalid in invalid_bets:
+            replies = session.handle_messages([f'bet_batch:{valid}*{invalid}'])
+            self.assertEqual(['failure:'], replies, invalid)
+
+        replies = session.handle_messages([f'bet_batch:{valid}*{valid}', 'finish:'])
+        self.assertEqual(['success:'], replies)
+        self.assertEqual(['10000000', '10000000'], lottery.winners(1))
+
+    def test_ids_and_fields_out_of_the_record_range_fail_at_decoding(self):
+        with self.assertRaises(ValueError):
+            AgencySession(self.open_lottery(1)).handle_messages(['agency:4294967296'])
+
+        lottery = self.open_lottery(1)
+        session = AgencySession(lottery)
+        session.handle_messages(['agency:1'])
+        with self.assertRaises(ValueError):
+            session.handle_messages(
+                ['bet_batch_seq:4294967296#first+last+10000000+2000-12-20+7500']
+            )
+
+        long_name = 'é' * 40000
+        replies = session.handle_messages([
+            f'bet_batch_seq:1#{long_name}+last+10000000+2000-12-20+7574',
+            f'bet_batch_seq:2#first+last+{"1" * 70000}+2000-12-20+7574',
+            'bet_batch_seq:3#first+last+10000001+2000-12-20+7574',
+            'finish:',
+        ])
+        self.assertEqual(['nack:1', 'nack:2', 'ack:3'], replies)
+        self.assertEqual(['10000001'], lottery.winners(1))
+
+    def test_bulk_upload_streams_chunks_and_acks_the_counts_at_the_end(self):
+        lottery = self.open_lottery(1)
+        session = AgencySession(lottery)
+        replies = session.handle_messages(['agency:1', 'bulk_upload:'])
+        self.assertEqual(['success:'], replies)
+        self.assertTrue(session.streaming)
+
+        replies = session.handle_messages([
+            b'bulk_chunk:1#first,last,10000000,2000-12-20,7574\n'
+            b'first,last,10000001,2000-12-20,7500',
+            b'bulk_chunk:2#first,last,10000002,2000-13-20,7574',
+            b'bulk_chunk:3#first,last,10000003,2000-12-20,7574',
+            b'bulk_end:',
+        ])
+        # The upload stops at the rejected chunk, so the agency resumes it
+        # right after the stored bets
+        self.assertEqual(['bulk_ack:2,2'], replies)
+        progress = lottery.resume_point(1)
+        self.assertEqual((1, 2), (progress.last_sequence, progress.bets))
+
+        session.handle_messages([b'finish:'])
+        self.assertEqual(['10000000'], lottery.winners(1))
+
+    def test_bulk_chunks_already_stored_are_not_counted_again(self):
+        lottery = self.open_lottery(1)
+        session = AgencySession(lottery)
+        chunk = b'bulk_chunk:1#first,last,10000000,2000-12-20,7574'
+        session.handle_messages(['agency:1', 'bulk_upload:'])
+        self.assertEqual(['bulk_ack:1,0'], session.handle_messages([chunk, b'bulk_end:']))
+
+        session.handle_messages([b'bulk_upload:'])
+        self.assertEqual(['bulk_ack:0,0'], session.handle_messages([chunk, b'bulk_end:']))
+
+    def test_bulk_records_with_fields_too_long_to_store_are_rejected(self):
+        lottery = self.open_lottery(1)
+        session = AgencySession(lottery)
+        session.handle_messages(['agency:1', 'bulk_upload:'])
+
+        long_name = ('a' * 70000).encode()
+        replies = session.handle_messages([
+            b'bulk_chunk:1#' + long_name + b',last,10000000,2000-12-20,7574\n'
+            b'first,last,10000001,2000-12-20,7574',
+            b'bulk_chunk:2#first,last,10000002,2000-12-20,7574',
+            b'bulk_end:',
+        ])
+        self.assertEqual(['bulk_ack:0,3'], replies)
+
+        session.handle_messages([b'finish:'])
+        self.assertEqual([], lottery.winners(1))
+
+    def test_bulk_chunks_wait_for_the_rate_limits_of_the_agency(self):
+        lottery = self.open_lottery(1)
+        session = AgencySession(lottery, AdmissionController(bets_rate=20))
+        session.handle_messages(['agency:1', 'bulk_upload:'])
+
+        chunk = b'\n'.join([b'first,last,10000000,2000-12-20,7500'] * 10)
+        start = time.monotonic()
+        replies = session.handle_messages([
+            b'bulk_chunk:1#' + chunk,
+            b'bulk_chunk:2#' + chunk.replace(b'7500', b'7501'),
+            b'bulk_chunk:3#' + chunk.replace(b'7500', b'7502'),
+            b'bulk_end:',
+        ])
+        self.assertEqual(['bulk_ack:30,0'], replies)
+        self.assertGreaterEqual(time.monotonic() - start, 0.4)
+
+    def test_binary_protocol_is_negotiated_at_identification(self):
+        session = AgencySession(self.open_lottery(1))
+        replies = session.handle_messages(['agency:1;binary;unknown'])
+        self.assertEqual(['success:binary'], replies)
+        self.assertTrue(session.binary)
+
+        name = 'first'.encode()
+        bet = struct.pack('<QIIB', 10000000, 7500, 20001220, len(name)) + name
+        bet += struct.pack('<B', len(name)) + name
+        frame = b'bet_batch_bin:' + struct.pack('<II', 7, 2) + bet + bet
+        self.assertEqual(['ack:7'], session.handle_messages([frame]))
+
+        invalid_frame = frame[:-1]
+        self.assertEqual(['nack:7'], session.handle_messages([invalid_frame]))
+
+    def test_compression_is_negotiated_at_identification(self):
+        session = AgencySession(self.open_lottery(1))
+        replies = session.handle_messages(['agency:1;zlib'])
+        self.assertEqual(['success:zlib'], replies)
+        self.assertTrue(session.compressed)
+
+    def test_stop_and_wait_bet_batches_keep_working(self):
+        session = AgencySession(self.open_lottery(1))
+        replies = session.handle_messages([
+            'agency:1',
+            'bet_batch:first+last+10000000+2000-12-20+7500',
+        ])
+        self.assertEqual(['success:'], replies)
+
+    def test_resume_reports_the_persisted_progress_of_the_agency(self):
+        lottery = self.open_lottery(1)
+        AgencySession(lottery).handle_messages([
+            'agency:1',
+            'bet_batch_seq:1#first+last+10000000+2000-12-20+7500',
+            'bet_batch_seq:2#first+last+10000001+2000-12-20+7501*first+last+10000002+2000-12-20+7502',
+        ])
+
+        replies = AgencySession(lottery).handle_messages(['agency:1;resume'])
+        self.assertEqual(['success:resume=2,3'], replies)
+
+    def test_resume_is_not_accepted_by_worker_shards(self):
+        self.addCleanup(shutil.rmtree, SHARD_STORAGE_DIRPATH.format(shard=0), True)
+        shard = ShardLottery(1, 0, 2, queue.Queue(), queue.Queue())
+        self.lotteries.append(shard)
+        replies = AgencySession(shard).handle_messages(['agency:1;resume;round'])
+        self.assertEqual(['success:round=1'], replies)
+
+    def test_round_is_reported_and_results_are_kept_after_the_draw(self):
+        lottery = self.open_lottery(1)
+        replies = AgencySession(lottery).handle_messages([
+            'agency:1;round',
+            f'bet_batch:first+last+10000000+2000-12-20+{LOTTERY_WINNER_NUMBER}',
+            'finish:',
+        ])
+        self.assertEqual(['success:round=1', 'success:'], replies)
+
+        replies = AgencySession(lottery).handle_messages([
+            'agency:1;round',
+            'request_results:',
+        ])
+        self.assertEqual(['success:round=2', 'winners:10000000'], replies)
+
+    def test_retried_bet_batches_are_acknowledged_but_not_stored_again(self):
+        lottery = self.open_lottery(1)
+        session = AgencySession(lottery)
+        replies = session.handle_messages([
+            'agency:1',
+            'bet_batch_seq:1#first+last+10000000+2000-12-20+7574',
+            'bet_batch_seq:1#first+last+10000000+2000-12-20+7574',
+        ])
+        self.assertEqual(['ack:1'], replies)
+
+        lottery.finish_betting(1)
+        self.assertEqual(['10000000'], lottery.winners(1))
+
+    def test_batches_with_the_same_bets_are_not_taken_as_retries(self):
+        lottery = self.open_lottery(1)
+        session = AgencySession(lottery)
+        replies = session.handle_messages([
+            'agency:1',
+            'bet_batch:first+last+10000000+2000-12-20+7574',
+            'bet_batch:first+last+10000000+2000-12-20+7574',
+            'bet_batch_seq:1#first+last+10000000+2000-12-20+7574',
+            'bet_batch_seq:2#first+last+10000000+2000-12-20+7574',
+        ])
+        self.assertEqual(['success:', 'success:', 'ack:2'], replies)
+
+        lottery.finish_betting(1)
+        self.assertEqual(['10000000'] * 4, lottery.winners(1))
+
+    def test_throttled_batch_is_sent_again_with_the_following_ones(self):
+        session = AgencySession(self.open_lottery(1), AdmissionController(bets_rate=2))
+        bet = 'first+last+10000000+2000-12-20+7500'
+        replies = session.handle_messages([
+            'agency:1',
+            f'bet_batch_seq:1#{bet}',
+            f'bet_batch_seq:2#{bet}*{bet}',
+            f'bet_batch_seq:3#{bet}',
+        ])
+        self.assertEqual('ack:1', replies[0])
+        self.assertTrue(replies[1].startswith('retry_after:2,'))
+        self.assertEqual(2, len(replies))
+
+        self.assertEqual([], session.handle_messages([f'bet_batch_seq:3#{bet}']))
+
+    def test_persistent_session_stays_open_across_rounds(self):
+        session = AgencySession(self.open_lottery(1), sessions=SessionRegistry(60))
+        replies = session.handle_messages(['agency:1;keepalive', 'heartbeat:'])
+        self.assertEqual(f'success:keepalive={session.token},60000', replies[0])
+        self.assertEqual('success:', replies[1])
+
+        for document in ['10000000', '10000001']:
+            replies = session.handle_messages([
+                f'bet_batch:first+last+{document}+2000-12-20+{LOTTERY_WINNER_NUMBER}',
+                'finish:',
+                'request_results:',
+            ])
+            self.assertEqual(['success:', f'winners:{document}'], replies)
+            self.assertFalse(session.finished)
+
+        session.handle_messages(['shutdown:'])
+        self.assertTrue(session.finished)
+
+    def test_sessions_are_taken_over_by_token_and_expire_when_idle(self):
+        lottery = self.open_lottery(2)
+        sessions = SessionRegistry(0.05)
+        first = AgencySession(lottery, sessions=sessions)
+        first.handle_messages(['agency:1;keepalive'])
+
+        second = AgencySession(lottery, sessions=sessions)
+        second.handle_messages([f'agency:1;keepalive={first.token}'])
+        self.assertEqual(first.token, second.token)
+        self.assertTrue(first.expired)
+
+        other = AgencySession(lottery, sessions=sessions)
+        other.handle_messages([f'agency:2;keepalive={first.token}'])
+        self.assertNotEqual(first.token, other.token)
+
+        self.assertFalse(second.expired)
+        time.sleep(0.1)
+        self.assertTrue(second.expired)
+
+    def test_results_requested_before_the_draw_are_pushed_to_waiters(self):
+        lottery = self.open_lottery(2, results_timeout=1.0)
+        session = AgencySession(lottery)
+        replies = session.handle_messages([
+            'agency:1',
+            'bet_batch:first+last+10000000+2000-12-20+7574',
+            'finish:',
+            'request_results:',
+        ])
+        self.assertEqual(['success:'], replies)
+        self.assertFalse(session.pending_results.done())
+
+        other_session = AgencySession(lottery)
+        other_session.handle_messages(['agency:2', 'finish:'])
+        self.assertTrue(session.pending_results.done())
+        self.assertEqual('winners:10000000', session.results_reply())
+
+    def test_parked_results_request_replies_not_ready_on_timeout(self):
+        session = AgencySession(self.open_lottery(2, results_timeout=1.0))
+        session.handle_messages(['agency:1', 'finish:', 'request_results:'])
+        self.assertEqual('not_ready:', session.results_reply())
+
+class TestServers(unittest.TestCase):
+
+    def setUp(self):
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            self.port = probe.getsockname()[1]
+
+    def tearDown(self):
+        shutil.rmtree(STORAGE_DIRPATH, ignore_errors=True)
+        for shard in range(2):
+            shutil.rmtree(SHARD_STORAGE_DIRPATH.format(shard=shard), ignore_errors=True)
+
+    def send_messages(self, messages, replies):
+        """
+        Send the messages in a new connection and return the first
+        `replies` lines replied by the server
+        """
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                connection = socket.create_connection(('127.0.0.1', self.port))
+                break
+            except ConnectionRefusedError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+
+        with connection, connection.makefile('rwb') as stream:
+            stream.write(''.join(f'{message}\n' for message in messages).encode())
+            stream.flush()
+            return [stream.readline().decode().rstrip('\n') for _ in range(replies)]
+
+    def play_lottery(self):
+        """
+        Every agency bets, finishes and polls its results until the draw
+        """
+        for agency in (1, 2):
+            replies = self.send_messages([
+                f'agency:{agency}',
+                f'bet_batch:first+last+1000000{agency}+2000-12-20+{LOTTERY_WINNER_NUMBER}*'
+                f'first+last+2000000{agency}+2000-12-20+1',
+                'finish:',
+                'request_results:',
+            ], 2)
+            self.assertEqual('success:', replies[0])
+
+        results = {}
+        deadline = time.monotonic() + 10
+        while len(results) < 2 and time.monotonic() < deadline:
+            for agency in (1, 2):
+                [reply] = self.send_messages([f'agency:{agency}', 'request_results:'], 1)
+                if reply.startswith('winners:'):
+                    results[agency] = reply
+            time.sleep(0.05)
+
+        return results
+
+    def test_threaded_server_plays_the_lottery_end_to_end(self):
+        server = Server(self.port, 8, Lottery(2))
+        thread = threading.Thread(target=server.run)
+        thread.start()
+        try:
+            results = self.play_lottery()
+        finally:
+            server.stop(None, None)
+            thread.join()
+        self.assertEqual({1: 'winners:10000001', 2: 'winners:10000002'}, results)
+
+    def test_async_server_plays_the_lottery_end_to_end(self):
+        server = AsyncServer(self.port, 8, Lottery(2))
+        thread = threading.Thread(target=server.run)
+        thread.start()
+        try:
+            results = self.play_lottery()
+        finally:
+            server.stop(None, None)
+            thread.join()
+        self.assertEqual({1: 'winners:10000001', 2: 'winners:10000002'}, results)
+
+    def test_worker_pool_plays_the_lottery_end_to_end(self):
+        pool = WorkerPool(self.port, 8, 2, AsyncServer, 2, {}, {})
+        thread = threading.Thread(target=pool.run)
+        thread.start()
+        try:
+            results = self.play_lottery()
+        finally:
+            pool.stop(None, None)
+            thread.join()
+        self.assertEqual({1: 'winners:10000001', 2: 'winners:10000002'}, results)
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_benchmark_agencies_send_every_bet_and_receive_results(self):
+        report = run_benchmark(
+            parse_args(['--agencies', '2', '--bets', '250', '--batch-size', '100'])
+        )
+        self.assertEqual([], report['errors'])
+        self.assertEqual(500, report['bets'])
+        self.assertGreater(report['bets_per_second'], 0)
+        self.assertLessEqual(report['ack_p50_ms'], report['ack_p99_ms'])
+
 if __name__ == '__main__':
     unittest.main()
 